@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Benchmark of the reconciliation done by opush_force (which online
+files/folders should be removed), on synthetic trees.
+
+    python benchmarks/bench_reconcile.py [--sizes 1000 10000 100000]
+
+The time per entry should stay (roughly) constant when the tree grows.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import ogit
+
+def synthetic_tree(nb_entries, files_per_folder=20, depth=3):
+    """A FileTree with nb_entries entries (files + folders), and the
+    list of local files (90% of the online files)."""
+    ft = ogit.FileTree()
+    ft.add_element("", "/", "root", "folder")
+    local_files = []
+    nb_folders = max(1, nb_entries // (files_per_folder + 1))
+    folders = []
+    for i in range(nb_folders):
+        parts = ["d{}".format((i // (10 ** k)) % 10) for k in range(depth - 1, 0, -1)] + ["f{}".format(i)]
+        path = "/"
+        for p in parts:
+            if not ft.get_element(path + p):
+                ft.add_element(p, path, "{}{}".format(path, p), "folder")
+            path = path + p + "/"
+        folders.append(path)
+    i = 0
+    while len(ft.l) < nb_entries:
+        folder = folders[i % len(folders)]
+        name = "file{}.tex".format(i)
+        ft.add_element(name, folder, "id{}".format(i), "doc")
+        # Some files (and therefore whole folders) have been removed locally
+        if i % 10 and (i % len(folders)) % 7:
+            local_files.append((folder + name).strip("/"))
+        i += 1
+    return ft, local_files
+
+def naive_stale_paths(ft, files_to_send):
+    """The previous (quadratic) implementation, for comparison."""
+    paths = [f.strip("/") for f in ft.get_list_files()
+             if f and not f.strip("/") in files_to_send]
+    for folder in [f.strip("/") for f in ft.get_list_folders() if f.strip("/")]:
+        if not [f for f in files_to_send if f.startswith(folder + "/")]:
+            paths.append(folder)
+    return paths
+
+def timeit(f, *args):
+    start = time.perf_counter()
+    res = f(*args)
+    return time.perf_counter() - start, res
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs='+', default=[1000, 10000, 50000, 100000])
+    parser.add_argument("--naive-max-size", type=int, default=5000,
+                        help="Also run the previous implementation up to this size")
+    args = parser.parse_args()
+    print("{:>8} {:>10} {:>14} {:>12}".format("entries", "time (s)", "us / entry", "naive (s)"))
+    per_entry = []
+    for n in args.sizes:
+        ft, local_files = synthetic_tree(n)
+        t, res = timeit(ogit.get_stale_paths, ft, local_files)
+        naive = ""
+        if n <= args.naive_max_size:
+            t_naive, res_naive = timeit(naive_stale_paths, ft, local_files)
+            assert sorted(res) == sorted(res_naive)
+            naive = "{:.3f}".format(t_naive)
+        per_entry.append(t / n)
+        print("{:>8} {:>10.3f} {:>14.2f} {:>12}".format(n, t, 1e6 * t / n, naive))
+    print("Time per entry, largest / smallest tree: {:.2f} (1 means linear)".format(per_entry[-1] / per_entry[0]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""Benchmark of ofetch, opull, opush and opush_force against the fake
+overleaf server (see fake_overleaf.py), on synthetic projects.
+
+    python benchmarks/bench_sync.py [--sizes 10 100 1000] [--latency 0.02]
+                                    [--save benchmarks/results/mine.json]
+                                    [--compare benchmarks/results/baseline.json]
+
+Each command is run in a new process, like a user would run it, with
+its own session cache. For each command, we store the wall time, the
+number of requests received by the server, the number of logins, and
+the phases reported by --profile-json. With --compare, the script
+exits with an error if a command does more requests than in the
+given results, or is more than --max-slowdown slower.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+OGIT = os.path.join(BENCH_DIR, "..", "ogit.py")
+sys.path.insert(0, BENCH_DIR)
+import fake_overleaf
+
+COMMANDS = ['ofetch', 'opull', 'opush', 'opush_force']
+
+def git(repo, *args):
+    return subprocess.run(["git"] + list(args), cwd=repo, check=True,
+                          capture_output=True, text=True).stdout
+
+def head_files(repo):
+    files = dict()
+    for f in git(repo, "ls-files", "-z").split("\0"):
+        if f:
+            with open(os.path.join(repo, f), "rb") as fh:
+                files[f] = fh.read()
+    return files
+
+def run_command(server, repo, env, command, *args):
+    """Run ogit.py command in repo, and return its measures."""
+    profile_file = os.path.join(repo, ".git", "ogit_profile.jsonl")
+    if os.path.exists(profile_file):
+        os.remove(profile_file)
+    nb_requests = server.state.nb_requests
+    nb_logins = server.state.nb_logins
+    start = time.perf_counter()
+    r = subprocess.run([sys.executable, OGIT, "-v", "WARNING", "--profile-json", profile_file, command] + list(args),
+                       cwd=repo, env=env, capture_output=True, text=True)
+    wall_time = time.perf_counter() - start
+    if r.returncode != 0:
+        raise RuntimeError("{} failed:\n{}{}".format(command, r.stdout, r.stderr))
+    with open(profile_file) as f:
+        profile = json.loads(f.read().splitlines()[-1])
+    return {'time': round(wall_time, 3),
+            'requests': server.state.nb_requests - nb_requests,
+            'logins': server.state.nb_logins - nb_logins,
+            'phases': {name: round(phase['time'], 3) for (name, phase) in profile['phases'].items()}}
+
+def bench_size(nb_files, latency, changed_ratio=0.01):
+    """Run the commands on a project of nb_files files. Between two
+    commands, some files are modified online (before opull) or locally
+    (before opush)."""
+    project = fake_overleaf.synthetic_project(nb_files)
+    tmp = tempfile.mkdtemp(prefix="ogit_bench_")
+    repo = os.path.join(tmp, "repo")
+    os.mkdir(repo)
+    env = dict(os.environ, XDG_CACHE_HOME=os.path.join(tmp, "cache"))
+    env.pop("OVERLEAF_PASSWORD", None)
+    results = dict()
+    nb_changed = max(1, int(nb_files * changed_ratio))
+    try:
+        with fake_overleaf.FakeOverleafServer(project, latency=latency) as server:
+            git(repo, "init", "-q")
+            git(repo, "config", "user.email", "bench@example.com")
+            git(repo, "config", "user.name", "Bench")
+            with open(os.path.join(repo, ".ogit_confproject"), "w") as f:
+                json.dump({'url_project': server.url_project,
+                           'email': "bench@example.com",
+                           'password': server.state.password}, f)
+            with open(os.path.join(repo, ".gitignore"), "w") as f:
+                f.write(".ogit_svg\n.ogit_confproject\n")
+
+            results['ofetch'] = run_command(server, repo, env, 'ofetch')
+
+            # Collaborators modified some files
+            online = project.files()
+            for path in sorted(p for p in online if p.endswith(".tex"))[:nb_changed]:
+                project.add_path(path, online[path] + b"% online edit\n")
+            results['opull'] = run_command(server, repo, env, 'opull')
+
+            # We modified, added and removed some files
+            local = sorted(f for f in head_files(repo) if f.endswith(".tex"))
+            for path in local[-nb_changed:]:
+                with open(os.path.join(repo, path), "a") as f:
+                    f.write("% local edit\n")
+            os.remove(os.path.join(repo, local[0]))
+            os.makedirs(os.path.join(repo, "bench"), exist_ok=True)
+            with open(os.path.join(repo, "bench", "new.tex"), "w") as f:
+                f.write("new\n")
+            git(repo, "add", "-A")
+            git(repo, "commit", "-qm", "Local modifications")
+            results['opush'] = run_command(server, repo, env, 'opush')
+
+            results['opush_force'] = run_command(server, repo, env, 'opush_force', '--full')
+            if head_files(repo) != project.files():
+                raise RuntimeError("The online project differs from the local one after opush_force")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return results
+
+def compare(results, baseline, max_slowdown, min_time=0.2):
+    """List of the regressions of results with respect to baseline."""
+    regressions = []
+    for size, commands in results['results'].items():
+        for command, res in commands.items():
+            base = baseline['results'].get(size, {}).get(command)
+            if not base:
+                continue
+            if res['requests'] > base['requests']:
+                regressions.append("{} files, {}: {} requests instead of {}".format(
+                    size, command, res['requests'], base['requests']))
+            # Small times are too noisy to be compared
+            if res['time'] > base['time'] * (1 + max_slowdown) and res['time'] - base['time'] > min_time:
+                regressions.append("{} files, {}: {:.2f}s instead of {:.2f}s".format(
+                    size, command, res['time'], base['time']))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs='+', default=[10, 100, 1000],
+                        help="Number of files of the projects (up to 50000)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Latency added by the server to each request (in seconds)")
+    parser.add_argument("--save", metavar="FILE", help="Save the results in FILE (json)")
+    parser.add_argument("--compare", metavar="FILE", help="Compare with the results saved in FILE")
+    parser.add_argument("--max-slowdown", type=float, default=0.25,
+                        help="Tolerated slowdown with --compare (default 0.25 = 25%%)")
+    args = parser.parse_args()
+    results = {'date': datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'latency': args.latency,
+               'results': dict()}
+    print("{:>8} {:>12} {:>10} {:>10} {:>8}".format("files", "command", "time (s)", "requests", "logins"))
+    for n in args.sizes:
+        res = bench_size(n, args.latency)
+        results['results'][str(n)] = res
+        for command in COMMANDS:
+            print("{:>8} {:>12} {:>10.2f} {:>10} {:>8}".format(
+                n, command, res[command]['time'], res[command]['requests'], res[command]['logins']))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print("Results saved in {}".format(args.save))
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('latency') != args.latency:
+            print("Warning: the baseline was measured with a latency of {}s".format(baseline.get('latency')))
+        regressions = compare(results, baseline, args.max_slowdown)
+        for r in regressions:
+            print("REGRESSION: " + r)
+        if regressions:
+            sys.exit(1)
+        print("No regression with respect to {}".format(args.compare))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,624 @@
+#!/usr/bin/env python3
+"""A small stand-in for the overleaf website, implementing only
+the endpoints used by ogit. Used by the benchmarks, never talks to
+the real overleaf.
+
+Run it with:
+    python benchmarks/fake_overleaf.py --port 8080 --nb-files 100 --latency 0.05
+and use the printed url as url_project (any email, password "password").
+POST /_fake/edit {"doc_id", "pos", "text"} simulates a collaborator
+editing a doc.
+"""
+
+import argparse
+import base64
+import collections
+import hashlib
+import io
+import json
+import random
+import socket
+import struct
+import threading
+import time
+import uuid
+import zipfile
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+PROJECT_ID = "5c0ffee0000000000000000a"
+CSRF_TOKEN = "fake-csrf-token"
+WS_MAGIC = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+DOC_EXTENSIONS = ('.tex', '.bib', '.txt', '.cls', '.sty', '.md')
+
+def new_id():
+    return uuid.uuid4().hex[:24]
+
+##############################
+### The project itself
+##############################
+
+class Entity:
+    def __init__(self, name, file_type, parent=None, content=b""):
+        self._id = new_id()
+        self.name = name
+        self.file_type = file_type # folder, doc or file
+        self.parent = parent
+        self.children = dict() # name -> Entity
+        self.content = content
+        self.version = 0
+
+    def path(self):
+        if self.parent is None:
+            return ""
+        parent_path = self.parent.path()
+        return (parent_path + "/" if parent_path else "") + self.name
+
+    def to_json(self):
+        return {'_id': self._id,
+                'name': self.name,
+                'folders': [c.to_json() for c in self.children.values() if c.file_type == 'folder'],
+                'docs': [{'_id': c._id, 'name': c.name} for c in self.children.values() if c.file_type == 'doc'],
+                'fileRefs': [{'_id': c._id, 'name': c.name} for c in self.children.values() if c.file_type == 'file']}
+
+class Project:
+    """In-memory overleaf project. Every mutation is broadcast to the
+    connected websockets as overleaf does. Like on overleaf, version
+    (given by joinProject) only changes with the file tree, while
+    content_version (used for the ETag of the zip) changes with any
+    modification, including the edits of the docs."""
+    def __init__(self, name="Fake project"):
+        self.name = name
+        self.lock = threading.RLock()
+        self.root = Entity("rootFolder", 'folder')
+        self.by_id = {self.root._id: self.root}
+        self.listeners = []
+        self.version = 0
+        self.content_version = 0
+
+    def broadcast(self, name, *args):
+        msg = '5:::' + json.dumps({'name': name, 'args': list(args)})
+        for listener in list(self.listeners):
+            listener(msg)
+
+    def add(self, parent, name, file_type, content=b""):
+        with self.lock:
+            if name in parent.children:
+                old = parent.children[name]
+                if file_type != 'folder' and old.file_type != 'folder':
+                    old.content = content
+                    old.version += 1
+                    self.content_version += 1
+                    if old.file_type != 'doc':
+                        # The file is replaced by a new one
+                        self.version += 1
+                    return old
+                raise FileExistsError(name)
+            e = Entity(name, file_type, parent, content)
+            parent.children[name] = e
+            self.by_id[e._id] = e
+            self.version += 1
+            self.content_version += 1
+            if file_type == 'folder':
+                self.broadcast('reciveNewFolder', parent._id, {'_id': e._id, 'name': name, 'folders': [], 'docs': [], 'fileRefs': []})
+            elif file_type == 'doc':
+                self.broadcast('reciveNewDoc', parent._id, {'_id': e._id, 'name': name})
+            else:
+                self.broadcast('reciveNewFile', parent._id, {'_id': e._id, 'name': name}, 'upload', None, None)
+            return e
+
+    def add_path(self, path, content):
+        parts = [p for p in path.split('/') if p]
+        folder = self.root
+        for p in parts[:-1]:
+            folder = folder.children.get(p) or self.add(folder, p, 'folder')
+        file_type = 'doc' if parts[-1].endswith(DOC_EXTENSIONS) else 'file'
+        return self.add(folder, parts[-1], file_type, content)
+
+    def remove(self, e):
+        with self.lock:
+            def unindex(x):
+                self.by_id.pop(x._id, None)
+                for c in x.children.values():
+                    unindex(c)
+            e.parent.children.pop(e.name, None)
+            unindex(e)
+            self.version += 1
+            self.content_version += 1
+            self.broadcast('removeEntity', e._id, 'editor')
+
+    def rename(self, e, name):
+        with self.lock:
+            if name in e.parent.children:
+                raise FileExistsError(name)
+            e.parent.children.pop(e.name)
+            e.name = name
+            e.parent.children[name] = e
+            self.version += 1
+            self.content_version += 1
+            self.broadcast('reciveEntityRename', e._id, name)
+
+    def move(self, e, folder):
+        with self.lock:
+            if e.name in folder.children:
+                raise FileExistsError(e.name)
+            e.parent.children.pop(e.name)
+            e.parent = folder
+            folder.children[e.name] = e
+            self.version += 1
+            self.content_version += 1
+            self.broadcast('reciveEntityMove', e._id, folder._id)
+
+    def edit_doc(self, e, pos, text):
+        """Simulate a collaborator inserting text in a doc."""
+        with self.lock:
+            s = e.content.decode('utf-8')
+            e.content = (s[:pos] + text + s[pos:]).encode('utf-8')
+            e.version += 1
+            self.content_version += 1
+            self.broadcast('otUpdateApplied', {'doc': e._id, 'op': [{'p': pos, 'i': text}], 'v': e.version - 1})
+
+    def zip_bytes(self):
+        buf = io.BytesIO()
+        with self.lock, zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as z:
+            def walk(e):
+                for c in e.children.values():
+                    if c.file_type == 'folder':
+                        walk(c)
+                    else:
+                        z.writestr(c.path(), c.content)
+            walk(self.root)
+        return buf.getvalue()
+
+    def join_project_json(self):
+        with self.lock:
+            return {'_id': PROJECT_ID,
+                    'name': self.name,
+                    'version': self.version,
+                    'rootFolder': [self.root.to_json()]}
+
+    def files(self):
+        with self.lock:
+            res = dict()
+            def walk(e):
+                for c in e.children.values():
+                    if c.file_type == 'folder':
+                        walk(c)
+                    else:
+                        res[c.path()] = c.content
+            walk(self.root)
+            return res
+
+def synthetic_project(nb_files, nb_folders=None, file_size=200, seed=0):
+    """A project with nb_files files spread over nb_folders folders."""
+    rnd = random.Random(seed)
+    nb_folders = nb_folders if nb_folders is not None else max(1, nb_files // 20)
+    project = Project()
+    project.add_path("main.tex", b"\\documentclass{article}\n\\begin{document}\nHello\n\\end{document}\n")
+    folders = ["chapter{}/part{}".format(i // 10, i % 10) for i in range(nb_folders)]
+    for i in range(1, nb_files):
+        folder = folders[rnd.randrange(len(folders))]
+        content = "% file {}\n".format(i).encode() + bytes(rnd.randrange(32, 127) for _ in range(file_size))
+        ext = '.tex' if i % 4 else '.png'
+        project.add_path("{}/f{}{}".format(folder, i, ext), content)
+    return project
+
+##############################
+### Websocket (minimal RFC 6455)
+##############################
+
+class WebSocket:
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def send(self, text):
+        data = text.encode('utf-8')
+        header = bytes([0x81])
+        if len(data) < 126:
+            header += bytes([len(data)])
+        elif len(data) < 65536:
+            header += bytes([126]) + struct.pack(">H", len(data))
+        else:
+            header += bytes([127]) + struct.pack(">Q", len(data))
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.conn.sendall(header + data)
+            except OSError:
+                self.closed = True
+
+    def _read_exact(self, n):
+        buf = b""
+        while len(buf) < n:
+            chunk = self.conn.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError("closed")
+            buf += chunk
+        return buf
+
+    def recv(self):
+        """Return the next text message, or None when closed."""
+        try:
+            b1, b2 = self._read_exact(2)
+            opcode = b1 & 0x0f
+            length = b2 & 0x7f
+            if length == 126:
+                length = struct.unpack(">H", self._read_exact(2))[0]
+            elif length == 127:
+                length = struct.unpack(">Q", self._read_exact(8))[0]
+            mask = self._read_exact(4) if b2 & 0x80 else b"\0\0\0\0"
+            payload = bytes(c ^ mask[i % 4] for i, c in enumerate(self._read_exact(length)))
+        except (ConnectionError, OSError, ValueError):
+            self.closed = True
+            return None
+        if opcode == 8:
+            self.closed = True
+            return None
+        if opcode == 9:
+            return self.recv()
+        return payload.decode('utf-8')
+
+##############################
+### HTTP server
+##############################
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def _start_request(self):
+        """Wait for the latency, and return True if the request must be
+        throttled (see State)."""
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        with self.state.lock:
+            self.state.nb_requests += 1
+            if self.state.fail_next:
+                self.state.fail_next -= 1
+                self.state.nb_throttled += 1
+                return True
+            if self.state.max_rate:
+                now = time.time()
+                recent = self.state.recent_requests
+                while recent and recent[0] < now - 1:
+                    recent.popleft()
+                if len(recent) >= self.state.max_rate:
+                    self.state.nb_throttled += 1
+                    return True
+                recent.append(now)
+        return False
+
+    def _throttle(self):
+        self._body()
+        return self._send(429, "Too many requests", content_type="text/plain",
+                          headers={'Retry-After': str(self.state.retry_after)} if self.state.retry_after else None)
+
+    def _send(self, code, body=b"", content_type="application/json", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        elif isinstance(body, str):
+            body = body.encode()
+        self.send_response(code)
+        if body:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _json(self):
+        try:
+            return json.loads(self._body() or b"{}")
+        except ValueError:
+            return {}
+
+    def _authenticated(self):
+        return "overleaf_session=s%3Aauth" in (self.headers.get('Cookie') or "")
+
+    def _check_csrf(self, body_json=None, query=None):
+        token = (self.headers.get('X-Csrf-Token')
+                 or (body_json or {}).get('_csrf')
+                 or (query or {}).get('_csrf', [None])[0])
+        return token == CSRF_TOKEN
+
+    def _project_path(self, path):
+        prefix = "/project/{}/".format(PROJECT_ID)
+        return path[len(prefix):] if path.startswith(prefix) else None
+
+    def do_GET(self):
+        if self._start_request():
+            return self._throttle()
+        url = urlparse(self.path)
+        if url.path == "/login":
+            return self._send(200, '<form><input name="_csrf" type="hidden" value="{}"></form>'.format(CSRF_TOKEN),
+                              content_type="text/html",
+                              headers={'Set-Cookie': 'overleaf_session=s%3Aanon{}; Path=/'.format(new_id())})
+        if not self._authenticated():
+            return self._send(302, headers={'Location': '/login'})
+        if url.path == "/socket.io/1/":
+            return self._send(200, "{}:60:60:websocket".format(new_id()), content_type="text/plain")
+        if url.path.startswith("/socket.io/1/websocket/"):
+            return self._websocket()
+        sub = self._project_path(url.path)
+        if sub == "download/zip":
+            data = self.state.project.zip_bytes()
+            etag = '"v{}"'.format(self.state.project.content_version)
+            rng = self.headers.get('Range')
+            start = 0
+            if rng and self.state.support_range and self.headers.get('If-Range', etag) == etag:
+                start = int(rng.split('=')[1].split('-')[0])
+                if start >= len(data):
+                    return self._send(416, headers={'Content-Range': 'bytes */{}'.format(len(data))})
+            if self.state.drop_downloads:
+                # Simulate a flaky connection: send only half of the zip
+                self.state.drop_downloads -= 1
+                self.send_response(206 if start else 200)
+                self.send_header("Content-Length", str(len(data) - start))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(data[start:start + (len(data) - start) // 2])
+                self.wfile.flush()
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+                return
+            if start:
+                return self._send(206, data[start:], content_type="application/zip",
+                                  headers={'Content-Range': 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data)),
+                                           'ETag': etag})
+            return self._send(200, data, content_type="application/zip", headers={'ETag': etag})
+        if sub and sub.startswith("file/"):
+            e = self.state.project.by_id.get(sub.split('/')[1])
+            if not e:
+                return self._send(404, "Not found")
+            return self._send(200, e.content, content_type="application/octet-stream")
+        return self._send(404, "Not found")
+
+    def do_POST(self):
+        if self._start_request():
+            return self._throttle()
+        url = urlparse(self.path)
+        project = self.state.project
+        if url.path == "/login":
+            data = self._json()
+            if data.get('_csrf') != CSRF_TOKEN:
+                return self._send(403, {'message': {'type': 'error', 'text': 'Bad csrf'}})
+            if data.get('password') != self.state.password:
+                return self._send(200, {'message': {'type': 'error', 'text': 'Your email or password is incorrect.'}})
+            with self.state.lock:
+                self.state.nb_logins += 1
+            return self._send(200, {'redir': '/project'},
+                              headers={'Set-Cookie': 'overleaf_session=s%3Aauth{}; Path=/'.format(new_id())})
+        if not self._authenticated():
+            return self._send(302, headers={'Location': '/login'})
+        sub = self._project_path(url.path)
+        if sub == "folder":
+            data = self._json()
+            if not self._check_csrf(data):
+                return self._send(403, "Forbidden")
+            parent = project.by_id.get(data.get('parent_folder_id'))
+            if not parent or parent.file_type != 'folder':
+                return self._send(404, "Not found")
+            try:
+                e = project.add(parent, data['name'], 'folder')
+            except FileExistsError:
+                return self._send(400, "file already exists", content_type="text/plain")
+            return self._send(200, {'_id': e._id, 'name': e.name, 'folders': [], 'docs': [], 'fileRefs': []})
+        if sub == "upload":
+            query = parse_qs(url.query)
+            if not self._check_csrf(query=query):
+                return self._send(403, "Forbidden")
+            parent = project.by_id.get(query.get('folder_id', [None])[0])
+            if not parent or parent.file_type != 'folder':
+                return self._send(404, "Not found")
+            body = self._body()
+            msg = BytesParser(policy=HTTP).parsebytes(
+                b"Content-Type: " + self.headers['Content-Type'].encode() + b"\r\n\r\n" + body)
+            part = next(p for p in msg.iter_parts() if p.get_param('name', header='content-disposition') == 'qqfile')
+            name = part.get_filename()
+            content = part.get_payload(decode=True) or b""
+            file_type = 'doc' if name.endswith(DOC_EXTENSIONS) else 'file'
+            try:
+                e = project.add(parent, name, file_type, content)
+            except FileExistsError:
+                return self._send(200, {'success': False, 'error': 'file already exists'})
+            return self._send(200, {'success': True, 'entity_id': e._id, 'entity_type': e.file_type})
+        if sub:
+            parts = sub.split('/')
+            if len(parts) == 3 and parts[2] in ('rename', 'move'):
+                data = self._json()
+                if not self._check_csrf(data):
+                    return self._send(403, "Forbidden")
+                e = project.by_id.get(parts[1])
+                if not e:
+                    return self._send(404, "Not found")
+                try:
+                    if parts[2] == 'rename':
+                        project.rename(e, data['name'])
+                    else:
+                        folder = project.by_id.get(data['folder_id'])
+                        if not folder or folder.file_type != 'folder':
+                            return self._send(404, "Not found")
+                        project.move(e, folder)
+                except FileExistsError:
+                    return self._send(400, "file already exists", content_type="text/plain")
+                return self._send(204)
+        if url.path == "/_fake/edit":
+            data = self._json()
+            e = project.by_id.get(data['doc_id'])
+            project.edit_doc(e, data['pos'], data['text'])
+            return self._send(204)
+        return self._send(404, "Not found")
+
+    def do_DELETE(self):
+        if self._start_request():
+            return self._throttle()
+        if not self._authenticated():
+            return self._send(302, headers={'Location': '/login'})
+        if not self._check_csrf():
+            return self._send(403, "Forbidden")
+        sub = self._project_path(urlparse(self.path).path)
+        parts = (sub or "").split('/')
+        if len(parts) == 2 and parts[0] in ('doc', 'file', 'folder'):
+            e = self.state.project.by_id.get(parts[1])
+            if not e or e is self.state.project.root:
+                return self._send(404, "Not found")
+            self.state.project.remove(e)
+            return self._send(204)
+        return self._send(404, "Not found")
+
+    def _websocket(self):
+        key = self.headers.get('Sec-WebSocket-Key')
+        accept = base64.b64encode(hashlib.sha1((key + WS_MAGIC).encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+        ws = WebSocket(self.connection)
+        project = self.state.project
+        joined_docs = set()
+        def listener(msg):
+            if msg.startswith('5:::{"name": "otUpdateApplied"'):
+                doc_id = json.loads(msg[4:])['args'][0]['doc']
+                if doc_id not in joined_docs:
+                    return
+            ws.send(msg)
+        ws.send("1::")
+        with self.state.lock:
+            reject = self.state.reject_sockets > 0
+            if reject:
+                self.state.reject_sockets -= 1
+        if reject:
+            ws.send('5:::{"name":"connectionRejected","args":[{"message":"not authorized"}]}')
+            self.close_connection = True
+            return
+        ws.send('5:::{"name":"connectionAccepted"}')
+        try:
+            while True:
+                msg = ws.recv()
+                if msg is None:
+                    break
+                if self.state.latency:
+                    time.sleep(self.state.latency)
+                if msg.startswith("2::"):
+                    continue
+                if msg.startswith("5:"):
+                    head, _, payload = msg.partition('+::')
+                    ack = head.split(':')[1]
+                    data = json.loads(payload)
+                    if data['name'] == 'joinProject':
+                        with self.state.lock:
+                            self.state.nb_join_project += 1
+                            refuse = self.state.refuse_join_project > 0
+                            if refuse:
+                                self.state.refuse_join_project -= 1
+                        if refuse:
+                            ws.send('6:::{}+{}'.format(ack, json.dumps([{'message': 'not authorized'}])))
+                            continue
+                        ws.send('6:::{}+{}'.format(ack, json.dumps([None, project.join_project_json(), 'owner', 2])))
+                        if listener not in project.listeners:
+                            project.listeners.append(listener)
+                    elif data['name'] == 'joinDoc':
+                        e = project.by_id.get(data['args'][0])
+                        joined_docs.add(e._id)
+                        lines = e.content.decode('utf-8').split('\n')
+                        ws.send('6:::{}+{}'.format(ack, json.dumps([None, lines, e.version, [], {}])))
+                    elif data['name'] == 'leaveDoc':
+                        joined_docs.discard(data['args'][0])
+                        ws.send('6:::{}+{}'.format(ack, json.dumps([None])))
+        finally:
+            if listener in project.listeners:
+                project.listeners.remove(listener)
+            self.close_connection = True
+
+class State:
+    """Configuration and counters of the server. The server answers 429
+    to the fail_next next requests, and to the requests beyond max_rate
+    per second (with a Retry-After of retry_after seconds if given). The
+    reject_sockets next socket.io connections are rejected, and the
+    refuse_join_project next joinProject get a 'not authorized' error."""
+    def __init__(self, project, latency=0.0, password="password", support_range=True, max_rate=None, retry_after=None):
+        self.project = project
+        self.latency = latency
+        self.password = password
+        self.support_range = support_range
+        self.max_rate = max_rate
+        self.retry_after = retry_after
+        self.recent_requests = collections.deque()
+        self.fail_next = 0
+        self.drop_downloads = 0
+        self.reject_sockets = 0
+        self.refuse_join_project = 0
+        self.lock = threading.Lock()
+        self.nb_requests = 0
+        self.nb_throttled = 0
+        self.nb_logins = 0
+        self.nb_join_project = 0
+
+class FakeOverleafServer:
+    """Runs the fake server in a background thread:
+        with FakeOverleafServer(synthetic_project(100)) as server:
+            server.url_project
+    """
+    def __init__(self, project=None, latency=0.0, port=0, **kwargs):
+        self.state = State(project or synthetic_project(10), latency=latency, **kwargs)
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = self.state
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    @property
+    def url_project(self):
+        return "http://127.0.0.1:{}/project/{}/".format(self.port, PROJECT_ID)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake overleaf server for ogit benchmarks')
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--nb-files", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0, help="Latency added to each request (in seconds)")
+    parser.add_argument("--max-rate", type=int, help="Answer 429 beyond this number of requests per second")
+    args = parser.parse_args()
+    server = FakeOverleafServer(synthetic_project(args.nb_files), latency=args.latency, port=args.port,
+                                max_rate=args.max_rate)
+    print("Serving {}".format(server.url_project))
+    server.httpd.serve_forever()
+
+if __name__ == "__main__":
+    main()
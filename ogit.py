@@ -8,21 +8,37 @@
 from bs4 import BeautifulSoup
 import json
 import requests
+import urllib3 # installed with requests
 import curlify
 from getpass import getpass
 import os
-from websocket import create_connection # websocket-client
+from websocket import create_connection, WebSocketTimeoutException # websocket-client
 import logging
 import zipfile
+import tarfile
+import struct
+import zlib
+import io
 import ntpath
-from pathlib import Path
 from datetime import datetime
 import git
 import shutil
-from distutils.dir_util import copy_tree
 import subprocess
 import sys
 import argparse
+import signal
+import contextlib
+import cProfile
+import functools
+import threading
+import time
+import hashlib
+import random
+import bisect
+import heapq
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from urllib.parse import urlparse
 
 ##############################
 ### Logger
@@ -39,9 +55,213 @@ logging.Logger.spam = spam
 logger = logging.getLogger('root')
 FORMAT = "[%(filename)s:%(lineno)s - %(funcName)20s() ] %(message)s"
 logging.basicConfig(format=FORMAT)
-# logger.setLevel(logging.INFO)
-# logger.setLevel(logging.DEBUG)
-logger.setLevel(logging.SPAM)
+# Can be changed with the -v option
+logger.setLevel(logging.INFO)
+
+class AsCurl:
+    """Lazy curl version of a request, only computed if the log
+    message is written: logger.debug("%s", AsCurl(r.request))."""
+    def __init__(self, request):
+        self.request = request
+
+    def __str__(self):
+        return curlify.to_curl(self.request)
+
+##############################
+### Tracing
+##############################
+
+class Tracer:
+    """Records a span for each HTTP request, socket.io exchange and
+    git call (kind, name, start, duration, sizes...). The spans are
+    written as JSON lines in the file given to enable(), and totals
+    per kind are kept for summary(). Nothing is done until enable()
+    is called, the callers check self.enabled before measuring
+    anything."""
+    def __init__(self):
+        self.enabled = False
+        self.fd = None
+        self.lock = threading.Lock()
+        self.totals = dict() # kind -> {'count', 'duration', 'bytes_sent', 'bytes_received'}
+
+    def enable(self, path):
+        """Spans are appended to path ("-" for stderr). The file is
+        opened in append mode, so that several processes (see omulti)
+        can write in it."""
+        if path == "-":
+            self.fd = sys.stderr.fileno()
+        else:
+            self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.enabled = True
+
+    def record(self, kind, name, start, duration, **attributes):
+        """Record a span that started at start (time.time()) and lasted
+        duration seconds."""
+        if not self.enabled:
+            return
+        span = {'kind': kind,
+                'name': name,
+                'start': round(start, 6),
+                'duration': round(duration, 6),
+                'pid': os.getpid(),
+                'thread': threading.current_thread().name}
+        span.update(attributes)
+        line = (json.dumps(span, default=str) + "\n").encode()
+        with self.lock:
+            total = self.totals.setdefault(kind, {'count': 0, 'duration': 0.0,
+                                                  'bytes_sent': 0, 'bytes_received': 0})
+            total['count'] += 1
+            total['duration'] += duration
+            for key in ['bytes_sent', 'bytes_received']:
+                total[key] += attributes.get(key) or 0
+            # A single write per line, the lines of several threads or
+            # processes are not mixed
+            os.write(self.fd, line)
+
+    @contextlib.contextmanager
+    def span(self, kind, name, **attributes):
+        """Context manager recording the time spent in the block. The
+        yielded dict can be completed with attributes known at the end
+        (like the size of the answer)."""
+        if not self.enabled:
+            yield attributes
+            return
+        start = time.time()
+        start_perf = time.perf_counter()
+        try:
+            yield attributes
+        except BaseException as e:
+            attributes['error'] = repr(e)
+            raise
+        finally:
+            self.record(kind, name, start, time.perf_counter() - start_perf, **attributes)
+
+    def summary(self):
+        with self.lock:
+            return "; ".join("{}: {} spans, {:.2f}s, {:.1f} kB sent, {:.1f} kB received".format(
+                kind, t['count'], t['duration'], t['bytes_sent'] / 1e3, t['bytes_received'] / 1e3)
+                             for kind, t in sorted(self.totals.items()))
+
+    def close(self):
+        if self.fd is not None and self.fd != sys.stderr.fileno():
+            os.close(self.fd)
+        self.fd = None
+        self.enabled = False
+
+## Spans of the current process, see the --trace option
+tracer = Tracer()
+
+##############################
+### Profiling
+##############################
+
+class Profiler:
+    """Wall-clock time and counters (requests, bytes, files...) of
+    the phases of a command (login, ls, download, import, push...),
+    see the --profile option. Phases are nested: a phase started
+    inside another one is named parent/name. The counters are added
+    to the running phases of the current thread (and to the total)."""
+    COUNTERS = ['requests', 'bytes_sent', 'bytes_received', 'files', 'git_commands']
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.phases = dict() # full name -> {'calls', 'time', counters...} (in order of first call)
+        self.totals = dict()
+        self.start = None
+        self.wall_time = None
+
+    def enable(self):
+        self.enabled = True
+        self.start = time.perf_counter()
+
+    def stop(self):
+        self.wall_time = time.perf_counter() - self.start
+
+    def current(self):
+        """Full name of the running phase of this thread."""
+        stack = getattr(self.local, 'stack', None)
+        return stack[-1] if stack else None
+
+    @contextlib.contextmanager
+    def phase(self, name, parent=None):
+        """Context manager timing a phase. parent defaults to the running
+        phase of this thread (give it for the work done in other threads)."""
+        if not self.enabled:
+            yield
+            return
+        parent = parent or self.current()
+        full_name = parent + "/" + name if parent else name
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        with self.lock:
+            self.phases.setdefault(full_name, {'calls': 0, 'time': 0.0})
+        self.local.stack.append(full_name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.local.stack.pop()
+            with self.lock:
+                self.phases[full_name]['calls'] += 1
+                self.phases[full_name]['time'] += duration
+
+    def count(self, counter, value=1):
+        """Add value to counter in the running phases (and their parents)."""
+        if not self.enabled:
+            return
+        current = self.current()
+        with self.lock:
+            self.totals[counter] = self.totals.get(counter, 0) + value
+            while current:
+                phase = self.phases[current]
+                phase[counter] = phase.get(counter, 0) + value
+                current = current.rpartition("/")[0]
+
+    def to_dict(self):
+        with self.lock:
+            return {'wall_time': self.wall_time,
+                    'totals': dict(self.totals),
+                    'phases': {name: dict(phase) for name, phase in self.phases.items()}}
+
+    def report(self):
+        """Table of the phases, with their time and counters."""
+        wall_time = self.wall_time or (time.perf_counter() - self.start)
+        lines = ["{:<32} {:>6} {:>9} {:>5} {:>9} {:>10} {:>10} {:>7} {:>5}".format(
+            "phase", "calls", "time (s)", "%", "requests", "kB sent", "kB recv", "files", "git")]
+        def row(name, calls, duration, counters):
+            return "{:<32} {:>6} {:>9.3f} {:>4.0f}% {:>9} {:>10.1f} {:>10.1f} {:>7} {:>5}".format(
+                name, calls, duration, 100 * duration / max(wall_time, 1e-9),
+                counters.get('requests', 0), counters.get('bytes_sent', 0) / 1e3,
+                counters.get('bytes_received', 0) / 1e3, counters.get('files', 0),
+                counters.get('git_commands', 0))
+        with self.lock:
+            # The sub-phases are listed after their parent
+            order = {name: i for (i, name) in enumerate(self.phases)}
+            def key(item):
+                parts = item[0].split("/")
+                return [order["/".join(parts[:i + 1])] for i in range(len(parts))]
+            for name, phase in sorted(self.phases.items(), key=key):
+                depth = name.count("/")
+                lines.append(row("  " * depth + name.rpartition("/")[2], phase['calls'], phase['time'], phase))
+            lines.append(row("total", 1, wall_time, self.totals))
+        lines.append("(the operations run in parallel, like the uploads, have their times added)")
+        return "\n".join(lines)
+
+## Phases of the current command, see the --profile option
+profiler = Profiler()
+
+def profiled(name):
+    """Decorator running the function in the phase name (see Profiler)."""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with profiler.phase(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
 
 ##############################
 ### Constants
@@ -142,6 +362,9 @@ class RunsInOgitRepo(GitException):
 class ErrorDuringMerge(GitException):
     """When an error occurs during the merge (merge conflict...)"""
 
+class OnlineChangesNotMerged(GitException):
+    """When the online modifications have not been merged in the current branch."""
+
 class DirtyRepository(GitException):
     """When an error occurs during the merge (merge conflict...)"""
 
@@ -159,18 +382,82 @@ class ProjectConfAlreadExist(ProjectConfException):
 ### Way to represent a file/folder in overleaf
 ##############################
 
+class FileTreeNode:
+    """A file, doc or folder of a FileTree. The parent is the folder
+    node containing it, and children maps the names of the elements
+    of a folder to their node (None for files). For compatibility,
+    the node can be read like a dict: node['_id'], node['path']..."""
+    __slots__ = ('name', '_id', 'file_type', 'parent', 'children', 'path_name')
+
+    def __init__(self, name, _id, file_type, parent=None, path_name="/"):
+        self.name = name
+        self._id = _id
+        self.file_type = file_type
+        self.parent = parent
+        self.children = dict() if file_type == 'folder' else None
+        # Same string as the key of the path index
+        self.path_name = path_name
+
+    @property
+    def parent_id(self):
+        return self.parent._id if self.parent else None
+
+    @property
+    def path(self):
+        """Path of the folder containing the element, with a trailing slash."""
+        if self.parent is None:
+            return "/"
+        return self.path_name[:len(self.path_name) - len(self.name)]
+
+    def __getitem__(self, key):
+        if key in ('name', 'path', '_id', 'file_type', 'parent_id'):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        return {'name': self.name,
+                'path': self.path,
+                '_id': self._id,
+                'file_type': self.file_type,
+                'parent_id': self.parent_id}
+
+    def iter_subtree(self):
+        """Iterate over the node and all its descendants (without recursion)."""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            if node.children:
+                stack.extend(node.children.values())
+
 class FileTree:
     """Represents a file/folder tree on overleaf's website.
     We register here the file/folder ids, as well as the
+    parent/children relations. Elements can be found in O(1)
+    from their path (self.l) or from their id (self.ids).
     """
     def __init__(self):
-        self.l = dict()
+        self.l = dict() # path_name -> FileTreeNode
+        self.ids = dict() # _id -> FileTreeNode
+        self._list_files = None
+        self._list_folders = None
+        # The tree can be updated by several threads during a push
+        self.lock = threading.RLock()
 
     def get_canon_path(self, path_name, should_finish_slash=False):
         """Depending on the context, path should have a trailing slash (in ['path']) or not (in key). Get the canonical version of a path!"""
         # Path should start and end with /
         if len(path_name) == 0 or path_name == "/":
             return "/"
+        if path_name[0] == "/" and (path_name[-1] == "/") == should_finish_slash:
+            # Already canonical, the most usual case
+            return path_name
         else:
             if should_finish_slash:
                if path_name[-1] != "/":
@@ -184,56 +471,1079 @@ class FileTree:
                 path_name = "/" + path_name
             return path_name
 
+    def _invalidate(self):
+        self._list_files = None
+        self._list_folders = None
+
+    def _unindex(self, node):
+        for n in node.iter_subtree():
+            if self.l.get(n.path_name) is n:
+                del self.l[n.path_name]
+            if self.ids.get(n._id) is n:
+                del self.ids[n._id]
+
+    def _index(self, node):
+        """(Re)compute the path of node and its descendants and index them."""
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            if n.parent is not None:
+                n.path_name = (n.parent.path_name if n.parent.parent is not None else "") + "/" + n.name
+            self.l[n.path_name] = n
+            self.ids[n._id] = n
+            if n.children:
+                stack.extend(n.children.values())
+
+    def _detach(self, node):
+        if node.parent is not None and node.parent.children.get(node.name) is node:
+            del node.parent.children[node.name]
+
     def add_element(self, name, path, _id, file_type, parent_id=None):
         """a path starts with a slash and ends with a slash.
         file_type can be either folder, file, or doc.
-        Parent_id should be None for root folders."""
+        Parent_id should be None for root folders.
+        If an element with the same _id already exists, it is moved
+        (with its content) to the new place."""
         path = self.get_canon_path(path, should_finish_slash=True)
         # name should not contain '/'
         name = name.replace("/", "")
-        self.l[path + name] = {
-            'name': name,
-            'path': path,
-            '_id': _id,
-            'file_type': file_type,
-            'parent_id': parent_id}
+        with self.lock:
+            self._invalidate()
+            if name == "" and path == "/":
+                # Root folder
+                node = FileTreeNode(name, _id, file_type)
+                self.l.clear()
+                self.ids.clear()
+                self._index(node)
+                return node
+            parent = self.l.get(self.get_canon_path(path))
+            if parent is None or parent.file_type != 'folder':
+                raise ImpossibleError("Cannot add {} in {}, the folder is not in the file tree.".format(name, path))
+            node = self.ids.get(_id)
+            if node is not None:
+                # The element is moved/renamed
+                self._unindex(node)
+                self._detach(node)
+                node.name = name
+                node.file_type = file_type
+            else:
+                node = FileTreeNode(name, _id, file_type)
+            # Replace any element already at this place
+            old = parent.children.get(name)
+            if old is not None and old is not node:
+                self._unindex(old)
+            node.parent = parent
+            parent.children[name] = node
+            self._index(node)
+            return node
 
     def get_element(self, path_name):
         """Get the element corresponding to the given path name.
         In case the element does not exist, return None.
-        In case the element exists, return a dict containing
+        In case the element exists, return a FileTreeNode containing
         the name, the path, the _id, file_type (folder, file, or doc), and parent_id."""
         path_name = self.get_canon_path(path_name,
                                         should_finish_slash=False)
-        try:
-            return self.l[path_name]
-        except KeyError:
-            return None
+        with self.lock:
+            return self.l.get(path_name)
+
+    def get_element_by_id(self, _id):
+        with self.lock:
+            return self.ids.get(_id)
 
     def remove_element(self, path_name, no_error=True):
+        """Remove the element and, for a folder, everything inside."""
         path_name = self.get_canon_path(path_name)
-        if no_error:
-            self.l.pop(path_name, True)
-        else:
-            self.l.pop(path_name)
+        with self.lock:
+            node = self.l.get(path_name)
+            if node is None:
+                if no_error:
+                    return
+                raise KeyError(path_name)
+            self._invalidate()
+            self._unindex(node)
+            self._detach(node)
 
     def get_list_files(self):
-        return [filename
-                for filename,elt in self.l.items()
-                if elt['file_type'] != 'folder']
+        """The list is cached until the next modification, do not modify it."""
+        with self.lock:
+            if self._list_files is None:
+                self._list_files = [filename
+                                    for filename,elt in self.l.items()
+                                    if elt.file_type != 'folder']
+            return self._list_files
             
     def get_list_folders(self):
-        return [filename
-                for filename,elt in self.l.items()
-                if elt['file_type'] == 'folder']
+        """The list is cached until the next modification, do not modify it."""
+        with self.lock:
+            if self._list_folders is None:
+                self._list_folders = [filename
+                                      for filename,elt in self.l.items()
+                                      if elt.file_type == 'folder']
+            return self._list_folders
+
+    def add_folder_json(self, json_folder, path="/", parent_id=None):
+        """Add a folder given in the json format of overleaf, with all its
+        content. The tree is walked iteratively, so deep trees are fine."""
+        stack = [(json_folder, path, parent_id)]
+        while stack:
+            json_folder, path, parent_id = stack.pop()
+            name = json_folder['name']
+            current_folder_id = json_folder['_id']
+            self.add_element(name=name,
+                             path = path,
+                             _id = current_folder_id,
+                             file_type = "folder",
+                             parent_id = parent_id)
+            if name == "":
+                newpath = path
+            else:
+                newpath = path + name + "/"
+            # Add the files in "docs"
+            for doc in json_folder.get('docs', []):
+                self.add_element(name = doc['name'],
+                                 path = newpath,
+                                 _id = doc['_id'],
+                                 file_type = 'doc',
+                                 parent_id = current_folder_id)
+            for doc in json_folder.get('fileRefs', []):
+                self.add_element(name = doc['name'],
+                                 path = newpath,
+                                 _id = doc['_id'],
+                                 file_type = 'file',
+                                 parent_id = current_folder_id)
+            # The subfolders will be added later
+            for json_subfolder in reversed(json_folder.get('folders', [])):
+                stack.append((json_subfolder, newpath, current_folder_id))
+
+    def add_json_element(self, parent_id, json_elt, file_type):
+        """Add an element given in the json format of overleaf (with all
+        its content for a folder) in the folder parent_id. Returns False
+        if the parent is unknown. Nothing is done if the element is
+        already known."""
+        with self.lock:
+            parent = self.ids.get(parent_id)
+            if parent is None or parent.file_type != 'folder':
+                return False
+            if json_elt['_id'] in self.ids:
+                return True
+            path = self.get_canon_path(parent.path_name, should_finish_slash=True)
+            if file_type == 'folder':
+                self.add_folder_json(json_elt, path=path, parent_id=parent_id)
+            else:
+                self.add_element(json_elt['name'], path, json_elt['_id'], file_type, parent_id=parent_id)
+            return True
+
+    def remove_element_by_id(self, _id):
+        with self.lock:
+            node = self.ids.get(_id)
+            if node is not None:
+                self.remove_element(node.path_name)
+
+    def move_element_by_id(self, _id, folder_id=None, new_name=None):
+        """Move the element _id in the folder folder_id (if given),
+        and rename it to new_name (if given). Returns False if the
+        element or the folder is unknown."""
+        with self.lock:
+            node = self.ids.get(_id)
+            folder = self.ids.get(folder_id) if folder_id else node and node.parent
+            if node is None or folder is None or folder.file_type != 'folder':
+                return False
+            self.add_element(new_name or node.name,
+                             self.get_canon_path(folder.path_name, should_finish_slash=True),
+                             _id,
+                             node.file_type,
+                             parent_id=folder._id)
+            return True
 
     def __str__(self):
-        s = ""
-        for path_name, d in self.l.items():
-            s += path_name + (" (File "
-                              if d['file_type'] != 'folder'
-                              else " (Dir ") + d['_id'] +  ")\n"
-        return s
+        with self.lock:
+            return "".join(path_name + (" (File "
+                                        if d.file_type != 'folder'
+                                        else " (Dir ") + d._id +  ")\n"
+                           for path_name, d in self.l.items())
+
+##############################
+### HTTP transport
+##############################
+
+class _CountingHTTPAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter that tells the transport each time a new
+    connection is opened (so we can know how many were reused)."""
+    def __init__(self, transport, **kwargs):
+        self.transport = transport
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        transport = self.transport
+        def counting_pool(pool_cls):
+            # urllib3 may reconnect a closed connection object instead of
+            # creating a new one, so we count the calls to connect()
+            class CountingConnection(pool_cls.ConnectionCls):
+                def connect(self):
+                    transport.add_stat('connections_opened')
+                    return super().connect()
+            class CountingPool(pool_cls):
+                ConnectionCls = CountingConnection
+            return CountingPool
+        # Copy the dict, it is shared by default between all the pool managers
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: counting_pool(pool_cls)
+            for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items()}
+
+class DeadlineExceeded(OverleafException):
+    """The command took more time than allowed (see RequestScheduler)."""
+    pass
+
+class RequestScheduler:
+    """All the requests of a transport go through the scheduler, to get
+    as much throughput as the server allows without being throttled:
+    - the requests are paced with a token bucket (max_rate requests per
+      second on average, up to burst at once), if max_rate is given,
+    - at most self.limit requests run at once. The limit grows by one
+      every limit successful requests, and is halved when the server
+      throttles us (AIMD, the throughput follows the limit),
+    - the requests that are throttled (429, 502, 503, 504, or 500 for
+      a GET) or that fail to connect are retried after an exponential
+      backoff with jitter (longer if the server gives a Retry-After).
+      The other requests (POST, DELETE: creation, move, removal...)
+      may have been applied by the server even if the answer is lost,
+      so they are only retried when they clearly were not processed
+      (429, 503, or the connection could not be opened),
+    - nothing is started after the deadline (time.monotonic()), a
+      DeadlineExceeded is raised instead."""
+    RETRY_STATUSES = (429, 502, 503, 504)
+    # The request has not been processed
+    NOT_PROCESSED_STATUSES = (429, 503)
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+    def __init__(self, max_rate=None, burst=10, max_concurrency=16, max_retries=5, backoff=0.5, max_backoff=30, deadline=None):
+        self.max_rate = max_rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = float(self.max_concurrency)
+        self.running = 0
+        self.last_decrease = 0
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.condition = threading.Condition()
+
+    def remaining_time(self):
+        """Seconds before the deadline (None if there is no deadline)."""
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def check_deadline(self, duration=0):
+        """Raise DeadlineExceeded if we cannot wait duration seconds."""
+        remaining = self.remaining_time()
+        if remaining is not None and remaining <= duration:
+            raise DeadlineExceeded("The deadline of the command has been reached.")
+
+    def _take_token(self):
+        """Take a token if possible, else return the time to wait for
+        the next one. Called with self.condition held."""
+        if not self.max_rate:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.max_rate)
+        self.last_refill = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.max_rate
+
+    def acquire(self):
+        """Wait until a request can be sent."""
+        with self.condition:
+            while True:
+                self.check_deadline()
+                wait_time = None
+                if self.running < int(self.limit):
+                    wait_time = self._take_token()
+                    if not wait_time:
+                        self.running += 1
+                        return
+                remaining = self.remaining_time()
+                if remaining is not None:
+                    wait_time = min(wait_time, remaining) if wait_time else remaining
+                self.condition.wait(wait_time)
+
+    def release(self, throttled=False):
+        """The request is finished (throttled if the server refused it)."""
+        with self.condition:
+            self.running -= 1
+            if throttled:
+                # The requests running together are usually throttled
+                # together, the limit is only halved once for them
+                now = time.monotonic()
+                if now - self.last_decrease > self.backoff:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.last_decrease = now
+                    logger.info("The server throttles us, at most %s request(s) at once now.", int(self.limit))
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def should_retry(self, method, r=None, error=None):
+        idempotent = method.upper() in self.IDEMPOTENT_METHODS
+        if error is not None:
+            if not isinstance(error, requests.ConnectionError):
+                return False
+            return idempotent or self._not_sent(error)
+        if not idempotent:
+            return r.status_code in self.NOT_PROCESSED_STATUSES
+        return r.status_code in self.RETRY_STATUSES or r.status_code == 500
+
+    @staticmethod
+    def _not_sent(error):
+        """True if the connection failed before the request was sent."""
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+    def get_retry_delay(self, attempt, r=None):
+        """Exponential backoff with full jitter, at least the Retry-After
+        given by the server."""
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        try:
+            delay = max(delay, float(r.headers.get('Retry-After')))
+        except (AttributeError, TypeError, ValueError):
+            pass
+        return delay
+
+    def wait_before_retry(self, delay):
+        self.check_deadline(delay)
+        time.sleep(delay)
+
+class Transport:
+    """Owns the (pooled, keep-alive) HTTP session used to talk to
+    overleaf. The session cookie and the csrf token are injected
+    here, so the callers only need to give the path to query.
+    Some counters are available in self.stats. The requests are
+    paced, limited and retried by self.scheduler (a RequestScheduler)."""
+    def __init__(self, base_url="https://www.overleaf.com", timeout=(10, 120), pool_size=10, scheduler=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = tuple(timeout) if isinstance(timeout, list) else timeout
+        self.scheduler = scheduler or RequestScheduler()
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0,
+                      'bytes_sent': 0,
+                      'bytes_received': 0,
+                      'connections_opened': 0,
+                      'connections_reused': 0,
+                      'request_time': 0.0,
+                      'retries': 0}
+        self.session = requests.Session()
+        self.session.headers.update({'Accept': 'application/json, text/plain, */*'})
+        self.session.hooks['response'].append(self._on_response)
+        adapter = _CountingHTTPAdapter(self, pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # Called with the session cookie that was rejected, to log in again
+        self.reauthenticate = None
+
+    def add_stat(self, name, value=1):
+        if name in Profiler.COUNTERS:
+            profiler.count(name, value)
+        with self.lock:
+            self.stats[name] += value
+            if name in ['requests', 'connections_opened']:
+                self.stats['connections_reused'] = max(0, self.stats['requests'] - self.stats['connections_opened'])
+
+    def _on_response(self, r, *args, **kwargs):
+        self.add_stat('requests')
+        # Time until the headers are received
+        self.add_stat('request_time', r.elapsed.total_seconds())
+        body = r.request.body
+        if body:
+            self.add_stat('bytes_sent', len(body))
+
+    def get_session_cookie(self):
+        for cookie in self.session.cookies:
+            if cookie.name == 'overleaf_session':
+                return cookie.value
+        return None
+
+    def set_session_cookie(self, overleaf_session):
+        """Keep a single overleaf_session cookie (the server may set
+        it for several domains during the login)."""
+        for cookie in list(self.session.cookies):
+            if cookie.name == 'overleaf_session':
+                self.session.cookies.clear(cookie.domain, cookie.path, cookie.name)
+        self.session.cookies.set('overleaf_session', overleaf_session)
+
+    def set_csrf_token(self, csrf_token):
+        self.session.headers['X-Csrf-Token'] = csrf_token
+
+    def cookie_header(self, extra_cookies=None):
+        """Cookie header to give to connections that do not go through
+        the session (like the websocket)."""
+        cookies = dict(extra_cookies or {})
+        cookies['overleaf_session'] = self.get_session_cookie()
+        return "".join("{}={}; ".format(k, v) for k, v in cookies.items()).strip()
+
+    def get_mean_latency(self):
+        """Mean round-trip time of the requests done so far (None if no
+        request has been done yet)."""
+        with self.lock:
+            if not self.stats['requests']:
+                return None
+            return self.stats['request_time'] / self.stats['requests']
+
+    def get_read_timeout(self):
+        if isinstance(self.timeout, tuple):
+            return self.timeout[-1]
+        return self.timeout
+
+    def url(self, path):
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return self.base_url + path
+
+    def _is_auth_failure(self, r):
+        if r.status_code in (401, 403):
+            return True
+        # Overleaf redirects to the login page
+        return bool(r.history) and urlparse(r.url).path.rstrip("/") == "/login"
+
+    def _with_new_csrf(self, path, kwargs, old_csrf):
+        """The csrf token may also be in the url or in the body, and the
+        files to upload must be read again."""
+        new_csrf = self.session.headers.get('X-Csrf-Token')
+        if old_csrf and new_csrf:
+            path = path.replace(old_csrf, new_csrf)
+            for key in ['json', 'data']:
+                if isinstance(kwargs.get(key), dict) and kwargs[key].get('_csrf') == old_csrf:
+                    kwargs[key] = dict(kwargs[key], _csrf=new_csrf)
+        self._rewind_files(kwargs)
+        return (path, kwargs)
+
+    def _rewind_files(self, kwargs):
+        for f in (kwargs.get('files') or dict()).values():
+            content = f[1] if isinstance(f, tuple) else f
+            if hasattr(content, 'seek'):
+                content.seek(0)
+
+    def request(self, method, path, **kwargs):
+        """Run a request on the pooled session. path can either
+        be a full url or a path relative to the base url. If the
+        session has expired, we log in again (see reauthenticate) and
+        run the request again."""
+        kwargs.setdefault('timeout', self.timeout)
+        cookie = self.get_session_cookie()
+        old_csrf = self.session.headers.get('X-Csrf-Token')
+        r = self._send(method, path, kwargs)
+        if (self.reauthenticate
+            and urlparse(self.url(path)).path.rstrip("/") != "/login"
+            and self._is_auth_failure(r)):
+            logger.info("The session has been rejected (%s), let's log in again.", r.status_code)
+            r.close()
+            self.reauthenticate(cookie)
+            (path, kwargs) = self._with_new_csrf(path, kwargs, old_csrf)
+            r = self._send(method, path, kwargs)
+        return r
+
+    def _send(self, method, path, kwargs):
+        """Send the request when the scheduler allows it, and send it
+        again (after some time) if the server throttles us or if we
+        cannot reach it."""
+        attempt = 0
+        while True:
+            self.scheduler.acquire()
+            (r, error) = (None, None)
+            try:
+                r = self._send_once(method, path, self._with_deadline(kwargs))
+            except requests.ConnectionError as e:
+                error = e
+            except BaseException:
+                self.scheduler.release()
+                raise
+            retry = self.scheduler.should_retry(method, r, error)
+            # A server error is a sign of overload, even if the request
+            # cannot be sent again
+            self.scheduler.release(throttled=retry or error is not None or r.status_code >= 500)
+            if not retry or attempt >= self.scheduler.max_retries:
+                if error is not None:
+                    raise error
+                return r
+            delay = self.scheduler.get_retry_delay(attempt, r)
+            logger.warning("%s %s failed (%s), retry %s/%s in %.1fs.", method, urlparse(self.url(path)).path,
+                           error or r.status_code, attempt + 1, self.scheduler.max_retries, delay)
+            if r is not None:
+                r.close()
+            self.add_stat('retries')
+            self.scheduler.wait_before_retry(delay)
+            self._rewind_files(kwargs)
+            attempt += 1
+
+    def _with_deadline(self, kwargs):
+        """The timeouts of the request cannot go beyond the deadline."""
+        remaining = self.scheduler.remaining_time()
+        if remaining is None:
+            return kwargs
+        timeout = kwargs.get('timeout')
+        if isinstance(timeout, tuple):
+            timeout = tuple(min(t, remaining) for t in timeout)
+        else:
+            timeout = min(timeout, remaining) if timeout else remaining
+        return dict(kwargs, timeout=timeout)
+
+    def _send_once(self, method, path, kwargs):
+        if not tracer.enabled:
+            r = self.session.request(method, self.url(path), **kwargs)
+            if not kwargs.get('stream'):
+                self.add_stat('bytes_received', len(r.content))
+            return r
+        # The csrf token may be in the query, only the path is recorded
+        with tracer.span('http', "{} {}".format(method, urlparse(self.url(path)).path)) as span:
+            r = self.session.request(method, self.url(path), **kwargs)
+            body = r.request.body
+            span['status'] = r.status_code
+            span['bytes_sent'] = len(body) if isinstance(body, (bytes, str)) else 0
+            # For a streamed answer, only the headers are counted
+            if not kwargs.get('stream'):
+                span['bytes_received'] = len(r.content)
+                self.add_stat('bytes_received', len(r.content))
+        return r
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+    def iter_content(self, r, chunk_size=1024):
+        """Iterate over a streamed response, counting the received bytes."""
+        start = time.time()
+        start_perf = time.perf_counter()
+        size = 0
+        for chunk in r.iter_content(chunk_size=chunk_size):
+            if chunk:
+                size += len(chunk)
+                self.add_stat('bytes_received', len(chunk))
+                yield chunk
+        if tracer.enabled:
+            tracer.record('http', "{} {} (body)".format(r.request.method, urlparse(r.url).path),
+                          start, time.perf_counter() - start_perf, bytes_received=size)
+
+    def close(self):
+        self.session.close()
+
+class ProgressLogger:
+    """Progress callback logging the progress and the throughput
+    every period seconds."""
+    def __init__(self, what, period=2):
+        self.what = what
+        self.period = period
+        self.start = time.time()
+        self.last_log = self.start
+
+    def __call__(self, done, total):
+        now = time.time()
+        if now - self.last_log < self.period:
+            return
+        self.last_log = now
+        rate = done / 1e6 / max(now - self.start, 1e-6)
+        if total:
+            logger.info("%s: %.1f/%.1f MB (%.0f%%, %.2f MB/s)", self.what, done / 1e6, total / 1e6, 100 * done / total, rate)
+        else:
+            logger.info("%s: %.1f MB (%.2f MB/s)", self.what, done / 1e6, rate)
+
+class SessionCache:
+    """Logged in sessions (cookie and csrf token) of each account, saved
+    in a file that only the user can read, to avoid logging in at each
+    command. An account is identified by the server and the email."""
+    def __init__(self, path=None):
+        cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser("~"), ".cache")
+        self.path = path or os.path.join(cache_dir, "ogit", "sessions.json")
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_account(url_project, email):
+        url = urlparse(url_project)
+        return "{}://{} {}".format(url.scheme, url.netloc, email)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def _write(self, sessions):
+        folder = os.path.dirname(self.path)
+        os.makedirs(folder, mode=0o700, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=folder, prefix=".sessions_")
+        try:
+            # mkstemp creates the file with the 0600 permissions
+            with os.fdopen(fd, 'w') as f:
+                json.dump(sessions, f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def get(self, account):
+        """The couple (overleaf_session cookie, csrf token), or None."""
+        session = self._read().get(account)
+        if session:
+            return (session['overleaf_session'], session['csrf_token'])
+        return None
+
+    def set(self, account, session):
+        with self.lock:
+            sessions = self._read()
+            if session:
+                sessions[account] = {'overleaf_session': session[0],
+                                     'csrf_token': session[1],
+                                     'date': datetime.now().isoformat()}
+            else:
+                sessions.pop(account, None)
+            try:
+                self._write(sessions)
+            except OSError as e:
+                logger.warning("Cannot save the session in %s: %s", self.path, e)
+
+##############################
+### Socket.io session
+##############################
+
+class SocketIOError(OverleafException):
+    """The socket.io connection is lost, or the server does not answer."""
+    pass
+
+class SocketIORejected(SocketIOError):
+    """The server rejected the connection (connectionRejected), usually
+    because the session is not valid anymore."""
+    pass
+
+class SocketIOSession:
+    """Long-lived socket.io (v0.9, as used by overleaf) connection.
+    A reader thread answers the heartbeats, gives the events sent by
+    the server to the callbacks registered with on(), and reconnects if
+    the connection is lost (the callbacks registered with
+    on_reconnect() are then called, in another thread, since some
+    events may have been missed)."""
+    def __init__(self, transport, extra_cookies=None, max_backoff=30):
+        self.transport = transport
+        self.extra_cookies = extra_cookies
+        self.max_backoff = max_backoff
+        self.ws = None
+        self.heartbeat_interval = 25
+        self.handlers = dict() # event name -> list of callbacks
+        self.reconnect_handlers = []
+        self.lock = threading.Lock()
+        self.pending = dict() # ack id -> [threading.Event, args of the answer, size of the answer]
+        self.next_ack = 1
+        self.accepted = threading.Event()
+        # Set when the server accepted or rejected the connection
+        self.answered = threading.Event()
+        self.rejected = None
+        self.closed = False
+        self.thread = None
+
+    def on(self, name, callback):
+        self.handlers.setdefault(name, []).append(callback)
+
+    def on_reconnect(self, callback):
+        self.reconnect_handlers.append(callback)
+
+    def is_connected(self):
+        return not self.closed and self.accepted.is_set()
+
+    def _open(self):
+        r = self.transport.get('/socket.io/1/', cookies=self.extra_cookies)
+        logger.debug("request to get io: %s", r.text)
+        if r.status_code != 200:
+            raise SocketIOError("Handshake failed: {} {}".format(r.status_code, r.text))
+        # sid:heartbeat timeout:close timeout:transports
+        fields = r.text.split(':')
+        if len(fields) > 1 and fields[1].isdigit():
+            self.heartbeat_interval = max(1, int(fields[1]) // 2)
+        full_wsurl = "{}/socket.io/1/websocket/{}".format(self.transport.base_url.replace("http", "ws", 1),
+                                                          fields[0])
+        logger.debug("full_wsurl: %s", full_wsurl)
+        self.accepted.clear()
+        self.answered.clear()
+        with tracer.span('socketio', 'connect'):
+            ws = create_connection(full_wsurl,
+                                   timeout = self.transport.get_read_timeout(),
+                                   cookie = self.transport.cookie_header(self.extra_cookies))
+        # recv() times out when it is time to send a heartbeat
+        ws.settimeout(self.heartbeat_interval)
+        self.ws = ws
+
+    def connect(self):
+        self._open()
+        self.thread = threading.Thread(target=self._read_loop, daemon=True, name="ogit-socketio")
+        self.thread.start()
+        if not self.answered.wait(self.transport.get_read_timeout()):
+            self.close()
+            raise SocketIOError("The server did not accept the connection.")
+        if self.rejected is not None:
+            self.close()
+            raise SocketIORejected("The server rejected the connection: {}".format(self.rejected))
+
+    def _send(self, msg):
+        logger.spam("socket.io send: %s", msg)
+        try:
+            self.ws.send(msg)
+        except Exception as e:
+            # The reader thread will notice it and reconnect
+            logger.debug("Cannot send on the websocket: %s", e)
+
+    def _fail_pending(self):
+        with self.lock:
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for p in pending:
+            p[0].set()
+
+    def _dispatch(self, msg):
+        logger.spam("socket.io received: %s", msg)
+        kind = msg.split(':', 1)[0]
+        if kind == '2':
+            # Heartbeat
+            self._send("2::")
+        elif kind == '5':
+            data = json.loads(msg.split(':', 3)[3])
+            if tracer.enabled:
+                tracer.record('socketio', "event " + str(data.get('name')), time.time(), 0,
+                              bytes_received=len(msg))
+            if data.get('name') == 'connectionAccepted':
+                self.accepted.set()
+                self.answered.set()
+            elif data.get('name') == 'connectionRejected':
+                self.rejected = data.get('args') or "no reason given"
+                raise SocketIORejected("The server rejected the connection: {}".format(self.rejected))
+            for callback in self.handlers.get(data.get('name'), []):
+                try:
+                    callback(*data.get('args', []))
+                except Exception as e:
+                    logger.warning("Error while handling the event %s: %s", data.get('name'), e)
+        elif kind == '6':
+            (ack_id, _, payload) = msg.split(':', 3)[3].partition('+')
+            with self.lock:
+                pending = self.pending.pop(ack_id, None)
+            if pending:
+                pending[1] = json.loads(payload) if payload else []
+                pending[2] = len(msg)
+                pending[0].set()
+        elif kind == '7':
+            logger.warning("socket.io error: %s", msg)
+        elif kind == '0':
+            raise SocketIOError("Disconnected by the server")
+
+    def _read_loop(self):
+        while not self.closed:
+            try:
+                msg = self.ws.recv()
+                if not msg:
+                    raise SocketIOError("Connection closed")
+                self._dispatch(msg)
+                continue
+            except WebSocketTimeoutException:
+                self._send("2::")
+                continue
+            except SocketIORejected as e:
+                # Reconnecting with the same session would be rejected as
+                # well: the session is closed, see Overleaf.get_socket
+                logger.debug("%s", e)
+                self.close()
+                return
+            except Exception as e:
+                if self.closed:
+                    return
+                logger.warning("The socket.io connection is lost (%s), let's reconnect.", e)
+            self.accepted.clear()
+            self.answered.clear()
+            self._fail_pending()
+            self._reconnect()
+
+    def _reconnect(self):
+        backoff = 1
+        while not self.closed:
+            try:
+                if self.ws:
+                    self.ws.close()
+                self._open()
+                break
+            except Exception as e:
+                logger.warning("Cannot reconnect (%s), retry in %ss.", e, backoff)
+                time.sleep(backoff)
+                backoff = min(2 * backoff, self.max_backoff)
+        for callback in self.reconnect_handlers:
+            # The callbacks usually emit, and the answer is read by this thread
+            threading.Thread(target=callback, daemon=True).start()
+
+    def emit(self, name, args, timeout=None):
+        """Send the event name and wait for the answer of the
+        server. Returns the arguments of the answer."""
+        timeout = timeout or self.transport.get_read_timeout()
+        if not self.answered.wait(timeout) or not self.accepted.is_set():
+            raise SocketIOError("Not connected")
+        pending = [threading.Event(), None, 0]
+        with self.lock:
+            ack_id = str(self.next_ack)
+            self.next_ack += 1
+            self.pending[ack_id] = pending
+        msg = '5:{}+::{}'.format(ack_id, json.dumps({'name': name, 'args': args}))
+        with tracer.span('socketio', name, bytes_sent=len(msg)) as span:
+            self._send(msg)
+            if not pending[0].wait(timeout):
+                with self.lock:
+                    self.pending.pop(ack_id, None)
+                raise SocketIOError("No answer to {} after {}s".format(name, timeout))
+            span['bytes_received'] = pending[2]
+        if pending[1] is None:
+            raise SocketIOError("The connection was lost before the answer to {}".format(name))
+        return pending[1]
+
+    def close(self):
+        self.closed = True
+        self.accepted.clear()
+        # Wake up the threads waiting for the connection
+        self.answered.set()
+        if self.ws:
+            try:
+                # Tell the server that we leave
+                self.ws.send("0::")
+                self.ws.close()
+            except Exception:
+                pass
+        self._fail_pending()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(self.heartbeat_interval)
+
+##############################
+### Streaming zip
+##############################
+
+ZIP_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+ZIP_LOCAL_SIGNATURE = 0x04034b50
+ZIP_DESCRIPTOR_SIGNATURE = 0x08074b50
+# Central directory, end of central directory (zip64 or not)
+ZIP_END_SIGNATURES = (0x02014b50, 0x06054b50, 0x06064b50)
+
+def zip_member_path(filename):
+    """Sanitized path of a member of a zip (same sanitization as
+    extractall), or None if the member must be ignored."""
+    parts = [p for p in filename.replace("\\", "/").split("/")
+             if p and p not in ['.', '..']]
+    if not parts or parts[0] == '.git':
+        return None
+    return "/".join(parts)
+
+class ChunkReader:
+    """Reads the bytes given by an iterator of chunks. The bytes read
+    too early can be put back with unread()."""
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = bytearray()
+
+    def _fill(self, n):
+        while len(self.buffer) < n:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return
+            self.buffer += chunk
+
+    def read(self, n):
+        """Read n bytes (less only at the end of the stream)."""
+        self._fill(n)
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    def read_some(self, n):
+        """Read at most n bytes (at least one, except at the end of the stream)."""
+        self._fill(1)
+        return self.read(min(n, len(self.buffer)))
+
+    def unread(self, data):
+        self.buffer[:0] = data
+
+class ZipStreamMember(io.RawIOBase):
+    """Content of a member of a zip read from a ChunkReader (see
+    iter_zip_members): the data is decompressed and checked (crc)
+    while it is read. size is None if the zip does not give it before
+    the data (data descriptor)."""
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, stream, name, method, crc, compressed_size, size, has_descriptor, zip64, mtime):
+        self.stream = stream
+        self.name = name
+        self.method = method
+        self.expected_crc = crc
+        self.has_descriptor = has_descriptor
+        self.zip64 = zip64
+        self.mtime = mtime
+        self.size = None if has_descriptor else size
+        # Compressed bytes still to read (unknown with a data descriptor)
+        self.remaining = None if has_descriptor else compressed_size
+        self.decompressor = zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None
+        if method == zipfile.ZIP_STORED and has_descriptor:
+            if name.endswith("/"):
+                # Folders are empty
+                self.remaining = 0
+            else:
+                raise BadZip("The size of {} is not known, it cannot be streamed.".format(name))
+        self.pending = b""
+        self.crc = 0
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    def _read_compressed(self):
+        n = self.CHUNK_SIZE if self.remaining is None else min(self.CHUNK_SIZE, self.remaining)
+        data = self.stream.read_some(n) if n else b""
+        if n and not data:
+            raise BadZip("The zip is truncated in {}.".format(self.name))
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        return data
+
+    def _fill(self):
+        if self.decompressor is None:
+            out = self._read_compressed()
+            done = self.remaining == 0
+        else:
+            data = self.decompressor.unconsumed_tail or self._read_compressed()
+            if not data:
+                raise BadZip("The file {} of the zip is truncated.".format(self.name))
+            try:
+                out = self.decompressor.decompress(data, self.CHUNK_SIZE)
+            except zlib.error as e:
+                raise BadZip("The file {} of the zip is corrupted ({}).".format(self.name, e)) from e
+            done = self.decompressor.eof
+            if done and self.decompressor.unused_data:
+                # Read after the end of the member
+                self.stream.unread(self.decompressor.unused_data)
+        self.crc = zlib.crc32(out, self.crc)
+        self.pending = out
+        if done:
+            self._finish()
+
+    def _finish(self):
+        self.finished = True
+        if self.has_descriptor:
+            descriptor = self.stream.read(4)
+            if struct.unpack("<I", descriptor)[0] == ZIP_DESCRIPTOR_SIGNATURE:
+                descriptor = self.stream.read(4)
+            # crc, then the sizes
+            self.expected_crc = struct.unpack("<I", descriptor)[0]
+            self.stream.read(16 if self.zip64 else 8)
+        if self.crc != self.expected_crc:
+            raise BadZip("The file {} of the zip is corrupted.".format(self.name))
+
+    def readinto(self, b):
+        while not self.pending and not self.finished:
+            self._fill()
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def skip(self):
+        """Read (and check) the rest of the member."""
+        while not self.finished:
+            self._fill()
+        self.pending = b""
+
+class ZipStreamFile(io.BufferedReader):
+    """Buffered file-like of a ZipStreamMember."""
+    @property
+    def size(self):
+        return self.raw.size
+
+    @property
+    def mtime(self):
+        return self.raw.mtime
+
+def _dos_time(date, dos_time):
+    try:
+        return time.mktime(((date >> 9) + 1980, (date >> 5) & 0xf, date & 0x1f,
+                            dos_time >> 11, (dos_time >> 5) & 0x3f, (dos_time & 0x1f) * 2, 0, 0, -1))
+    except (OverflowError, ValueError):
+        return time.time()
+
+def iter_zip_members(chunks):
+    """Generator of (path, file-like) for the files of a zip given as an
+    iterator of bytes. Only the local headers are read (no seek), so
+    the memory stays bounded whatever the size of the zip. Each
+    file-like must be read before getting the next member (what is not
+    read is skipped). The folders and the paths ignored by
+    zip_member_path are skipped."""
+    stream = ChunkReader(chunks)
+    while True:
+        header = stream.read(ZIP_LOCAL_HEADER.size)
+        if len(header) >= 4 and struct.unpack("<I", header[:4])[0] in ZIP_END_SIGNATURES:
+            return
+        if len(header) < ZIP_LOCAL_HEADER.size or struct.unpack("<I", header[:4])[0] != ZIP_LOCAL_SIGNATURE:
+            raise BadZip("Invalid zip header ({} bytes).".format(len(header)))
+        (_, _, flags, method, dos_time, date, crc, compressed_size, size, name_len, extra_len) = ZIP_LOCAL_HEADER.unpack(header)
+        name = stream.read(name_len).decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = stream.read(extra_len)
+        if flags & 0x1:
+            raise BadZip("The file {} of the zip is encrypted.".format(name))
+        if method not in [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED]:
+            raise BadZip("Unsupported compression {} for {}.".format(method, name))
+        zip64 = False
+        i = 0
+        while i + 4 <= len(extra):
+            (tag, length) = struct.unpack("<HH", extra[i:i + 4])
+            if tag == 0x0001:
+                zip64 = True
+                fields = extra[i + 4:i + 4 + length]
+                if size == 0xFFFFFFFF and len(fields) >= 8:
+                    (size,) = struct.unpack("<Q", fields[:8])
+                    fields = fields[8:]
+                if compressed_size == 0xFFFFFFFF and len(fields) >= 8:
+                    (compressed_size,) = struct.unpack("<Q", fields[:8])
+            i += 4 + length
+        member = ZipStreamMember(stream, name, method, crc, compressed_size, size,
+                                 has_descriptor=bool(flags & 0x8), zip64=zip64,
+                                 mtime=_dos_time(date, dos_time))
+        path = zip_member_path(name)
+        if name.endswith("/") or not path:
+            if path:
+                logger.debug("Skipping the folder %s of the zip.", name)
+            else:
+                logger.warning("Ignoring the file %s of the zip.", name)
+            member.skip()
+            continue
+        profiler.count('files')
+        yield (path, ZipStreamFile(member, ZipStreamMember.CHUNK_SIZE))
+        member.skip()
+
+def write_tar(members, out, compression=""):
+    """Write the (path, ZipStreamFile) members in out as a tar stream
+    (compressed with compression, like "gz"). The members whose size is
+    not known are first spooled (in memory up to 16 MB)."""
+    with tarfile.open(fileobj=out, mode="w|" + compression) as tar:
+        for (path, f) in members:
+            info = tarfile.TarInfo(path)
+            info.mtime = f.mtime
+            if f.size is None:
+                with tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024) as spool:
+                    shutil.copyfileobj(f, spool)
+                    info.size = spool.tell()
+                    spool.seek(0)
+                    tar.addfile(info, spool)
+            else:
+                info.size = f.size
+                tar.addfile(info, f)
 
 ##############################
 ### Class that deals with the overleaf website
@@ -242,46 +1552,111 @@ class FileTree:
 class Overleaf:
     """This class will be the one interacting with the
     overleaf online's website."""
-    def __init__(self, url_project=None, email=None, password=None):
+    def __init__(self, url_project=None, email=None, password=None, timeout=(10, 120), pool_size=10, live_file_tree=True, session=None, session_cache=None, scheduler=None):
+        """If live_file_tree is True, the file tree is kept up to date with
+        the events sent by overleaf on the socket.io session, so ls does not
+        need to join the project again.
+        session is an optional couple (overleaf_session cookie, csrf token)
+        of an already logged in session (see get_session), to avoid
+        logging in again. Else, the session is read from session_cache
+        (a SessionCache) if possible. In both cases, if the session has
+        expired, we log in again when the server rejects it.
+        scheduler is the RequestScheduler used by all the requests."""
         self.email = email or os.environ.get("OVERLEAF_EMAIL") or input("email? ")
         self.password = password or os.environ.get("OVERLEAF_PASSWORD") or getpass("password? ")
         self.old_overleaf_session = None
         self.overleaf_session = None
         self.csrf_token = None
         self.file_tree = None
+        self.project_json = None
+        self.socket = None
+        self.live_file_tree = live_file_tree
+        # Some events could not be applied to the file tree
+        self.file_tree_outdated = False
+        self.join_lock = threading.Lock()
+        # To ignore the events caused by our own changes, see _own_change
+        self.echo_lock = threading.Lock()
+        self.expected_echoes = dict() # (event name, _id) -> number of events to ignore
+        self.seen_events = dict() # recent (event name, _id) not expected (yet)
         self.url_project = url_project or os.environ.get("URL_PROJECT") or input("What is the url of the project?")
         if self.url_project[-1] != "/":
             self.url_project = self.url_project + "/"
         else:
             self.url_project = self.url_project
         self.project_id = self.url_project.split("/")[-2]
+        url = urlparse(self.url_project)
+        self.transport = Transport(base_url="{}://{}".format(url.scheme, url.netloc),
+                                   timeout=timeout,
+                                   pool_size=pool_size,
+                                   scheduler=scheduler)
+        self.session_cache = session_cache
+        self.login_lock = threading.Lock()
+        self.closed = False
+        self.transport.reauthenticate = self._reauthenticate
+        if not session and session_cache:
+            session = session_cache.get(SessionCache.get_account(self.url_project, self.email))
+            if session:
+                logger.debug("Reuse the session saved in %s", session_cache.path)
+        if session:
+            (self.overleaf_session, self.csrf_token) = session
+            self.transport.set_session_cookie(self.overleaf_session)
+            self.transport.set_csrf_token(self.csrf_token)
+        else:
+            self._login()
+
+    @profiled("login")
+    def _login(self):
         self._connect() # sets old_overleaf_session and csrf_token
+        if self.session_cache:
+            self.session_cache.set(SessionCache.get_account(self.url_project, self.email),
+                                   self.get_session())
+
+    def _reauthenticate(self, rejected_cookie):
+        """Called by the transport (or the socket.io session) when the
+        session is rejected."""
+        with self.login_lock:
+            if self.transport.get_session_cookie() != rejected_cookie:
+                # Another thread already logged in again
+                return
+            if self.session_cache:
+                # Never reuse this session, even if the login fails
+                self.session_cache.set(SessionCache.get_account(self.url_project, self.email), None)
+            self._login()
+
+    def get_session(self):
+        """The couple (overleaf_session cookie, csrf token) that can be
+        given to another Overleaf instance of the same account."""
+        return (self.transport.get_session_cookie(), self.csrf_token)
+
+    def close(self):
+        self.closed = True
+        if self.socket:
+            self.socket.close()
+        self.transport.close()
 
     def _connect(self):
         # Go to the login page
         logger.info('#### Trying to connect...')
         try:
             logger.debug('## 1) Go to login page')
-            r = requests.get('https://www.overleaf.com/login')
+            r = self.transport.get('/login')
             soup = BeautifulSoup(r.text, "html.parser")
             self.csrf_token = soup.find('input', {'name':'_csrf'})['value']
             self.old_overleaf_session = r.cookies["overleaf_session"]
 
-            logger.debug('The old overleaf session is {}'.format(self.old_overleaf_session))
-            logger.debug('The csrf token is {}'.format(self.csrf_token))
+            logger.debug('The old overleaf session is %s', self.old_overleaf_session)
+            logger.debug('The csrf token is %s', self.csrf_token)
             # Send the login informations
             logger.debug('## 2) Send the email/passwd informations')
-            r = requests.post('https://www.overleaf.com/login',
-                      cookies = {'overleaf_session': self.old_overleaf_session},
-                      headers = {'Content-Type': 'application/json;charset=UTF-8',
-                                 'Accept': 'application/json, text/plain, */*'},
+            r = self.transport.post('/login',
+                      headers = {'Content-Type': 'application/json;charset=UTF-8'},
                       json = {'_csrf': self.csrf_token,
                               'email': self.email,
                               'password': self.password})
             out_json = r.json()
             # Sanity checks, handle errors
             if not "redir" in out_json:
-                logger.warning("The json does not contain the good informations: {}".format(out_json))
+                logger.warning("The json does not contain the good informations: %s", out_json)
                 
                 try:
                     if out_json["message"]["type"] == "error":
@@ -294,7 +1669,9 @@ class Overleaf:
                 except KeyError:
                     raise ConnectException(out_json)
             self.overleaf_session = r.cookies["overleaf_session"]
-            logger.debug("The good overleaf session is {}".format(self.overleaf_session))
+            self.transport.set_session_cookie(self.overleaf_session)
+            self.transport.set_csrf_token(self.csrf_token)
+            logger.debug("The good overleaf session is %s", self.overleaf_session)
             if self.overleaf_session[0:2] != "s%":
                 logger.warning("The overleaf session does not start with s%, which is quite unusual...")
         except OverleafException:
@@ -302,101 +1679,376 @@ class Overleaf:
         except Exception as e:
             raise ConnectException(e) from e
         
-    def get_zip(self, outputfile="output_ogit.zip"):
-        """Get the zip file associated with a given project"""
+    def _download_zip(self, url, resume_file, chunk_size, retries, backoff, progress):
+        """Download url in resume_file, resuming what has already been
+        downloaded if possible. Returns (nb_retries, resumed)."""
+        meta_file = resume_file + ".json"
         try:
-            logger.info('#### Getting the zip for project {}'.format(self.url_project))
-            r = requests.get('{}download/zip'.format(self.url_project),
-                             cookies = {'overleaf_session': self.overleaf_session})
-            with open(outputfile, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=1024): 
-                    if chunk:
+            with open(meta_file) as f:
+                validators = json.load(f)
+        except (OSError, ValueError):
+            validators = dict()
+        validator = validators.get('etag') or validators.get('last_modified')
+        if os.path.exists(resume_file) and not (validators.get('url') == url and validator):
+            # We cannot know if the zip changed since this partial download
+            os.remove(resume_file)
+        nb_retries = 0
+        resumed = False
+        while True:
+            offset = os.path.getsize(resume_file) if os.path.exists(resume_file) else 0
+            headers = dict()
+            if offset:
+                headers['Range'] = 'bytes={}-'.format(offset)
+                if validator:
+                    headers['If-Range'] = validator
+            try:
+                r = self.transport.get(url, stream=True, headers=headers)
+                if offset and self._nothing_to_resume(r, offset):
+                    # The partial download is already complete (or longer
+                    # than the zip): it cannot be resumed
+                    logger.info("The partial download cannot be resumed (status %s), let's download the zip again.", r.status_code)
+                    r.close()
+                    for f in [resume_file, meta_file]:
+                        if os.path.exists(f):
+                            os.remove(f)
+                    validator = None
+                    continue
+                r.raise_for_status()
+                length = r.headers.get('Content-Length')
+                if r.status_code == 206 and offset:
+                    logger.info("Resuming the download at %s bytes", offset)
+                    mode = 'ab'
+                    resumed = True
+                else:
+                    mode = 'wb'
+                    offset = 0
+                total = offset + int(length) if length else None
+                validators = {'url': url,
+                              'etag': r.headers.get('ETag'),
+                              'last_modified': r.headers.get('Last-Modified')}
+                validator = validators['etag'] or validators['last_modified']
+                with open(meta_file, 'w') as f:
+                    json.dump(validators, f)
+                done = offset
+                with open(resume_file, mode) as f:
+                    for chunk in self.transport.iter_content(r, chunk_size=chunk_size):
                         f.write(chunk)
+                        done += len(chunk)
+                        progress(done, total)
+                if total is not None and done != total:
+                    raise requests.exceptions.ConnectionError("Incomplete download: {} bytes instead of {}".format(done, total))
+                return (nb_retries, resumed)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.HTTPError) as e:
+                if (isinstance(e, requests.exceptions.HTTPError)
+                    and e.response is not None
+                    and e.response.status_code < 500
+                    and e.response.status_code != 429):
+                    raise GetZipError(e) from e
+                if nb_retries >= retries:
+                    raise GetZipError(e) from e
+                nb_retries += 1
+                wait = backoff * 2 ** (nb_retries - 1)
+                logger.warning("The download failed (%s), retry %s/%s in %ss.", e, nb_retries, retries, wait)
+                time.sleep(wait)
+
+    @staticmethod
+    def _nothing_to_resume(r, offset):
+        """True if the server answered that there is nothing after offset
+        (416, or a Content-Range whose total is offset)."""
+        if r.status_code == 416:
+            return True
+        if r.status_code == 206:
+            total = (r.headers.get('Content-Range') or "").rpartition("/")[2]
+            return total.isdigit() and int(total) <= offset
+        return False
+
+    @profiled("download")
+    def get_zip(self, outputfile="output_ogit.zip", resume_file=None, chunk_size=1024*1024, retries=5, backoff=1, check_crc=True, progress=None):
+        """Get the zip file associated with a given project.
+        The zip is first downloaded in resume_file (outputfile.part by
+        default). If the connection drops, the download is resumed with an
+        HTTP Range request, up to retries times (waiting backoff, 2*backoff,
+        ... seconds). A partial download left by a previous run is resumed
+        only if the server gave an ETag or Last-Modified (sent in If-Range).
+        progress(done, total) is called after each chunk (total is None if
+        unknown). Returns a dict with the size, the time and the number of
+        retries of the download."""
+        url = '{}download/zip'.format(self.url_project)
+        resume_file = resume_file or outputfile + ".part"
+        progress = progress or ProgressLogger("Download")
+        logger.info('#### Getting the zip for project %s', self.url_project)
+        start = time.time()
+        nb_retries = 0
+        while True:
+            try:
+                (n, resumed) = self._download_zip(url, resume_file, chunk_size, retries - nb_retries, backoff, progress)
+                nb_retries += n
+            except OverleafException:
+                raise
+            except Exception as e:
+                raise GetZipError(e) from e
+            err = None
+            if not zipfile.is_zipfile(resume_file):
+                err = "The output file {} is not a zip file.".format(outputfile)
+            elif check_crc:
+                with zipfile.ZipFile(resume_file) as zip_ref:
+                    bad_file = zip_ref.testzip()
+                if bad_file:
+                    err = "The file {} of the zip is corrupted.".format(bad_file)
+            if not err:
+                break
+            os.remove(resume_file)
+            if not resumed or nb_retries >= retries:
+                logger.error(err)
+                raise BadZip(err)
+            # The zip may have changed online between two parts
+            logger.warning("%s Let's download it again from the beginning.", err)
+            nb_retries += 1
+        shutil.move(resume_file, outputfile)
+        if os.path.exists(resume_file + ".json"):
+            os.remove(resume_file + ".json")
+        stats = {'bytes': os.path.getsize(outputfile),
+                 'time': time.time() - start,
+                 'retries': nb_retries}
+        logger.info("Downloaded %.1f MB in %.1fs (%.2f MB/s, %s retries)",
+            stats['bytes'] / 1e6, stats['time'], stats['bytes'] / 1e6 / max(stats['time'], 1e-6), nb_retries)
+        return stats
+
+    def iter_zip(self, chunk_size=1024*1024, progress=None):
+        """Generator of the bytes of the zip of the project, as they are
+        downloaded (nothing is written on disk, and the download cannot
+        be resumed: see get_zip for that)."""
+        url = '{}download/zip'.format(self.url_project)
+        progress = progress or ProgressLogger("Download")
+        logger.info('#### Streaming the zip of project %s', self.url_project)
+        try:
+            r = self.transport.get(url, stream=True)
+        except OverleafException:
+            raise
         except Exception as e:
             raise GetZipError(e) from e
-        if not zipfile.is_zipfile(outputfile):
-            err = "The output file {} is not a zip file.".format(outputfile)
-            logger.error(err)
-            raise BadZip(err)
+        try:
+            if r.status_code != 200:
+                raise GetZipError("Cannot download the zip: status code {}".format(r.status_code))
+            length = r.headers.get('Content-Length')
+            total = int(length) if length else None
+            done = 0
+            for chunk in self.transport.iter_content(r, chunk_size=chunk_size):
+                done += len(chunk)
+                progress(done, total)
+                yield chunk
+            if total is not None and done != total:
+                raise GetZipError("Incomplete download: {} bytes instead of {}".format(done, total))
+        finally:
+            r.close()
+
+    def iter_files(self, chunk_size=1024*1024):
+        """Generator of (path, file-like) for the files of the project,
+        read while the zip is downloaded (see iter_zip_members)."""
+        return iter_zip_members(self.iter_zip(chunk_size=chunk_size))
+
+    def get_socket(self):
+        """The socket.io session, opened at the first call. If the
+        server rejects the connection, we log in again and retry once."""
+        if self.socket is None or self.socket.closed:
+            cookie = self.transport.get_session_cookie()
+            try:
+                self._open_socket()
+            except SocketIORejected as e:
+                logger.info("%s, let's log in again.", e)
+                self._reauthenticate(cookie)
+                self._open_socket()
+        return self.socket
+
+    def _open_socket(self):
+        """Open a new socket.io session. The callbacks registered on the
+        previous one are kept, and its reconnection callbacks are called
+        since the events sent in the meantime have been missed."""
+        previous = self.socket
+        socket = SocketIOSession(self.transport, extra_cookies={'SERVERID': 'sl-lin-prod-web-5'})
+        if previous is None:
+            socket.on('reciveNewDoc', lambda parent_id, doc, *args: self._on_new_element('reciveNewDoc', parent_id, doc, 'doc'))
+            socket.on('reciveNewFile', lambda parent_id, f, *args: self._on_new_element('reciveNewFile', parent_id, f, 'file'))
+            socket.on('reciveNewFolder', lambda parent_id, folder, *args: self._on_new_element('reciveNewFolder', parent_id, folder, 'folder'))
+            socket.on('removeEntity', self._on_removed_element)
+            socket.on('reciveEntityRename', lambda _id, name, *args: self._on_moved_element('reciveEntityRename', _id, new_name=name))
+            socket.on('reciveEntityMove', lambda _id, folder_id, *args: self._on_moved_element('reciveEntityMove', _id, folder_id=folder_id))
+            socket.on_reconnect(self._on_reconnect)
+        else:
+            previous.close()
+            socket.handlers = previous.handlers
+            socket.reconnect_handlers = previous.reconnect_handlers
+        socket.connect()
+        self.socket = socket
+        if previous is not None:
+            for callback in socket.reconnect_handlers:
+                threading.Thread(target=callback, daemon=True).start()
+
+    @staticmethod
+    def _is_auth_error(error):
+        """True if the error sent by the server in the answer to an
+        event means that the session is not valid anymore."""
+        if not error:
+            return False
+        message = error.get('message', '') if isinstance(error, dict) else str(error)
+        return "authorized" in str(message).lower()
+
+    def has_live_file_tree(self):
+        return (self.live_file_tree
+                and self.file_tree is not None
+                and not self.file_tree_outdated
+                and self.socket is not None
+                and self.socket.is_connected())
+
+    def _own_change(self, event_name, _id):
+        """We changed the element _id online (and in the file tree): overleaf
+        will also send us the event, maybe after some other changes of ours
+        have been applied to the file tree, so this event must be ignored."""
+        with self.echo_lock:
+            key = (event_name, _id)
+            if self.seen_events.pop(key, None):
+                # The event was received before the answer to our request
+                return
+            self.expected_echoes[key] = self.expected_echoes.get(key, 0) + 1
+
+    def _is_echo(self, event_name, _id):
+        """True if the event is the echo of one of our own changes."""
+        with self.echo_lock:
+            key = (event_name, _id)
+            if self.expected_echoes.get(key):
+                self.expected_echoes[key] -= 1
+                if not self.expected_echoes[key]:
+                    del self.expected_echoes[key]
+                return True
+            self.seen_events[key] = True
+            # Only the recent events matter
+            while len(self.seen_events) > 1000:
+                del self.seen_events[next(iter(self.seen_events))]
+            return False
+
+    def _on_new_element(self, event_name, parent_id, json_elt, file_type):
+        if self._is_echo(event_name, json_elt['_id']) or not self.file_tree:
+            return
+        if not self.file_tree.add_json_element(parent_id, json_elt, file_type):
+            logger.debug("Unknown parent %s for %s, the file tree will be reloaded.", parent_id, json_elt)
+            self.file_tree_outdated = True
+
+    def _on_removed_element(self, _id, *args):
+        if self._is_echo('removeEntity', _id) or not self.file_tree:
+            return
+        self.file_tree.remove_element_by_id(_id)
+
+    def _on_moved_element(self, event_name, _id, folder_id=None, new_name=None):
+        if self._is_echo(event_name, _id) or not self.file_tree:
+            return
+        if not self.file_tree.move_element_by_id(_id, folder_id=folder_id, new_name=new_name):
+            logger.debug("Unknown element %s or folder %s, the file tree will be reloaded.", _id, folder_id)
+            self.file_tree_outdated = True
+
+    def _on_reconnect(self):
+        """Some events may have been missed."""
+        try:
+            self.reload_file_tree()
+        except OverleafException as e:
+            logger.warning("Cannot reload the file tree after the reconnection: %s", e)
+            self.file_tree_outdated = True
+
+    @profiled("ls")
+    def reload_file_tree(self):
+        """Join the project (on the socket.io session) to get the list of
+        files and folders, and set self.file_tree to the associated file tree."""
+        logger.info("#### Getting list of files and folders of the project %s", self.url_project)
+        with self.join_lock:
+            try:
+                cookie = self.transport.get_session_cookie()
+                out_json = self.get_socket().emit('joinProject', [{'project_id': self.project_id}])
+                if out_json and self._is_auth_error(out_json[0]):
+                    logger.info("joinProject has been refused (%s), let's log in again.", out_json[0])
+                    self._reauthenticate(cookie)
+                    self._open_socket()
+                    out_json = self.socket.emit('joinProject', [{'project_id': self.project_id}])
+                logger.debug("Json: %s", out_json)
+            except Exception as e:
+                raise ErrorDuringGetListFilesFolders(e) from e
+            if out_json and out_json[0]:
+                raise ErrorDuringGetListFilesFolders(out_json[0])
+            try:
+                self.project_json = out_json[1]
+                self.name_project = out_json[1]['name']
+                rootFolderJson = out_json[1]['rootFolder'][0]
+                rootFolderJson['name'] = ''
+                ft = FileTree()
+                ft.add_folder_json(rootFolderJson)
+                self.file_tree = ft
+                self.file_tree_outdated = False
+                logger.spam(ft)
+                return ft
+            except Exception as e:
+                raise BadFormatJsonListFilesFolders(e) from e
 
     def ls(self, force_reload=True):
         """This function gets the list of files and folders on the
         online overleaf website, and sets self.file_tree to the associated
-        file tree.
+        file tree. If the file tree is kept up to date by the socket.io
+        session, it is never reloaded.
         """
         if self.file_tree and not force_reload:
             logger.debug("The file tree already exists, and we don't force to reload, so I'll provide the same file_tree as before")
-            logger.spam("{}".format(self.file_tree))
+            logger.spam("%s", self.file_tree)
             return self.file_tree
-        logger.info("#### Getting list of files and folders of the project {}".format(self.url_project))
-        try:
-            r = requests.get('https://www.overleaf.com/socket.io/1/',
-                             cookies = {'overleaf_session': self.overleaf_session,
-                                        'SERVERID': 'sl-lin-prod-web-5'}
-            )
-            logger.debug("request to get io: {}".format(r.text))
-            socket_url = r.text.split(':')[0]
-            full_wsurl = "wss://www.overleaf.com/socket.io/1/websocket/{}".format(socket_url)
-            logger.debug("full_wsurl: {}".format(full_wsurl))
-            ws = create_connection(full_wsurl,
-                                   cookie = "SERVERID=sl-lin-prod-web-5; overleaf_session={};".format(self.overleaf_session))
-            out_json = None
-            while True:
-                logger.debug("Waiting to receive a message...")
-                resp = ws.recv()
-                logger.debug("I received: {}".format(resp))
-                if resp[0] =='5':
-                    to_send = '5:1+::{"name":"joinProject","args":[{"project_id":"' + self.project_id + '"}]}'
-                    logger.debug("I'll send:{}".format(to_send))
-                    ws.send(to_send)
-                if resp[0] ==  '6':
-                    logger.debug("I will jsonize: {}".format(resp[6:]))
-                    out_json = json.loads(resp[6:])
-                    break
-            logger.debug("Json: {}".format(out_json))
-        except Exception as e:
-            raise ErrorDuringGetListFilesFolders(e) from e
-        try:
-            self.name_project = out_json[1]['name']
-            rootFolderJson = out_json[1]['rootFolder'][0]
-            rootFolderJson['name'] = ''
-            ft = FileTree()
-            def iterate_folder(json_folders, path="/", parent_id=None):
-                name = json_folders['name']
-                current_folder_id = json_folders['_id']
-                ft.add_element(name=name,
-                               path = path,
-                               _id = current_folder_id,
-                               file_type = "folder",
-                               parent_id = parent_id)
-                # Add the subfolders
-                if name == "":
-                    newpath = path
-                else:
-                    newpath = path + name + "/"
-                for json_subfolders in json_folders['folders']:
-                    iterate_folder(json_subfolders,
-                                   path=newpath,
-                                   parent_id=json_folders['_id'])
-                # Add the files in "docs"
-                for doc in json_folders['docs']:
-                    ft.add_element(name = doc['name'],
-                                   path = newpath,
-                                   _id = doc['_id'],
-                                   file_type = 'doc',
-                                   parent_id = current_folder_id)
-                for doc in json_folders['fileRefs']:
-                    ft.add_element(name = doc['name'],
-                                   path = newpath,
-                                   _id = doc['_id'],
-                                   file_type = 'file',
-                                   parent_id = current_folder_id)
-            iterate_folder(rootFolderJson)
-            self.file_tree = ft
-            logger.debug(ft)
-            return ft
-        except Exception as e:
-            raise BadFormatJsonListFilesFolders(e) from e
+        if self.has_live_file_tree():
+            logger.debug("The file tree is kept up to date by the socket.io session, no need to reload it.")
+            return self.file_tree
+        return self.reload_file_tree()
+
+    def join_doc(self, doc_id):
+        """Join the doc on the socket.io session: overleaf will then send
+        its updates (otUpdateApplied events). Returns (text, version)."""
+        out = self.get_socket().emit('joinDoc', [doc_id, {'encodeRanges': True}])
+        if out[0]:
+            raise OverleafException("Cannot join the doc {}: {}".format(doc_id, out[0]))
+        lines = []
+        for line in out[1]:
+            # The lines are sent as utf-8 bytes in a latin-1 string
+            try:
+                lines.append(line.encode('latin-1').decode('utf-8'))
+            except UnicodeError:
+                lines.append(line)
+        return ("\n".join(lines), out[2])
+
+    def leave_doc(self, doc_id):
+        self.get_socket().emit('leaveDoc', [doc_id])
+
+    def get_file_content(self, file_id):
+        """Content (bytes) of a file (not a doc) of the project."""
+        r = self.transport.get("{}file/{}".format(self.url_project, file_id))
+        if r.status_code != 200:
+            raise OverleafException("Cannot download the file {}: {}".format(file_id, r.status_code))
+        return r.content
+
+    def get_project_fingerprint(self):
+        """Cheap way to know if the project changed online: a hash of the
+        version given by joinProject and of the file tree. The file tree
+        is only reloaded if it is not kept up to date by the events of
+        overleaf (see has_live_file_tree). Overleaf does not change the
+        version when a doc is edited (and lastUpdated only once the doc
+        is flushed), so a recent edit of a doc may not be seen: this is
+        why skip_unchanged_fetch is disabled by default. Returns None if
+        the project has no version information."""
+        ft = self.ls(force_reload=not self.has_live_file_tree())
+        markers = {k: self.project_json[k]
+                   for k in ['version', 'lastUpdated']
+                   if k in self.project_json}
+        if not markers:
+            logger.debug("No version in the project, cannot know if it changed.")
+            return None
+        with ft.lock:
+            elements = sorted((path, elt._id) for (path, elt) in ft.l.items())
+        to_hash = json.dumps({'markers': markers, 'elements': elements}, sort_keys=True)
+        return hashlib.sha1(to_hash.encode('utf-8')).hexdigest()
 
     def rm(self, path_name=None, _id_filetype=None, force=False, force_reload=True):
         """Remove a file at the given path. Specify either the path or a couple (_id,file_type).
@@ -410,20 +2062,19 @@ class Overleaf:
                 _id = elt['_id']
                 file_type = elt['file_type']
             except KeyError as e:
-                logger.debug("The file {} does not exist and you try to remove it...".format(path_name or _id))
+                logger.debug("The file %s does not exist and you try to remove it...", path_name or _id)
                 if force:
                     return None
                 else:
                     raise FileDoesNotExistSoNoRemove(e) from e
-        logger.debug("I will delete id {}.".format(_id))
+        logger.debug("I will delete id %s.", _id)
         mid_url = elt['file_type'] + "/"
-        r = requests.delete("{}{}{}".format(self.url_project,
-                                            mid_url,
-                                            _id),
-                            cookies = {'overleaf_session': self.overleaf_session},
-                            headers = {'Accept': 'application/json, text/plain, */*',
-                                       'X-Csrf-Token': self.csrf_token})
-        logger.debug(curlify.to_curl(r.request))
+        r = self.transport.delete("{}{}{}".format(self.url_project,
+                                                  mid_url,
+                                                  _id))
+        logger.debug("%s", AsCurl(r.request))
+        if r.ok:
+            self._own_change('removeEntity', _id)
         self.file_tree.remove_element(path_name)
         logger.debug(r.text)
 
@@ -436,13 +2087,13 @@ class Overleaf:
         path="/"
         for p in subfolders:
             new_path = path + p + "/"
-            logger.debug("Will deal with subpath {}.".format(new_path))
+            logger.debug("Will deal with subpath %s.", new_path)
             elt = ft.get_element(new_path)
             if elt:
                 if elt['file_type'] == 'folder':
-                    logger.debug("The folder {} already exist.".format(new_path))
+                    logger.debug("The folder %s already exist.", new_path)
                 else:
-                    logger.debug("The path {} already exist BUT IS A FILE.".format(new_path))
+                    logger.debug("The path %s already exist BUT IS A FILE.", new_path)
                     if not force:
                         raise PathExistsButIsFile
                     else:
@@ -451,23 +2102,21 @@ class Overleaf:
                                    force=force,
                                    force_reload=force_reload)
             else:
-                logger.debug("The folder {} does not exist. Let's create it!".format(new_path))
+                logger.debug("The folder %s does not exist. Let's create it!", new_path)
                 parent_id=ft.get_element(path)['_id']
-                r = requests.post(self.url_project + 'folder',
-                                  cookies = {'overleaf_session': self.overleaf_session},
-                                  headers = {'Content-Type': 'application/json;charset=UTF-8',
-                                             'Accept': 'application/json, text/plain, */*'},
+                r = self.transport.post(self.url_project + 'folder',
+                                  headers = {'Content-Type': 'application/json;charset=UTF-8'},
                                   json = {'_csrf': self.csrf_token,
                                           'parent_folder_id': parent_id,
                                           'name': p})
-                logger.debug(curlify.to_curl(r.request))
+                logger.debug("%s", AsCurl(r.request))
                 if "file already exists" in r.text:
                     ### If the file already exist, it means that the file has been created meanwhile, so let's try again! (NB: that is quite unlikely to happen when force_reload=False)
                     if nb_retry <= 0:
-                        logger.warning("The file {} already exists online, but wasn't on the file tree after several tries... That's REALLY strange, so if you see this warning, please do a report!")
+                        logger.warning("The file %s already exists online, but wasn't on the file tree after several tries... That's REALLY strange, so if you see this warning, please do a report!", new_path)
                         return
-                    logger.warning("The file {} already exists online, but wasn't on the file tree... That's strange, let's try again! Note that this should NOT loop, else please do a bug report.")
-                    self.ls(force_reload=True)
+                    logger.warning("The file %s already exists online, but wasn't on the file tree... That's strange, let's try again! Note that this should NOT loop, else please do a bug report.", new_path)
+                    self.reload_file_tree()
                     self.mkdir(online_path,
                                force=force,
                                force_reload=force_reload,
@@ -477,6 +2126,7 @@ class Overleaf:
                     out_json = r.json()
                     logger.debug(out_json)
                     new_id = out_json["_id"]
+                    self._own_change('reciveNewFolder', new_id)
                     ft.add_element(p,
                                    path=path,
                                    _id=new_id,
@@ -493,18 +2143,20 @@ class Overleaf:
         ### Sorry the code of this function is ugly, but tries to deal with as many case/errors
         ### as possible... (and I didn't think it would be that complex before actually writing it)
         ### If I've the time I may try to rewrite it in a better way
-        logger.debug("I will try to move file {} to folder {}{}.".format(src, dst_folder, "with name " + new_name if new_name else ""))
+        logger.debug("I will try to move file %s to folder %s%s.", src, dst_folder, "with name " + new_name if new_name else "")
         ft = self.ls(force_reload=force_reload)
         src_elt = ft.get_element(src)
+        # Keep a copy, the node is modified when the file tree is updated
+        src_elt = src_elt.to_dict() if src_elt else None
         if not src_elt:
             # The src file does not exist...
             if nb_retry <= 0 or force_reload == True:
-                logger.error("Cannot move the file {}, it does not exist.".format(src))
+                logger.error("Cannot move the file %s, it does not exist.", src)
                 if force:
                     return
                 raise FileDoesNotExistSoNoMove(src)
             logger.error("The file seems to be non-existant. Let's reload and try again.")
-            self.ls(force_reload = True)
+            self.reload_file_tree()
             self.mv(src,
                     dst_folder,
                     new_name,
@@ -518,7 +2170,7 @@ class Overleaf:
         # Deal with destination folder
         dst_elt = ft.get_element(dst_folder)
         if not dst_elt:
-            logger.warning("The dst folder {} does not exist. ".format(dst_folder))
+            logger.warning("The dst folder %s does not exist. ", dst_folder)
             # The dst folder does not exist...
             if not create_folder:
                 raise DstFolderDoesNotExistSoNoMove(dst_folder)
@@ -531,7 +2183,7 @@ class Overleaf:
                 raise ImpossibleError("Mkdir didn't create the file, please do a but report.")
         if dst_elt['file_type'] != "folder":
             # The dst is a file instead of a folder
-            logger.warning('The dst {} you are trying to move to is a file, not a folder!'.format(dst_folder))
+            logger.warning('The dst %s you are trying to move to is a file, not a folder!', dst_folder)
             if not allow_erase:
                 raise DstFolderIsFile(dst_folder)
             logger.warning('We will erase this file and create another one instead...')
@@ -553,7 +2205,7 @@ class Overleaf:
         ##### Check if we need to remove the output file before moving
         remove_later = False
         if self.file_tree.get_element(final_dst):
-            logger.debug("File {} exists, so an erasure would be needed.".format(final_dst))
+            logger.debug("File %s exists, so an erasure would be needed.", final_dst)
             # We need to remove the file
             if not allow_erase:
                 raise FileErasureNotAllowed("File {} already exists.".format(final_dst))
@@ -576,30 +2228,29 @@ class Overleaf:
             prefix_int = 0
             while (self.file_tree.get_element(dst_folder_canon + prefix + src_elt['name'])
                    or (prefix != "" and self.file_tree.get_element(src_path_slash + prefix + src_elt['name']))):
-                logger.debug("An element already exists with prefix '{}' and name {}, either in folder {} or {}. Let's change the prefix:".format(prefix, src_elt['name'], dst_folder_canon, src_path_slash))
+                logger.debug("An element already exists with prefix '%s' and name %s, either in folder %s or %s. Let's change the prefix:", prefix, src_elt['name'], dst_folder_canon, src_path_slash)
                 logger.debug(self.file_tree)
                 prefix_int += 1
                 prefix = str(prefix_int) + "_"
             ##########################
             #### Pre-rename the file if needed
             if prefix:
-                logger.debug("We will now pre-rename the file {} with the prefix {}.".format(src, prefix))
+                logger.debug("We will now pre-rename the file %s with the prefix %s.", src, prefix)
                 url = '{}{}{}/rename'.format(self.url_project,
                                              mid_url,
                                              src_elt['_id'])
-                r = requests.post(url,
-                                  cookies = {'overleaf_session': self.overleaf_session},
-                                  headers = {'Content-Type': 'application/json;charset=UTF-8',
-                                             'Accept': 'application/json, text/plain, */*'},
+                r = self.transport.post(url,
+                                  headers = {'Content-Type': 'application/json;charset=UTF-8'},
                                   json = {'name': prefix + src_elt['name'],
                                           '_csrf': self.csrf_token})
                 if r.text:
                     # Error, as r.text should output nothing
-                    logger.debug(curlify.to_curl(r.request))
+                    logger.debug("%s", AsCurl(r.request))
                     logger.warning("Very strange, the rename request shouldn't  output anything!")
                     logger.debug(r.text)
                     raise ImpossibleError(r)
-                if force_reload:
+                self._own_change('reciveEntityRename', src_elt['_id'])
+                if force_reload and not self.has_live_file_tree():
                     self.ls(force_reload=True)
                 else:
                     self.file_tree.add_element(name=prefix + src_elt['name'],
@@ -610,23 +2261,22 @@ class Overleaf:
                     self.file_tree.remove_element(src)
                 logger.debug("pre-renaming finished.")
             ##### Move the file to the folder (cannot change the name)
-            logger.debug("I will move the file {} to the folder {}".format(src_path_slash + prefix + src_elt['name'], dst_folder))
+            logger.debug("I will move the file %s to the folder %s", src_path_slash + prefix + src_elt['name'], dst_folder)
             url = '{}{}{}/move'.format(self.url_project,
                                        mid_url,
                                        src_elt['_id'])
-            r = requests.post(url,
-                              cookies = {'overleaf_session': self.overleaf_session},
-                              headers = {'Content-Type': 'application/json;charset=UTF-8',
-                                         'Accept': 'application/json, text/plain, */*'},
+            r = self.transport.post(url,
+                              headers = {'Content-Type': 'application/json;charset=UTF-8'},
                               json = {'folder_id': dst_elt['_id'],
                                       '_csrf': self.csrf_token})
             if r.text:
                 # Error, as r.text should output nothing
-                logger.debug(curlify.to_curl(r.request))
+                logger.debug("%s", AsCurl(r.request))
                 logger.warning("Very strange, the move request shouldn't  output anything!")
                 logger.debug(r.text)
                 raise ImpossibleError(r)
-            if force_reload:
+            self._own_change('reciveEntityMove', src_elt['_id'])
+            if force_reload and not self.has_live_file_tree():
                 self.ls(force_reload=True)
             else:
                 self.file_tree.add_element(name=prefix + src_elt['name'],
@@ -644,19 +2294,18 @@ class Overleaf:
             url = '{}{}{}/rename'.format(self.url_project,
                                          mid_url,
                                          src_elt['_id'])
-            r = requests.post(url,
-                              cookies = {'overleaf_session': self.overleaf_session},
-                              headers = {'Content-Type': 'application/json;charset=UTF-8',
-                                         'Accept': 'application/json, text/plain, */*'},
+            r = self.transport.post(url,
+                              headers = {'Content-Type': 'application/json;charset=UTF-8'},
                               json = {'name': new_name,
                                       '_csrf': self.csrf_token})
             if r.text:
                 # Error, as r.text should output nothing
-                logger.debug(curlify.to_curl(r.request))
+                logger.debug("%s", AsCurl(r.request))
                 logger.warning("Very strange, the rename request shouldn't  output anything!")
                 logger.debug(r.text)
                 raise ImpossibleError(r)
-            if force_reload:
+            self._own_change('reciveEntityRename', src_elt['_id'])
+            if force_reload and not self.has_live_file_tree():
                 self.ls(force_reload=True)
             else:
                 self.file_tree.add_element(name=new_name,
@@ -665,7 +2314,7 @@ class Overleaf:
                                            file_type=src_elt['file_type'],
                                            parent_id=dst_elt['_id'])
                 self.file_tree.remove_element(dst_folder_canon + prefix + src_elt['name'])
-        logger.info("### File {} has been moved successfully to folder {}{}".format(src, dst_folder, "and renamed to " + new_name if new_name else ""))
+        logger.info("### File %s has been moved successfully to folder %s%s", src, dst_folder, "and renamed to " + new_name if new_name else "")
 
     def upload_file(self, online_path_name, local_path_name=None, string_content=None, force=False, force_reload=True):
         """Upload of file located on local_path_name on the online path online_path_name. If force==True, create the folder brutally by erasing any exising file/folder.
@@ -675,8 +2324,8 @@ class Overleaf:
         if online_path_name[0] != "/":
             online_path_name = "/" + online_path_name
         online_path, online_filename = ntpath.split(online_path_name)
-        logger.debug("online_path: {}".format(online_path))
-        logger.debug("online_filename: {}".format(online_filename))
+        logger.debug("online_path: %s", online_path)
+        logger.debug("online_filename: %s", online_filename)
         if not online_filename:
             raise ErrorUploadFile("The online path {} does not have a valid filename.".format(online_path_name))
         path_id = ft.get_element(online_path)
@@ -688,13 +2337,16 @@ class Overleaf:
             path_id = ft.get_element(online_path)
             if not path_id or path_id['file_type'] != 'folder':
                 raise ImpossibleError("Mkdir didn't created a folder at {}, please report the error!".format(online_path_name))
-        logger.debug("path_id: {}".format(path_id))
+        logger.debug("path_id: %s", path_id)
         # Upload the file
-        content = open(local_path_name, 'rb') if local_path_name else string_content
-        r = requests.post("{}upload?folder_id={}&_csrf={}".format(self.url_project, path_id['_id'], self.csrf_token),
-                          cookies = {'overleaf_session': self.overleaf_session},
-                  files = {'qqfile': (online_filename, content)})
-        logger.debug(curlify.to_curl(r.request))
+        if local_path_name:
+            with open(local_path_name, 'rb') as content:
+                r = self.transport.post("{}upload?folder_id={}&_csrf={}".format(self.url_project, path_id['_id'], self.csrf_token),
+                                        files = {'qqfile': (online_filename, content)})
+        else:
+            r = self.transport.post("{}upload?folder_id={}&_csrf={}".format(self.url_project, path_id['_id'], self.csrf_token),
+                                    files = {'qqfile': (online_filename, string_content)})
+        logger.debug("%s", AsCurl(r.request))
         logger.debug(r.text)
         try:
             out_json = r.json()
@@ -703,7 +2355,9 @@ class Overleaf:
                 raise ErrorUploadFile(r.text)
             new_id = out_json['entity_id']
             file_type = out_json['entity_type']
-            if force_reload:
+            if not self.file_tree.get_element_by_id(new_id):
+                self._own_change('reciveNewDoc' if file_type == 'doc' else 'reciveNewFile', new_id)
+            if force_reload and not self.has_live_file_tree():
                 self.ls()
             else:
                 self.file_tree.add_element(name=online_filename,
@@ -711,7 +2365,7 @@ class Overleaf:
                                            _id=new_id,
                                            file_type=file_type,
                                            parent_id=path_id['_id'])
-            logger.info("### Successful upload of file {} at online path {}.".format(local_path_name, online_path_name))
+            logger.info("### Successful upload of file %s at online path %s.", local_path_name, online_path_name)
         except KeyError as e:
             logger.debug("An unknown error occured during uploading. Please fill a bug report.")
             raise ErrorUploadFile(r.text) from e
@@ -742,10 +2396,465 @@ def demo_overleaf():
     # o.upload_file("/ogitupload/fichier.txt", string_content="I'm a content completely written in python!", force_reload=False)
 # demo_overleaf()
 
+##############################
+### Run remote operations concurrently
+##############################
+
+class RemoteOperation:
+    """One operation to run on the online project: kind is either
+    mkdir, upload, mv or rm, path is the online path. deps is the list
+    of op_id that must be finished before running this operation."""
+    def __init__(self, kind, path, local_path=None, dst_folder=None, new_name=None, deps=None):
+        self.kind = kind
+        self.path = path
+        self.local_path = local_path
+        self.dst_folder = dst_folder
+        self.new_name = new_name
+        self.deps = list(deps or [])
+        self.op_id = "{}:{}".format(kind, path)
+        # Number of bytes to upload, only known for uploads
+        self.size = None
+        if kind == 'upload' and local_path and os.path.isfile(local_path):
+            self.size = os.path.getsize(local_path)
+
+    def run(self, overleaf):
+        """The file tree is supposed to be up to date, so we never
+        reload it (it would not be safe with several threads anyway)."""
+        if self.kind == 'mkdir':
+            overleaf.mkdir(self.path, force=True, force_reload=False)
+        elif self.kind == 'upload':
+            overleaf.upload_file(self.path,
+                                 local_path_name=self.local_path,
+                                 force=True,
+                                 force_reload=False)
+        elif self.kind == 'mv':
+            overleaf.mv(self.path,
+                        self.dst_folder,
+                        new_name=self.new_name,
+                        create_folder=True,
+                        allow_erase=True,
+                        force_reload=False)
+        elif self.kind == 'rm':
+            overleaf.rm(self.path, force=True, force_reload=False)
+        else:
+            raise ImpossibleError("Unknown operation {}".format(self.kind))
+
+    def is_done(self, ft):
+        """True if the file tree ft shows that the operation has already
+        been done (we cannot know it for uploads)."""
+        with ft.lock:
+            if self.kind == 'mkdir':
+                return bool(ft.get_element(self.path))
+            if self.kind == 'rm':
+                return not ft.get_element(self.path)
+            if self.kind == 'mv':
+                dst = os.path.join(self.dst_folder, self.new_name or os.path.basename(self.path))
+                return not ft.get_element(self.path) and bool(ft.get_element(dst))
+        return False
+
+    def describe(self):
+        if self.kind == 'mv':
+            return "mv {} -> {}".format(self.path,
+                                        os.path.join(self.dst_folder, self.new_name or os.path.basename(self.path)))
+        if self.kind == 'upload' and self.size is not None:
+            return "upload {} ({} bytes)".format(self.path, self.size)
+        return "{} {}".format(self.kind, self.path)
+
+    def to_dict(self):
+        d = {'kind': self.kind, 'path': self.path, 'deps': self.deps}
+        for key in ['local_path', 'dst_folder', 'new_name', 'size']:
+            if getattr(self, key, None) is not None:
+                d[key] = getattr(self, key)
+        return d
+
+    @staticmethod
+    def from_dict(d):
+        op = RemoteOperation(d['kind'], d['path'],
+                             local_path=d.get('local_path'),
+                             dst_folder=d.get('dst_folder'),
+                             new_name=d.get('new_name'),
+                             deps=d.get('deps'))
+        if 'size' in d:
+            op.size = d['size']
+        return op
+
+    def __str__(self):
+        if self.kind == 'mv':
+            return "mv {} {}{}".format(self.path, self.dst_folder, self.new_name or "")
+        return "{} {}".format(self.kind, self.path)
+
+def build_push_operations(ft, files_to_send, paths_to_remove, moves=()):
+    """Build the list of operations needed to send files_to_send (local
+    paths, which are also the online paths), to remove paths_to_remove
+    (files or folders) and to do the moves (list of (src, dst_folder, new_name)).
+    The folders are created before the uploads, the moves are done before
+    uploading at their source or destination, and the removals wait for
+    the moves of the elements they contain."""
+    operations = []
+    rm_ops = dict()
+    for path in paths_to_remove:
+        op = RemoteOperation('rm', "/" + path.strip("/"))
+        rm_ops[op.path] = op
+    move_ops = []
+    moved_to = dict() # online path -> mv op creating it
+    moved_from = dict() # online path -> mv op removing it
+    for (src, dst_folder, new_name) in moves:
+        op = RemoteOperation('mv', "/" + src.strip("/"),
+                             dst_folder="/" + dst_folder.strip("/"),
+                             new_name=new_name)
+        move_ops.append(op)
+        moved_to[os.path.join(op.dst_folder, new_name or os.path.basename(op.path))] = op
+        moved_from[op.path] = op
+    mkdir_ops = dict()
+    def get_mkdir_deps(folder):
+        """Return the ops to wait for before using the online folder
+        (and create the mkdir ops if needed)."""
+        folder = "/" + folder.strip("/")
+        if folder == "/":
+            return []
+        if folder in mkdir_ops:
+            return [mkdir_ops[folder].op_id]
+        if folder in moved_to:
+            return [moved_to[folder].op_id]
+        elt = ft.get_element(folder)
+        if elt and elt['file_type'] == 'folder' and not folder in rm_ops and not folder in moved_from:
+            return []
+        deps = get_mkdir_deps(os.path.dirname(folder))
+        if folder in rm_ops:
+            deps.append(rm_ops[folder].op_id)
+        if folder in moved_from:
+            deps.append(moved_from[folder].op_id)
+        op = RemoteOperation('mkdir', folder, deps=deps)
+        mkdir_ops[folder] = op
+        operations.append(op)
+        return [op.op_id]
+    for op in move_ops:
+        op.deps = get_mkdir_deps(op.dst_folder)
+    for filename in files_to_send:
+        op = RemoteOperation('upload', "/" + filename, local_path=filename)
+        op.deps = get_mkdir_deps(os.path.dirname(filename))
+        if op.path in rm_ops:
+            # A folder is replaced by a file
+            op.deps.append(rm_ops[op.path].op_id)
+        for moves_dict in [moved_to, moved_from]:
+            if op.path in moves_dict:
+                op.deps.append(moves_dict[op.path].op_id)
+        operations.append(op)
+    operations += move_ops
+    # Do not remove a folder before moving its content elsewhere
+    for op in move_ops:
+        folder = op.path
+        while folder != "/":
+            if folder in rm_ops:
+                rm_ops[folder].deps.append(op.op_id)
+            folder = os.path.dirname(folder)
+    operations += rm_ops.values()
+    return operations
+
+class ExecutionReport:
+    """Latency of each operation, and total wall time of the execution."""
+    def __init__(self):
+        self.latencies = []
+        self.wall_time = 0
+
+    def add(self, op, latency):
+        self.latencies.append((op, latency))
+
+    def summary(self):
+        lines = ["{} operation(s) in {:.2f}s".format(len(self.latencies), self.wall_time)]
+        for kind in ['mkdir', 'upload', 'mv', 'rm']:
+            latencies = [l for (op, l) in self.latencies if op.kind == kind]
+            if latencies:
+                lines.append("  {}: {} op(s), mean latency {:.3f}s, max latency {:.3f}s".format(
+                    kind, len(latencies), sum(latencies) / len(latencies), max(latencies)))
+        total = sum(l for (op, l) in self.latencies)
+        if self.wall_time > 0:
+            lines.append("  sum of latencies {:.2f}s ({:.1f}x speedup)".format(total, total / self.wall_time))
+        return "\n".join(lines)
+
+class RemoteExecutor:
+    """Run some RemoteOperation using a pool of at most concurrency
+    threads, making sure that the dependencies of an operation are
+    finished before running it."""
+    def __init__(self, overleaf, concurrency=4, journal=None):
+        self.overleaf = overleaf
+        self.concurrency = max(1, concurrency)
+        # PushJournal in which the finished operations are written
+        self.journal = journal
+
+    def _run_op(self, op, phase=None):
+        start = time.time()
+        logger.info("Will run %s", op)
+        with profiler.phase(op.kind, parent=phase):
+            op.run(self.overleaf)
+            if op.kind == 'upload':
+                profiler.count('files')
+        if self.journal:
+            self.journal.done(op)
+        return time.time() - start
+
+    def run(self, operations):
+        """Run all the operations, and return an ExecutionReport. If an
+        operation fails, we wait for the running ones and raise the error."""
+        report = ExecutionReport()
+        start = time.time()
+        known = set(op.op_id for op in operations)
+        waiting_for = {op.op_id: set(d for d in op.deps if d in known)
+                       for op in operations}
+        dependents = dict()
+        for op in operations:
+            for d in waiting_for[op.op_id]:
+                dependents.setdefault(d, []).append(op)
+        error = None
+        running = dict()
+        # The operations are profiled in the phase of the caller
+        phase = profiler.current()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            def submit(op):
+                running[pool.submit(self._run_op, op, phase)] = op
+            for op in operations:
+                if not waiting_for[op.op_id]:
+                    submit(op)
+            while running:
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    op = running.pop(future)
+                    if future.cancelled():
+                        continue
+                    try:
+                        report.add(op, future.result())
+                    except Exception as e:
+                        logger.error("The operation %s failed: %s", op, e)
+                        if error is None:
+                            error = e
+                            for f in running:
+                                f.cancel()
+                        continue
+                    if error is not None:
+                        continue
+                    for next_op in dependents.get(op.op_id, []):
+                        waiting_for[next_op.op_id].discard(op.op_id)
+                        if not waiting_for[next_op.op_id]:
+                            submit(next_op)
+        report.wall_time = time.time() - start
+        if error is not None:
+            raise error
+        if len(report.latencies) != len(operations):
+            raise ImpossibleError("Some operations have cyclic dependencies, please do a bug report.")
+        return report
+
+class PlanOutdated(OverleafException):
+    """The local repository or the online project changed since the
+    plan was computed."""
+    pass
+
+class PushPlan:
+    """The operations of a push, computed without running them. The
+    plan can be saved in json, reviewed, and run later exactly as
+    planned: it remembers the local commit and the online file tree it
+    was computed from, and refuses to run if one of them changed."""
+    VERSION = 1
+
+    def __init__(self, operations, head=None, online_tree=None, nb_saved_removals=0):
+        self.operations = operations
+        self.head = head
+        self.online_tree = online_tree
+        self.nb_saved_removals = nb_saved_removals
+
+    @staticmethod
+    def get_online_tree_hash(overleaf):
+        """Hash of the online file tree (paths and ids), as known by overleaf.file_tree."""
+        ft = overleaf.ls(force_reload=False)
+        with ft.lock:
+            to_hash = json.dumps(sorted((path, node._id) for (path, node) in ft.l.items()))
+        return hashlib.sha1(to_hash.encode('utf-8')).hexdigest()
+
+    def get_bytes_to_upload(self):
+        return sum(op.size or 0 for op in self.operations if op.kind == 'upload')
+
+    def estimate_wall_time(self, latency, concurrency=4, upload_bandwidth=None):
+        """Simulate the execution (like RemoteExecutor) when each operation
+        takes latency seconds, plus the time to send the file at
+        upload_bandwidth (bytes/s) for uploads."""
+        def duration(op):
+            if op.kind == 'upload' and upload_bandwidth:
+                return latency + (op.size or 0) / upload_bandwidth
+            return latency
+        known = set(op.op_id for op in self.operations)
+        waiting_for = {op.op_id: set(d for d in op.deps if d in known)
+                       for op in self.operations}
+        dependents = dict()
+        for op in self.operations:
+            for d in waiting_for[op.op_id]:
+                dependents.setdefault(d, []).append(op)
+        ready = [op for op in self.operations if not waiting_for[op.op_id]]
+        running = [] # heap of (end time, index, op)
+        now = 0
+        index = 0
+        while ready or running:
+            while ready and len(running) < max(1, concurrency):
+                op = ready.pop(0)
+                heapq.heappush(running, (now + duration(op), index, op))
+                index += 1
+            (now, _, op) = heapq.heappop(running)
+            for next_op in dependents.get(op.op_id, []):
+                waiting_for[next_op.op_id].discard(op.op_id)
+                if not waiting_for[next_op.op_id]:
+                    ready.append(next_op)
+        return now
+
+    def summary(self, latency=None, concurrency=4, upload_bandwidth=None):
+        lines = ["{} operation(s), {:.2f} MB to upload".format(len(self.operations),
+                                                              self.get_bytes_to_upload() / 1e6)]
+        for kind in ['mkdir', 'upload', 'mv', 'rm']:
+            nb = len([op for op in self.operations if op.kind == kind])
+            if nb:
+                lines.append("  {}: {} op(s)".format(kind, nb))
+        if self.nb_saved_removals:
+            lines.append("  {} removal(s) saved by removing whole folders".format(self.nb_saved_removals))
+        for op in self.operations:
+            lines.append("    " + op.describe())
+        if latency is not None:
+            lines.append("Estimated time: {:.1f}s (latency {:.0f}ms, {} parallel operation(s){})".format(
+                self.estimate_wall_time(latency, concurrency, upload_bandwidth),
+                1000 * latency,
+                concurrency,
+                ", upload at {:.1f} MB/s".format(upload_bandwidth / 1e6) if upload_bandwidth else ""))
+        return "\n".join(lines)
+
+    def to_dict(self):
+        return {'version': self.VERSION,
+                'head': self.head,
+                'online_tree': self.online_tree,
+                'nb_saved_removals': self.nb_saved_removals,
+                'operations': [op.to_dict() for op in self.operations]}
+
+    @staticmethod
+    def from_dict(d):
+        if d.get('version') != PushPlan.VERSION:
+            raise BadJsonFormat("Unknown version of push plan: {}".format(d.get('version')))
+        return PushPlan([RemoteOperation.from_dict(op) for op in d['operations']],
+                        head=d.get('head'),
+                        online_tree=d.get('online_tree'),
+                        nb_saved_removals=d.get('nb_saved_removals', 0))
+
+    def save(self, outfile):
+        with open(outfile, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    @staticmethod
+    def load(infile):
+        with open(infile, encoding='utf-8') as f:
+            return PushPlan.from_dict(json.load(f))
+
+    def check(self, repo, overleaf):
+        """Raise PlanOutdated if the plan cannot be run exactly as planned."""
+        if self.head and repo.head.commit.hexsha != self.head:
+            raise PlanOutdated("The plan was computed for the commit {}, but HEAD is now {}.".format(self.head, repo.head.commit.hexsha))
+        if repo.is_dirty():
+            raise PlanOutdated("The files to upload are read from the working tree, please commit or stash your modifications.")
+        if self.online_tree and self.get_online_tree_hash(overleaf) != self.online_tree:
+            raise PlanOutdated("The online project changed since the plan was computed.")
+
+class NothingToResume(OverleafException):
+    """opush --resume, but no push was interrupted."""
+    pass
+
+class PushJournal:
+    """Journal of the push in progress, kept in the .git folder so that
+    an interrupted push (network error, Ctrl-C, crash...) can be
+    resumed with opush --resume. The first line is the plan (see
+    PushPlan.to_dict), then a line is appended (and synced on the disk)
+    each time an operation is done. The journal is removed once the
+    push and the merge back are finished."""
+    FILENAME = "ogit_push_journal"
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.f = None
+
+    @staticmethod
+    def for_repo(repo):
+        return PushJournal(os.path.join(repo.git_dir, PushJournal.FILENAME))
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def create(self, plan):
+        """Start the journal of plan (replacing the previous one)."""
+        self.close()
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(plan.to_dict()) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.f = open(self.path, 'a', encoding='utf-8')
+
+    def load(self):
+        """Returns (plan, set of the op_id done), and reopens the journal
+        to add the next operations."""
+        if not self.exists():
+            raise NothingToResume("No interrupted push to resume.")
+        with open(self.path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        plan = PushPlan.from_dict(json.loads(lines[0]))
+        done = set()
+        for line in lines[1:]:
+            try:
+                done.add(json.loads(line)['done'])
+            except (ValueError, KeyError):
+                # Last line not fully written before the crash
+                logger.debug("Ignoring the line %s of the journal", line)
+        self.close()
+        self.f = open(self.path, 'a', encoding='utf-8')
+        return (plan, done)
+
+    def get_remaining_plan(self, repo, overleaf):
+        """The plan of the interrupted push, without the operations
+        already done. Raises PlanOutdated if HEAD is not the commit
+        that was being pushed."""
+        (plan, done) = self.load()
+        if plan.head and repo.head.commit.hexsha != plan.head:
+            raise PlanOutdated("The interrupted push was for the commit {}, but HEAD is now {}: run opush to push again.".format(plan.head, repo.head.commit.hexsha))
+        if repo.is_dirty():
+            raise PlanOutdated("The files to upload are read from the working tree, please commit or stash your modifications.")
+        # The operations that were running when the push was interrupted
+        # may have been done
+        ft = overleaf.ls(force_reload=True)
+        remaining = [op for op in plan.operations
+                     if op.op_id not in done and not op.is_done(ft)]
+        logger.info("Resuming the push of %s: %s operation(s) already done, %s remaining.",
+                    plan.head, len(plan.operations) - len(remaining), len(remaining))
+        return PushPlan(remaining, head=plan.head, online_tree=plan.online_tree)
+
+    def done(self, op):
+        with self.lock:
+            if self.f:
+                self.f.write(json.dumps({'done': op.op_id}) + "\n")
+                self.f.flush()
+                os.fsync(self.f.fileno())
+
+    def close(self):
+        with self.lock:
+            if self.f:
+                self.f.close()
+                self.f = None
+
+    def remove(self):
+        self.close()
+        if self.exists():
+            os.remove(self.path)
+
 ##############################
 ### Configuration project
 ##############################
 
+# (url_project, email) -> Overleaf, see ConfProject.get_overleaf
+_overleaf_instances = dict()
+_overleaf_instances_lock = threading.Lock()
+
 class ConfProject:
     def __init__(self,
                  conf_dict=None,
@@ -753,15 +2862,34 @@ class ConfProject:
                  json_file=None,
                  try_to_find_conf=True,
                  url_project=None, email=None, password=None,
-                 args=None):
+                 args=None, interactive=True):
         """You can either provide nothing and wait for the prompt (or use the environment variables), or give a dictionnary, or give a json string, or give a json filename, or give manually the 3 mandatory parameters. Or directly the args from the command line.
+        If not interactive, nothing is asked to the user: a missing
+        mandatory parameter raises ProjectConfException, and the git
+        commands cannot read the standard input (see is_interactive).
         The dict/json/... have:
         mandatory:
         - url_project
         - email
         - password
         facultative:
-        - TODO: fill
+        - have_svg, svg_path: backups of the online project
+        - svg_keep_last, svg_keep_daily_days, svg_max_size_mb: retention of the backups
+        - overleaf_branch_name, ls_force_reload
+        - download_chunk_size, download_retries, download_backoff, download_check_crc: see Overleaf.get_zip
+        - skip_unchanged_fetch: do not download the project if its version and its file tree did not change (false by default, the recent edits of the docs may be missed)
+        - incremental_push: only send the files that changed since the last sync
+        - push_concurrency: number of remote operations run in parallel during a push
+        - follow_commit_interval: seconds between two commits of ofollow
+        - watch_poll_interval, watch_debounce, watch_max_delay, watch_reconcile_interval: seconds, see owatch
+        - session_cache: keep the logged in session in ~/.cache/ogit/sessions.json (true, default), in the given file, or not (false)
+        - live_file_tree: keep the file tree up to date with the events of overleaf instead of reloading it
+        - upload_bandwidth_mb: upload speed (MB/s) used to estimate the time of a push (opush --plan)
+        - http_timeout: seconds, or [connect timeout, read timeout]
+        - http_pool_size: number of connections kept alive
+        - http_max_rate, http_burst: at most http_max_rate requests per second on average (no limit by default)
+        - http_max_concurrency, http_max_retries, http_backoff: see RequestScheduler
+        - command_deadline: seconds after which a command stops sending requests (see also --deadline)
         """
         self.conf_dict = conf_dict
         # If provide json string
@@ -783,13 +2911,37 @@ class ConfProject:
                     self.conf_dict = json.load(f)
         if not self.conf_dict:
             self.conf_dict = dict()
+        self.interactive = interactive
         # Load project url
-        self.url_project = url_project or self.conf_dict.get('url_project') or os.environ.get("URL_PROJECT") or input("What is the url of the project? ")
-        self.email = email or self.conf_dict.get('email') or os.environ.get("OVERLEAF_EMAIL") or input("email? ")
-        self.password = password or self.conf_dict.get('password') or os.environ.get("OVERLEAF_PASSWORD") or getpass("password? ")
+        self.url_project = url_project or self.conf_dict.get('url_project') or os.environ.get("URL_PROJECT") or self._ask('url_project', "What is the url of the project? ")
+        self.email = email or self.conf_dict.get('email') or os.environ.get("OVERLEAF_EMAIL") or self._ask('email', "email? ")
+        self.password = password or self.conf_dict.get('password') or os.environ.get("OVERLEAF_PASSWORD") or self._ask('password', "password? ", secret=True)
         self.conf_dict['url_project'] = self.url_project
         self.conf_dict['email'] = self.email
         self.conf_dict['password'] = self.password
+        # Logged in session to reuse (see Overleaf.get_session)
+        self.session = None
+        # The deadline starts with the command
+        deadline = getattr(args, 'deadline', None) or self.conf_dict.get('command_deadline')
+        self.deadline = time.monotonic() + deadline if deadline else None
+
+    def _ask(self, key, question, secret=False):
+        """Ask the value of key to the user. The question is written on
+        stderr, since stdout may be the output of the command (oexport)."""
+        if not self.interactive:
+            raise ProjectConfException("No {} in .ogit_confproject (nor in the environment variables).".format(key))
+        if secret:
+            # getpass writes on the terminal (or stderr)
+            return getpass(question)
+        sys.stderr.write(question)
+        sys.stderr.flush()
+        answer = sys.stdin.readline()
+        if not answer:
+            raise ProjectConfException("No {} given.".format(key))
+        return answer.rstrip("\n")
+
+    def is_interactive(self):
+        return self.interactive
 
     def get_url_project(self):
         return self.url_project
@@ -806,18 +2958,99 @@ class ConfProject:
     def get_svg_path(self):
         return self.conf_dict.get('svg_path', '.ogit_svg')
 
+    def get_backup_store(self):
+        """The svg path is relative to the root of the repository."""
+        return BackupStore(os.path.join(get_repo().working_tree_dir, self.get_svg_path()),
+                           keep_last=self.conf_dict.get('svg_keep_last', 20),
+                           keep_daily_days=self.conf_dict.get('svg_keep_daily_days', 30),
+                           max_size_mb=self.conf_dict.get('svg_max_size_mb', None))
+
     def get_overleaf_branch_name(self):
         return self.conf_dict.get('overleaf_branch_name', 'overleaf')
 
     def get_force_reload(self):
         return self.conf_dict.get('ls_force_reload', False)
 
+    def get_skip_unchanged_fetch(self):
+        return self.conf_dict.get('skip_unchanged_fetch', False)
+
+    def get_download_options(self):
+        """Options given to Overleaf.get_zip"""
+        return {'chunk_size': self.conf_dict.get('download_chunk_size', 1024 * 1024),
+                'retries': self.conf_dict.get('download_retries', 5),
+                'backoff': self.conf_dict.get('download_backoff', 1),
+                'check_crc': self.conf_dict.get('download_check_crc', True)}
+
+    def get_incremental_push(self):
+        return self.conf_dict.get('incremental_push', True)
+
+    def get_http_timeout(self):
+        """Either a number of seconds, or a list [connect timeout, read timeout]."""
+        return self.conf_dict.get('http_timeout', [10, 120])
+
+    def get_http_pool_size(self):
+        # Make sure each thread of the push can keep its connection
+        return max(self.conf_dict.get('http_pool_size', 10),
+                   self.get_push_concurrency())
+
+    def get_push_concurrency(self):
+        return self.conf_dict.get('push_concurrency', 4)
+
+    def get_request_scheduler(self):
+        return RequestScheduler(max_rate=self.conf_dict.get('http_max_rate', None),
+                                burst=self.conf_dict.get('http_burst', 10),
+                                max_concurrency=self.conf_dict.get('http_max_concurrency', 16),
+                                max_retries=self.conf_dict.get('http_max_retries', 5),
+                                backoff=self.conf_dict.get('http_backoff', 0.5),
+                                deadline=self.deadline)
+
+    def get_follow_commit_interval(self):
+        return self.conf_dict.get('follow_commit_interval', 5)
+
+    def get_watch_options(self):
+        """Options of owatch, in seconds"""
+        return {'poll_interval': self.conf_dict.get('watch_poll_interval', 0.5),
+                'debounce': self.conf_dict.get('watch_debounce', 1.0),
+                'max_delay': self.conf_dict.get('watch_max_delay', 10),
+                'reconcile_interval': self.conf_dict.get('watch_reconcile_interval', 600)}
+
+    def get_live_file_tree(self):
+        return self.conf_dict.get('live_file_tree', True)
+
+    def get_upload_bandwidth(self):
+        """In bytes/s"""
+        return self.conf_dict.get('upload_bandwidth_mb', 2) * 1e6
+
+    def get_session_cache(self):
+        """session_cache is either true (default place), false or the path of the cache."""
+        session_cache = self.conf_dict.get('session_cache', True)
+        if not session_cache:
+            return None
+        return SessionCache(session_cache if isinstance(session_cache, str) else None)
+
     def get_overleaf(self):
-        return Overleaf(
-            url_project=self.get_url_project(),
-            email=self.get_email(),
-            password=self.get_password()
-        )
+        """The Overleaf instance of the project, shared by all the commands
+        run in this process (so that we log in only once)."""
+        key = (self.get_url_project(), self.get_email())
+        with _overleaf_instances_lock:
+            overleaf = _overleaf_instances.get(key)
+            if overleaf is None or overleaf.closed:
+                overleaf = Overleaf(
+                    url_project=self.get_url_project(),
+                    email=self.get_email(),
+                    password=self.get_password(),
+                    timeout=self.get_http_timeout(),
+                    pool_size=self.get_http_pool_size(),
+                    live_file_tree=self.get_live_file_tree(),
+                    session=self.session,
+                    session_cache=self.get_session_cache(),
+                    scheduler=self.get_request_scheduler()
+                )
+                _overleaf_instances[key] = overleaf
+            else:
+                # The deadline of the current command
+                overleaf.transport.scheduler.deadline = self.deadline
+            return overleaf
 
     def get_path_to_save(self):
         try:
@@ -831,24 +3064,206 @@ class ConfProject:
     def save(self, outfile=None):
         """This function save the confproject into a file (as json)"""
         outfile = outfile or self.get_path_to_save()
-        logger.debug("Will save dict {}".format(self.conf_dict))
+        logger.debug("Will save dict %s", self.conf_dict)
         with open(outfile, 'w', encoding='utf-8') as outfile:
             json.dump(self.conf_dict, outfile)
-        logger.info("Configuration file saved in {}".format(outfile))
+        logger.info("Configuration file saved in %s", outfile)
+
+##############################
+### Backups of the online project
+##############################
+
+class BackupStore:
+    """Content-addressed store for the backups of the project (in the
+    svg folder). Each different file is stored only once in objects/,
+    and each backup is a manifest snapshots/<date>.json mapping the
+    paths of the project to the hash of their content."""
+    def __init__(self, root, keep_last=20, keep_daily_days=30, max_size_mb=None):
+        self.root = root
+        self.keep_last = keep_last
+        self.keep_daily_days = keep_daily_days
+        self.max_size_mb = max_size_mb
+        self.objects_dir = os.path.join(root, "objects")
+        self.snapshots_dir = os.path.join(root, "snapshots")
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest[2:])
+
+    def _write_atomic(self, path, write):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def add_zip(self, zip_file, date):
+        """Store the content of the zip as a new snapshot, and return its name."""
+        files = dict()
+        with zipfile.ZipFile(zip_file, "r") as zip_ref:
+            for info in zip_ref.infolist():
+                if info.is_dir():
+                    continue
+                h = hashlib.sha256()
+                with zip_ref.open(info) as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        h.update(chunk)
+                digest = h.hexdigest()
+                files[info.filename] = digest
+                if not os.path.exists(self._object_path(digest)):
+                    def write(out):
+                        with zip_ref.open(info) as f:
+                            shutil.copyfileobj(f, out, 1024 * 1024)
+                    self._write_atomic(self._object_path(digest), write)
+        base_name_hour = date.strftime("%Y_%m_%d_-_%H_%M_%S")
+        name = base_name_hour
+        i = 0
+        while os.path.exists(os.path.join(self.snapshots_dir, name + ".json")):
+            i += 1
+            name = "{}_-_{}".format(base_name_hour, i)
+        manifest = json.dumps({'date': date.isoformat(), 'files': files}, indent=1).encode('utf-8')
+        self._write_atomic(os.path.join(self.snapshots_dir, name + ".json"),
+                           lambda f: f.write(manifest))
+        logger.debug("Backup %s saved (%s files).", name, len(files))
+        return name
+
+    def get_snapshots(self):
+        """List of (name, manifest), oldest first."""
+        if not os.path.isdir(self.snapshots_dir):
+            return []
+        snapshots = []
+        for filename in os.listdir(self.snapshots_dir):
+            if filename.endswith(".json"):
+                with open(os.path.join(self.snapshots_dir, filename)) as f:
+                    snapshots.append((filename[:-len(".json")], json.load(f)))
+        return sorted(snapshots, key=lambda s: (s[1]['date'], s[0]))
+
+    def _objects_size(self, snapshots):
+        digests = set(d for (name, m) in snapshots for d in m['files'].values())
+        return sum(os.path.getsize(self._object_path(d))
+                   for d in digests
+                   if os.path.exists(self._object_path(d)))
+
+    def apply_retention(self, now=None):
+        """Keep the keep_last last snapshots, and the last snapshot of each
+        day for keep_daily_days days. Then remove the oldest snapshots until
+        the objects take less than max_size_mb. Unused objects are removed."""
+        now = now or datetime.now()
+        snapshots = self.get_snapshots()
+        kept = set(name for (name, m) in snapshots[-self.keep_last:]) if self.keep_last else set()
+        last_of_day = dict()
+        for (name, m) in snapshots:
+            date = datetime.fromisoformat(m['date'])
+            if (now - date).days < self.keep_daily_days:
+                last_of_day[date.date()] = name
+        kept.update(last_of_day.values())
+        if snapshots:
+            # Never remove the last backup
+            kept.add(snapshots[-1][0])
+        snapshots = [(name, m) for (name, m) in snapshots if name in kept]
+        if self.max_size_mb is not None:
+            while len(snapshots) > 1 and self._objects_size(snapshots) > self.max_size_mb * 1024 * 1024:
+                snapshots.pop(0)
+        kept = set(name for (name, m) in snapshots)
+        for filename in os.listdir(self.snapshots_dir) if os.path.isdir(self.snapshots_dir) else []:
+            if filename.endswith(".json") and not filename[:-len(".json")] in kept:
+                logger.debug("Removing the backup %s", filename)
+                os.remove(os.path.join(self.snapshots_dir, filename))
+        self.gc(snapshots)
+
+    def gc(self, snapshots=None):
+        """Remove the objects that are not used by any snapshot."""
+        snapshots = self.get_snapshots() if snapshots is None else snapshots
+        used = set(d for (name, m) in snapshots for d in m['files'].values())
+        if not os.path.isdir(self.objects_dir):
+            return
+        for prefix in os.listdir(self.objects_dir):
+            folder = os.path.join(self.objects_dir, prefix)
+            for rest in os.listdir(folder):
+                if not prefix + rest in used:
+                    os.remove(os.path.join(folder, rest))
+            if not os.listdir(folder):
+                os.rmdir(folder)
+
+    def restore(self, name, dest):
+        """Write the files of the snapshot name in the folder dest."""
+        with open(os.path.join(self.snapshots_dir, name + ".json")) as f:
+            manifest = json.load(f)
+        for path, digest in manifest['files'].items():
+            parts = [p for p in path.split("/") if p and p not in ['.', '..']]
+            out = os.path.join(dest, *parts)
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+            shutil.copyfile(self._object_path(digest), out)
+
+_background_threads = []
+
+def run_in_background(target, *args):
+    """Run target in a thread, so that it does not slow down the
+    command. Use wait_for_background_tasks before leaving."""
+    def run():
+        try:
+            target(*args)
+        except Exception as e:
+            logger.error("Error in a background task: %s", e)
+    thread = threading.Thread(target=run)
+    thread.start()
+    _background_threads.append(thread)
+    return thread
+
+def wait_for_background_tasks():
+    while _background_threads:
+        _background_threads.pop().join()
+
+@profiled("backup")
+def backup_zip(store, zip_file, date, remove_zip=True):
+    """Save the zip in the backup store, and apply the retention policy."""
+    try:
+        name = store.add_zip(zip_file, date)
+        store.apply_retention()
+        logger.info("Backup %s saved in %s", name, store.root)
+    finally:
+        if remove_zip:
+            os.remove(zip_file)
 
 ##############################
 ### Git integration
 ##############################
 
-def run_interactive_command(args):
-    """Args is a list of arguments (including the program name), and we will plug this command into git."""
-    return subprocess.call(args, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr)
+def run_interactive_command(args, interactive=True):
+    """Args is a list of arguments (including the program name), and we will plug this command into git.
+    If not interactive, the command cannot read the standard input."""
+    profiler.count('git_commands')
+    with tracer.span('git', " ".join(args[1:2]), args=args[1:]):
+        return subprocess.call(args,
+                               stdin=sys.stdin if interactive else subprocess.DEVNULL,
+                               stdout=sys.stdout, stderr=sys.stderr)
+
+class TracedGit(git.Git):
+    """git.Git recording a span (see Tracer) for each git command."""
+    def execute(self, command, *args, **kwargs):
+        profiler.count('git_commands')
+        if not tracer.enabled or isinstance(command, str):
+            return super().execute(command, *args, **kwargs)
+        # The global options (-c...) are before the sub-command
+        name = next((a for a in command[1:] if not str(a).startswith("-")), "")
+        with tracer.span('git', name, args=[str(a) for a in command[1:]][:20]) as span:
+            out = super().execute(command, *args, **kwargs)
+            if isinstance(out, (str, bytes)):
+                span['bytes_received'] = len(out)
+            return out
+
+class TracedRepo(git.Repo):
+    """git.Repo whose git commands (self.git...) are traced."""
+    GitCommandWrapperType = TracedGit
 
 def get_repo():
     cwd = os.getcwd()
     try:
-        repo = git.Repo(cwd, search_parent_directories=True)
-        logger.debug("I found a repo in {} whose working dir is {}.".format(cwd, repo.working_tree_dir))
+        repo = TracedRepo(cwd, search_parent_directories=True)
+        logger.debug("I found a repo in %s whose working dir is %s.", cwd, repo.working_tree_dir)
         if repo.bare:
             raise BareRepoNotSupported()
         return repo
@@ -862,9 +3277,13 @@ def overleaf_branch_exists():
 
 class OverleafRepo():
     """This class needs to be used with the 'with' keyword
-    to make sure that the repository is sent back to it's
-    original state. Should use it like:
+    to make sure that we come back to the original directory.
+    Should use it like:
     with OverleafRepo(repo) as repo:
+    It makes sure that the overleaf branch exists. The overleaf branch
+    is never checked out: it is only updated with plumbing commands
+    (see commit_in_branch and merge_in_branch), so the working tree
+    and the index of the user are never touched.
     """
     def __init__(self, repo=None, confproject=None, overleaf_branch=GIT_OVERLEAF_BRANCH, warning_run_in_ogit_folder=True):
         self.repo = repo or get_repo()
@@ -872,6 +3291,9 @@ class OverleafRepo():
         if warning_run_in_ogit_folder and os.path.exists(
                 os.path.join(self.repo.working_tree_dir,
                              'should_not_run_ogit_here.txt')):
+            if confproject and not confproject.is_interactive():
+                logger.error("It seems that you are running ogit in the git repository of ogit.")
+                raise RunsInOgitRepo()
             print("WARNING:")
             print("It seems that you are running ogit in the git")
             print("repository of ogit, while usually you should")
@@ -888,42 +3310,23 @@ class OverleafRepo():
         # come back on master after that.
         if not self.repo.heads:
             logger.info("No branch exists, creating an empty commit to initialize the repository")
-            # No branch
-            if self.repo.is_dirty():
-                self.repo.git.stash("push")
-                self.repo.index.commit("First (empty) commit")
-                self.repo.git.stash("pop")
-            else:
-                self.repo.index.commit("First (empty) commit")
+            # No branch: the commit is created without the index, so
+            # the files already added are kept in the index
+            empty_tree = self.repo.git.mktree(istream=subprocess.DEVNULL)
+            first_commit = self.repo.git.commit_tree(empty_tree, "-m", "First (empty) commit")
+            self.repo.git.update_ref("HEAD", first_commit)
         self.old_branch = self.repo.active_branch.name
         # Make sure the overleaf branch exists
         if not self.overleaf_branch in [b.name
                                         for b in self.repo.branches]:
-            logger.info("Branch {} didn't exist, I will create it.".format(self.overleaf_branch))
-            self.repo.git.checkout('-b', self.overleaf_branch)
-        logger.debug("Currently on branch {}, I will stash push everything.".format(self.old_branch))
-        ## `git stash push --all` does not push anything if nothing
-        ## has been modified so we first check if there is
-        ## anything to push:
-        self.must_push_pop = self.repo.is_dirty(untracked_files=True)
-        if self.must_push_pop:
-            logger.debug("I will run: git stash push --all")
-            self.repo.git.stash("push", "--all")
-        else:
-            logger.debug("Nothing to stash.")
-        logger.debug("I'll go to branch {}".format(self.overleaf_branch))
-        self.repo.heads[self.overleaf_branch].checkout()
+            logger.info("Branch %s didn't exist, I will create it.", self.overleaf_branch)
+            self.repo.git.branch(self.overleaf_branch)
         os.chdir(self.repo.working_tree_dir)
         return {'repo': self.repo,
                 'old_branch': self.old_branch}
 
     def __exit__(self, type, value, traceback):
-        logger.debug("Let's go back to branch {}".format(self.old_branch))
-        self.repo.heads[self.old_branch].checkout()
-        if self.must_push_pop:
-            logger.debug("Let's run: git stash pop")
-            self.repo.git.stash("pop")
-        logger.debug("Let's go now to {}".format(self.cwd))
+        logger.debug("Let's go now to %s", self.cwd)
         os.chdir(self.cwd)
 
 class cd:
@@ -941,64 +3344,230 @@ class cd:
     def __exit__(self, etype, value, traceback):
         os.chdir(self.savedPath)
 
+def _fast_import_path(path):
+    """Quote the path for git fast-import if needed."""
+    if path.startswith('"') or any(c in path for c in '\n\\'):
+        return '"' + path.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+    return path
+
+def commit_in_branch(repo, branch, message, write_files, deleteall=False):
+    """Create a commit on branch with git fast-import: write_files(w) writes
+    the file commands (M, D...) on the stream w. If deleteall, the commit
+    only contains the files written by write_files. The working tree is
+    not touched (except if branch is currently checked out, in which case
+    only the modified files are updated). Returns True if a new commit
+    has been created."""
+    parent = repo.git.rev_parse("--verify", "refs/heads/" + branch)
+    tmp_ref = "refs/ogit/fetch"
+    committer = repo.git.var("GIT_COMMITTER_IDENT")
+    profiler.count('git_commands')
+    with tracer.span('git', 'fast-import'):
+        proc = subprocess.Popen(["git", "fast-import", "--quiet", "--done", "--force"],
+                                cwd=repo.working_tree_dir,
+                                stdin=subprocess.PIPE)
+        try:
+            w = proc.stdin
+            message = message.encode('utf-8')
+            w.write("commit {}\ncommitter {}\ndata {}\n".format(tmp_ref, committer, len(message)).encode('utf-8'))
+            w.write(message + b"\n")
+            w.write("from {}\n".format(parent).encode('utf-8'))
+            if deleteall:
+                w.write(b"deleteall\n")
+            write_files(w)
+            w.write(b"done\n")
+            w.close()
+        except BaseException:
+            # The original error must not be hidden by the one of fast-import
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+            if proc.wait() != 0:
+                logger.error("git fast-import failed with code %s", proc.returncode)
+            raise
+        if proc.wait() != 0:
+            raise GitException("git fast-import failed with code {}".format(proc.returncode))
+    try:
+        new_commit = repo.git.rev_parse(tmp_ref)
+        if repo.git.rev_parse(new_commit + "^{tree}") == repo.git.rev_parse(parent + "^{tree}"):
+            logger.debug("No change, nothing to commit.")
+            return False
+        repo.git.update_ref("refs/heads/" + branch, new_commit, parent)
+        if not repo.head.is_detached and repo.active_branch.name == branch:
+            # Update the files of the working tree that changed
+            repo.git.read_tree("-m", "-u", parent, new_commit)
+        return True
+    finally:
+        try:
+            repo.git.update_ref("-d", tmp_ref)
+        except git.GitCommandError as e:
+            # Harmless (the next fast-import overwrites it), and must not
+            # hide the original error
+            logger.warning("Cannot remove %s: %s", tmp_ref, e)
+
+def merge_in_branch(repo, branch, commit):
+    """Update branch once commit has been pushed online, without
+    touching the working tree: branch is fast-forwarded to commit if
+    possible, else a merge commit is created whose content is the
+    content of commit (i.e. the online content). Returns True if
+    branch changed."""
+    new_commit = repo.git.rev_parse("--verify", commit + "^{commit}")
+    old_commit = repo.git.rev_parse("--verify", "refs/heads/" + branch)
+    if new_commit == old_commit:
+        return False
+    if repo.is_ancestor(old_commit, new_commit):
+        logger.debug("Fast-forward %s to %s", branch, new_commit)
+        target = new_commit
+    else:
+        if repo.git.rev_parse(new_commit + "^{tree}") == repo.git.rev_parse(old_commit + "^{tree}"):
+            logger.debug("%s already has the content of %s.", branch, new_commit)
+            return False
+        message = "Merge {} into {}".format(repo.git.name_rev("--name-only", "--always", new_commit), branch)
+        target = repo.git.commit_tree(new_commit + "^{tree}", "-p", old_commit, "-p", new_commit,
+                                      "-m", message)
+    repo.git.update_ref("refs/heads/" + branch, target, old_commit)
+    if not repo.head.is_detached and repo.active_branch.name == branch:
+        # Update the files of the working tree that changed
+        repo.git.read_tree("-m", "-u", old_commit, target)
+    return True
+
+@profiled("import")
+def import_zip_in_branch(repo, zip_file, branch, message):
+    """Create a commit on branch whose content is the content of zip_file.
+    The members of the zip are streamed to git fast-import, so nothing is
+    extracted on the disk (see commit_in_branch). Returns True if a new
+    commit has been created."""
+    def write_files(w):
+        nb_files = 0
+        with zipfile.ZipFile(zip_file, "r") as zip_ref:
+            for info in zip_ref.infolist():
+                if info.is_dir():
+                    continue
+                path = zip_member_path(info.filename)
+                if not path:
+                    logger.warning("Ignoring the file %s of the zip.", info.filename)
+                    continue
+                w.write("M 100644 inline {}\ndata {}\n".format(_fast_import_path(path),
+                                                              info.file_size).encode('utf-8'))
+                with zip_ref.open(info) as f:
+                    shutil.copyfileobj(f, w, 1024 * 1024)
+                w.write(b"\n")
+                nb_files += 1
+        logger.debug("%s files imported", nb_files)
+        profiler.count('files', nb_files)
+    return commit_in_branch(repo, branch, message, write_files, deleteall=True)
+
+def read_fetch_state(repo):
+    """What we know about the last fetch (stored in the .git folder)."""
+    try:
+        with open(os.path.join(repo.git_dir, "ogit_fetch_state.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+def write_fetch_state(repo, state):
+    with open(os.path.join(repo.git_dir, "ogit_fetch_state.json"), 'w') as f:
+        json.dump(state, f)
+
+@profiled("fetch")
 def ogit_ofetch(confproject=None, args=None):
     """
     Will simulate a kind of fetch on the overleaf branch, and
     basically sync this branch with the online overleaf version.
+    The branch is updated without checking it out. If the project
+    did not change since the last fetch, nothing is downloaded.
     """
     if not confproject:
         confproject = ConfProject(args=args)
     with OverleafRepo(confproject=confproject) as repo_dict:
         repo = repo_dict['repo']
-        # Find a good destination folder for files
-        d = datetime.now()
-        base_name_hour = d.strftime("%Y_%m_%d_-_%H_%M_%S")
-        base_name = base_name_hour
-        current_svg_folder = os.path.join(confproject.get_svg_path(),
-                                          base_name)
-        i = 0
-        while os.path.exists(current_svg_folder):
-            i += 1
-            base_name = "{}_-_{}".format(base_name_hour, i)
-            current_svg_folder = os.path.join(confproject.get_svg_path(),
-                                              base_name)
-        should_keep_root_svg = os.path.exists(confproject.get_svg_path())
-        file_zip = os.path.join(current_svg_folder,
-                                base_name + ".zip")
-        os.makedirs(current_svg_folder, exist_ok=True)
         overleaf = confproject.get_overleaf()
-        overleaf.get_zip(outputfile=file_zip)
-        # Extract the zip file
-        extract_dir = os.path.join(current_svg_folder, "extracted")
-        os.makedirs(extract_dir, exist_ok=True)
-        with zipfile.ZipFile(file_zip,"r") as zip_ref:
-            zip_ref.extractall(extract_dir)
-        # Remove all the files created by git:
-        repo.git.rm("-r", "-f", "--ignore-unmatch", ".")
-        # Copy all files
-        copy_tree(extract_dir, repo.working_tree_dir)
-        # Add all these files
-        os.chdir(extract_dir)
-        files_to_add = []
-        for f in Path(".").glob('**/*'):
-            if f.is_file():
-                files_to_add.append(str(f))
-        os.chdir(repo.working_tree_dir)
-        repo.index.add(files_to_add)
-        # Commit
-        if not repo.is_dirty():
-            logger.debug("No change, nothing to commit.")
-        else:
-            repo.index.commit("New version from overleaf on {}".format(d.strftime("%a. %d %B %Y, %H:%M")))
-        # If no svg is asked, remove the folder
-        if not confproject.have_svg():
-            if should_keep_root_svg:
-                shutil.rmtree(current_svg_folder)
+        fingerprint = None
+        if confproject.get_skip_unchanged_fetch() and not getattr(args, 'force_download', False):
+            try:
+                fingerprint = overleaf.get_project_fingerprint()
+            except OverleafException as e:
+                logger.warning("Cannot know if the project changed (%s), let's download it.", e)
+            last_fetch = read_fetch_state(repo)
+            if (fingerprint
+                and last_fetch.get('fingerprint') == fingerprint
+                and last_fetch.get('commit') == repo.git.rev_parse(confproject.get_overleaf_branch_name())):
+                logger.info("The project did not change online since the last fetch.")
+                return
+        d = datetime.now()
+        fd, file_zip = tempfile.mkstemp(prefix="ogit_", suffix=".zip", dir=repo.git_dir)
+        os.close(fd)
+        try:
+            # An interrupted download is kept in the .git folder to be resumed
+            overleaf.get_zip(outputfile=file_zip,
+                             resume_file=os.path.join(repo.git_dir, "ogit_download.zip.part"),
+                             **confproject.get_download_options())
+        except BaseException:
+            os.remove(file_zip)
+            raise
+        backup = None
+        if confproject.have_svg():
+            # The backup is done while we deal with git
+            backup = run_in_background(backup_zip, confproject.get_backup_store(), file_zip, d, False)
+        try:
+            # Commit the content of the zip on the overleaf branch
+            import_zip_in_branch(repo,
+                                 file_zip,
+                                 confproject.get_overleaf_branch_name(),
+                                 "New version from overleaf on {}".format(d.strftime("%a. %d %B %Y, %H:%M")))
+        finally:
+            if backup:
+                # The zip is still read by the backup
+                run_in_background(lambda: (backup.join(), os.remove(file_zip)))
             else:
-                shutil.rmtree(confproject.get_svg_path())
-        else:
-            # Remove only the extracted folder
-            shutil.rmtree(extract_dir)
+                os.remove(file_zip)
+        write_fetch_state(repo, {'fingerprint': fingerprint,
+                                 'commit': repo.git.rev_parse(confproject.get_overleaf_branch_name())})
+
+def ogit_osvg(confproject=None, args=None):
+    """List the backups of the online project, or restore one of them."""
+    if not confproject:
+        confproject = ConfProject(args=args)
+    store = confproject.get_backup_store()
+    name = getattr(args, 'restore', None)
+    if not name:
+        for (name, manifest) in store.get_snapshots():
+            print("{} ({} files)".format(name, len(manifest['files'])))
+        return
+    dest = getattr(args, 'to', None) or "ogit_restore_{}".format(name)
+    store.restore(name, dest)
+    logger.info("The backup %s has been restored in %s", name, dest)
+
+def ogit_oexport(confproject=None, args=None):
+    """Write the online project on the standard output (or in
+    args.output) as a zip (as given by overleaf), a tar or a tar.gz,
+    while it is downloaded. Nothing is written on disk (except the
+    files of unknown size bigger than 16MB in a tar), and it can be run
+    outside of a git repository."""
+    if not confproject:
+        confproject = ConfProject(args=args)
+    fmt = getattr(args, 'format', None) or 'zip'
+    output = getattr(args, 'output', None) or '-'
+    overleaf = confproject.get_overleaf()
+    chunk_size = confproject.get_download_options()['chunk_size']
+    out = sys.stdout.buffer if output == '-' else open(output, 'wb')
+    try:
+        with profiler.phase("export"):
+            if fmt == 'zip':
+                for chunk in overleaf.iter_zip(chunk_size=chunk_size):
+                    out.write(chunk)
+            else:
+                write_tar(overleaf.iter_files(chunk_size=chunk_size), out,
+                          compression="gz" if fmt == 'tar.gz' else "")
+        out.flush()
+    except BaseException:
+        if output != '-':
+            out.close()
+            os.remove(output)
+        raise
+    if output != '-':
+        out.close()
+        logger.info("The project has been exported in %s", output)
 
 def ogit_opull(confproject=None, other_arguments=[], args=None):
     """
@@ -1008,72 +3577,338 @@ def ogit_opull(confproject=None, other_arguments=[], args=None):
     """
     if not confproject:
         confproject = ConfProject(args=args)
-    ogit_ofetch(confproject)
-    return run_interactive_command(["git", "merge", confproject.get_overleaf_branch_name()] + other_arguments)
+    ogit_ofetch(confproject, args=args)
+    with profiler.phase("merge"):
+        # Without a user to write the message of the merge commit
+        no_edit = [] if confproject.is_interactive() else ["--no-edit"]
+        return run_interactive_command(["git", "merge"] + no_edit + [confproject.get_overleaf_branch_name()] + other_arguments,
+                                       interactive=confproject.is_interactive())
+
+def get_folder_moves(renames, branch_files, index_files):
+    """Find the folders that have been renamed/moved as a whole: all the
+    files of old_folder are renamed to new_folder with the same relative
+    path, new_folder did not exist and old_folder does not exist anymore.
+    renames is a list of (old_path, new_path). Returns a list of
+    (old_folder, new_folder), without nested moves."""
+    branch_files = sorted(branch_files)
+    index_files = sorted(index_files)
+    def files_under(sorted_files, folder):
+        i = bisect.bisect_left(sorted_files, folder + "/")
+        j = bisect.bisect_left(sorted_files, folder + "0") # '0' is the character after '/'
+        return sorted_files[i:j]
+    renamed_to = dict(renames)
+    candidates = set()
+    for (old, new) in renames:
+        while os.path.basename(old) == os.path.basename(new) and os.path.dirname(old) and os.path.dirname(new):
+            old = os.path.dirname(old)
+            new = os.path.dirname(new)
+            if old != new:
+                candidates.add((old, new))
+    folder_moves = []
+    # Highest folders first
+    for (old, new) in sorted(candidates, key=lambda c: (c[0].count("/"), c)):
+        if any(old.startswith(f + "/") for (f, _) in folder_moves):
+            continue
+        if files_under(index_files, old) or files_under(branch_files, new) or new in branch_files:
+            continue
+        if all(renamed_to.get(f) == new + f[len(old):]
+               for f in files_under(branch_files, old)):
+            folder_moves.append((old, new))
+    return folder_moves
+
+def get_incremental_changes(repo, ft, overleaf_branch):
+    """Compare the overleaf branch with the index to know what should
+    be sent online. Returns (files_to_send, paths_to_remove, moves) (see
+    build_push_operations), or None if the overleaf branch is missing or
+    does not describe the online project anymore (in that case a full
+    push is needed). Renamed files and folders are moved online instead
+    of being sent again."""
+    if not overleaf_branch in [b.name for b in repo.branches]:
+        logger.info("No branch %s, the push will not be incremental.", overleaf_branch)
+        return None
+    # The overleaf branch should be a copy of the online project
+    branch_files = set(f
+                       for f in repo.git.ls_tree("-r", "-z", "--name-only", overleaf_branch).split('\x00')
+                       if f)
+    online_files = set(f.strip("/")
+                       for f in ft.get_list_files()
+                       if f)
+    if branch_files != online_files:
+        logger.info("The branch %s does not match the online files, the push will not be incremental.", overleaf_branch)
+        logger.debug("Only in branch: %s, only online: %s", branch_files - online_files,
+                                                                 online_files - branch_files)
+        return None
+    files_to_send = []
+    files_to_remove = []
+    renames = []
+    elts = [elt for elt in repo.git.diff_index("--cached", "-z", "--name-status", "-M", overleaf_branch).split('\x00')
+            if elt]
+    i = 0
+    while i < len(elts):
+        status = elts[i]
+        if status[0] in "RC":
+            (old, new) = (elts[i+1], elts[i+2])
+            i += 3
+            if status[0] == "R":
+                renames.append((old, new))
+            if status[0] == "C" or status[1:] != "100":
+                # The content changed as well (or is a copy)
+                files_to_send.append(new)
+            continue
+        if status == "D":
+            files_to_remove.append(elts[i+1])
+        else:
+            files_to_send.append(elts[i+1])
+        i += 2
+    index_files = [f for f in repo.git.ls_files("-z").split('\x00') if f]
+    ### Whole folders can be moved in one request
+    folder_moves = get_folder_moves(renames, branch_files, index_files)
+    moves = [(old, os.path.dirname(new), os.path.basename(new))
+             for (old, new) in folder_moves]
+    moved_folders = set(old for (old, new) in folder_moves)
+    def in_moved_folder(path):
+        folder = os.path.dirname(path)
+        while folder:
+            if folder in moved_folders:
+                return True
+            folder = os.path.dirname(folder)
+        return False
+    moves += [(old, os.path.dirname(new), os.path.basename(new))
+              for (old, new) in renames
+              if not in_moved_folder(old)]
+    logger.info("Incremental push: %s file(s) to send, %s file(s) to remove, %s move(s)", len(files_to_send), len(files_to_remove), len(moves))
+    ### Also remove the folders that do not contain any file anymore
+    kept_folders = get_ancestor_folders(index_files)
+    folders_to_remove = set()
+    for folder in set(os.path.dirname(f)
+                      for f in files_to_remove + [old for (old, new) in renames]):
+        # Remove only the highest folder that should disappear
+        top_folder = None
+        while folder and not folder in kept_folders:
+            top_folder = folder
+            folder = os.path.dirname(folder)
+        if top_folder and not top_folder in moved_folders and not in_moved_folder(top_folder):
+            folders_to_remove.add(top_folder)
+    return (files_to_send, files_to_remove + sorted(folders_to_remove), moves)
+
+def get_ancestor_folders(paths):
+    """Set of all the folders containing (directly or not) one of the
+    paths (without leading or trailing slash)."""
+    folders = set()
+    for path in paths:
+        folder = os.path.dirname(path)
+        # If the folder is known, its ancestors are known as well
+        while folder and not folder in folders:
+            folders.add(folder)
+            folder = os.path.dirname(folder)
+    return folders
+
+def get_stale_paths(ft, files_to_send):
+    """Online files and folders that do not appear in files_to_send (and
+    should therefore be removed). Linear in the size of both lists."""
+    sent_files = set(files_to_send)
+    sent_folders = get_ancestor_folders(sent_files)
+    stale_files = [ f.strip("/")
+                    for f in ft.get_list_files()
+                    if f.strip("/") and not f.strip("/") in sent_files ]
+    # Make sure to remove '/' else you break completely the project!
+    stale_folders = [ f.strip("/")
+                      for f in ft.get_list_folders()
+                      if f.strip("/") and not f.strip("/") in sent_folders ]
+    return stale_files + stale_folders
+
+def plan_remote_deletions(ft, paths_to_remove, moved=(), kept=()):
+    """Removing a folder online removes everything inside, so we only
+    need to remove the highest folders whose content is entirely in
+    paths_to_remove (or moved elsewhere before, see moved), even if
+    the folder itself is not in paths_to_remove. The folders containing
+    one of the paths kept (the files sent or moved by the push) are
+    never removed, and neither are the folders of paths_to_remove that
+    still contain something else online (e.g. a file added by a
+    collaborator). Returns (paths, nb_saved) where paths are the paths
+    to really remove, and nb_saved the number of requests saved
+    compared to removing each path."""
+    to_remove = set("/" + p.strip("/") for p in paths_to_remove)
+    # Never remove the root folder
+    to_remove.discard("/")
+    moved = set("/" + p.strip("/") for p in moved)
+    kept_folders = set("/" + f for f in get_ancestor_folders(p.strip("/") for p in kept))
+    # Find (bottom-up) the folders whose whole content will be removed
+    fully_stale = set()
+    root = ft.get_element("/")
+    stack = [(root, False)] if root else []
+    while stack:
+        node, children_done = stack.pop()
+        if node.children and not children_done:
+            stack.append((node, True))
+            stack.extend((c, False) for c in node.children.values())
+            continue
+        if node.path_name == "/" or node.path_name in kept_folders:
+            continue
+        if node.path_name in moved:
+            # Will not be in the folder anymore
+            fully_stale.add(node.path_name)
+        elif ((node.path_name in to_remove or node.children)
+              and all(c.path_name in fully_stale for c in (node.children or dict()).values())):
+            fully_stale.add(node.path_name)
+    paths = []
+    seen = set()
+    removed = set()
+    for p in paths_to_remove:
+        path = "/" + p.strip("/")
+        if not path in to_remove or path in seen:
+            continue
+        node = ft.get_element(path)
+        if node and node.file_type == 'folder' and not path in fully_stale:
+            logger.debug("The folder %s is not removed, it still contains other elements", path)
+            continue
+        seen.add(path)
+        # The highest fully stale folder containing path (or path itself)
+        top = path
+        ancestor = os.path.dirname(path)
+        while ancestor != "/":
+            if ancestor in fully_stale:
+                top = ancestor
+            ancestor = os.path.dirname(ancestor)
+        if top in removed:
+            continue
+        removed.add(top)
+        paths.append(p if top == path else top.lstrip("/"))
+    nb_saved = len(seen) - len(paths)
+    logger.info("Removal of %s online path(s) with %s request(s) (%s request(s) saved)", len(seen), len(paths), nb_saved)
+    return (paths, nb_saved)
+
+def get_full_changes(repo, ft):
+    """Send all the files of the index, and remove everything else
+    online. Returns (files_to_send, paths_to_remove, moves) (see
+    build_push_operations)."""
+    files_to_send = [ filename
+                      for filename in repo.git.ls_files("-z").split('\x00')
+                      if filename ]
+    paths_to_remove = get_stale_paths(ft, files_to_send)
+    logger.debug("files_to_send: %s", files_to_send)
+    logger.debug("paths_to_remove: %s", paths_to_remove)
+    return (files_to_send, paths_to_remove, [])
+
+@profiled("plan")
+def get_push_plan(repo, overleaf, confproject, args=None):
+    """Compute the operations needed to push the current commit online.
+    If possible, only the files that changed since the last
+    synchronisation with the overleaf branch are sent."""
+    with cd(repo.working_tree_dir):
+        ft = overleaf.ls(force_reload=confproject.get_force_reload())
+        changes = None
+        if confproject.get_incremental_push() and not getattr(args, 'full', False):
+            changes = get_incremental_changes(repo, ft, confproject.get_overleaf_branch_name())
+        if changes is None:
+            changes = get_full_changes(repo, ft)
+        (files_to_send, paths_to_remove, moves) = changes
+        (paths_to_remove, nb_saved) = plan_remote_deletions(
+            ft, paths_to_remove,
+            moved=[src for (src, dst_folder, new_name) in moves],
+            kept=files_to_send + [os.path.join(dst_folder, new_name) for (src, dst_folder, new_name) in moves])
+        operations = build_push_operations(ft, files_to_send, paths_to_remove, moves)
+    return PushPlan(operations,
+                    head=repo.head.commit.hexsha,
+                    online_tree=PushPlan.get_online_tree_hash(overleaf),
+                    nb_saved_removals=nb_saved)
+
+def ogit_opush_plan(confproject=None, args=None):
+    """Compute the operations of a push without running them, print
+    them with an estimation of the time, and save the plan in json if
+    args.plan is a filename (run it later with opush --apply-plan). Without
+    filename, the json plan is written on stdout and the summary on stderr.
+    The overleaf branch is fetched first (the current branch and the
+    working tree are not touched): if the online project has
+    modifications that are not merged in the current branch, the plan
+    would not be the one of opush (that pulls them first), so we stop."""
+    if not confproject:
+        confproject = ConfProject(args=args)
+    repo = get_repo()
+    overleaf = confproject.get_overleaf()
+    ogit_ofetch(confproject, args=args)
+    if not repo.is_ancestor(confproject.get_overleaf_branch_name(), "HEAD"):
+        txt = "The online project changed, run 'ogit.py opull' before computing the plan."
+        logger.error(txt)
+        raise OnlineChangesNotMerged(txt)
+    plan = get_push_plan(repo, overleaf, confproject, args=args)
+    outfile = getattr(args, 'plan', None)
+    summary = plan.summary(latency=overleaf.transport.get_mean_latency(),
+                           concurrency=confproject.get_push_concurrency(),
+                           upload_bandwidth=confproject.get_upload_bandwidth())
+    if outfile == '-':
+        print(summary, file=sys.stderr)
+        print(json.dumps(plan.to_dict(), indent=1))
+    else:
+        print(summary)
+        if outfile:
+            plan.save(outfile)
+            logger.info("Plan saved in %s, run it with: ogit.py opush --apply-plan %s", outfile, outfile)
+    return plan
 
 def ogit_opush_force(confproject=None, should_merge_back=True, args=None):
-    """Force to push everything online without pulling first"""
+    """Force to push everything online without pulling first.
+    If possible, only the files that changed since the last
+    synchronisation with the overleaf branch are sent. If
+    args.apply_plan is given, the operations of this plan are run
+    instead (if the plan is still valid). The operations are written
+    in a PushJournal: if args.resume, the interrupted push is
+    finished instead."""
     if not confproject:
         confproject = ConfProject(args=args)
     logger.info("Let's push the files online...")
     repo = get_repo()
     overleaf = confproject.get_overleaf()
+    journal = PushJournal.for_repo(repo)
+    if getattr(args, 'resume', False):
+        with profiler.phase("plan"):
+            plan = journal.get_remaining_plan(repo, overleaf)
+    else:
+        if getattr(args, 'apply_plan', None):
+            with profiler.phase("plan"):
+                plan = PushPlan.load(args.apply_plan)
+                overleaf.ls(force_reload=True)
+                plan.check(repo, overleaf)
+        else:
+            plan = get_push_plan(repo, overleaf, confproject, args=args)
+        if journal.exists():
+            logger.warning("The push interrupted previously will not be resumed.")
+        journal.create(plan)
     with cd(repo.working_tree_dir):
-        files_to_send = [ filename
-                          for filename in repo.git.ls_files("-z").split('\x00')
-                          if filename ]
-        ### First send files
-        for filename in files_to_send:
-            logger.info("Will send file {}".format(filename))
-            overleaf.upload_file(filename,
-                                 local_path_name=filename,
-                                 force=True,
-                                 force_reload=confproject.get_force_reload())
-        ### Then remove unused files
-        ft = overleaf.ls(
-            force_reload=confproject.get_force_reload()
-        )
-        online_files = [f.strip("/")
-                        for f in ft.get_list_files()
-                        if f]
-        logger.debug("files_to_send: {}".format(files_to_send))
-        logger.debug("online_files: {}".format(online_files))
-        for filename in online_files:
-            if not filename in files_to_send:
-                logger.info("Will remove file {}".format(filename))
-                overleaf.rm("/" + filename,
-                            force=True,
-                            force_reload=confproject.get_force_reload())
-        ### Then remove unused folders
-        # Make sure to remove '/' else you break completely the project!
-        online_folders = [ f.strip("/")
-                           for f in ft.get_list_folders()
-                           if f.strip("/") ]
-        logger.debug("online_folders: {}".format(online_folders))
-        for folder in online_folders:
-            # Check if the folder appears in the sent files
-            # ... if not, remove it!
-            if not [ f
-                     for f in files_to_send
-                     if f.startswith(folder + "/") ]:
-                logger.info("Will remove folder {}".format(folder))
-                overleaf.rm("/" + folder,
-                           force=True,
-                           force_reload=confproject.get_force_reload())
+        with profiler.phase("push"):
+            try:
+                report = RemoteExecutor(overleaf,
+                                        concurrency=confproject.get_push_concurrency(),
+                                        journal=journal).run(plan.operations)
+            except BaseException:
+                logger.error("The push has been interrupted, run 'ogit.py opush --resume' to finish it.")
+                try:
+                    journal.close()
+                except OSError as e:
+                    logger.error("Cannot close the push journal: %s", e)
+                raise
+            journal.close()
+        logger.info(report.summary())
         logger.info("Push successful")
         if not should_merge_back:
+            journal.remove()
             return 0
         logger.info("Let's merge back to overleaf branch!")
         ### Merge everything back to the overleaf branch
-        with OverleafRepo(confproject=confproject) as repo_dict:
-            repo = repo_dict['repo']
-            old_branch = repo_dict['old_branch']
-            return run_interactive_command(["git", "merge", old_branch])
+        with profiler.phase("merge back"), OverleafRepo(confproject=confproject) as repo_dict:
+            merge_in_branch(repo_dict['repo'],
+                            confproject.get_overleaf_branch_name(),
+                            plan.head or "HEAD")
+        journal.remove()
+        return 0
 
 
 def ogit_opush(confproject=None, allow_dirty_repo=False, other_arguments=[], args=None):
     """In order to avoid to get lose of information during push,
     we force the user to first do a pull."""
+    if getattr(args, 'plan', None):
+        # Nothing is modified, locally or online
+        return ogit_opush_plan(confproject, args=args)
     if not confproject:
         confproject = ConfProject(args=args)
     repo = get_repo()
@@ -1082,12 +3917,590 @@ def ogit_opush(confproject=None, allow_dirty_repo=False, other_arguments=[], arg
         logger.error(txt)
         raise DirtyRepository(txt)
     logger.debug("Let's first pull before pushing notification")
+    if getattr(args, 'apply_plan', None) or getattr(args, 'resume', False):
+        # The plan was computed for a given online project, nothing to pull
+        return ogit_opush_force(confproject=confproject, args=args)
     res_code = ogit_opull(confproject,
-                          other_arguments=other_arguments)
+                          other_arguments=other_arguments,
+                          args=args)
     if res_code != 0:
         logger.error("An error occured during the merge, so we won't push anything.")
         raise ErrorDuringMerge()
-    return ogit_opush_force(confproject=confproject)
+    return ogit_opush_force(confproject=confproject, args=args)
+
+##############################
+### Follow mode
+##############################
+
+def apply_ot_op(text, op):
+    """Apply the components of an overleaf (sharejs) text operation to
+    text. The positions count UTF-16 code units, as in javascript.
+    They are the indexes of the characters only if the text stays ASCII
+    (the inserted text too)."""
+    if text.isascii() and all(c.get('i', '').isascii() for c in op):
+        for c in op:
+            if 'i' in c:
+                text = text[:c['p']] + c['i'] + text[c['p']:]
+            elif 'd' in c:
+                if text[c['p']:c['p'] + len(c['d'])] != c['d']:
+                    raise ValueError("Deleted text {!r} not found at {}".format(c['d'], c['p']))
+                text = text[:c['p']] + text[c['p'] + len(c['d']):]
+            # Other components (comments) do not modify the text
+        return text
+    data = text.encode('utf-16-le', 'surrogatepass')
+    for c in op:
+        p = 2 * c['p']
+        if 'i' in c:
+            data = data[:p] + c['i'].encode('utf-16-le', 'surrogatepass') + data[p:]
+        elif 'd' in c:
+            deleted = c['d'].encode('utf-16-le', 'surrogatepass')
+            if data[p:p + len(deleted)] != deleted:
+                raise ValueError("Deleted text {!r} not found at {}".format(c['d'], c['p']))
+            data = data[:p] + data[p + len(deleted):]
+    return data.decode('utf-16-le', 'surrogatepass')
+
+class FollowSession:
+    """Follow the online project (see ogit_ofollow): the docs are
+    joined, so that overleaf sends their updates, which are applied to
+    our copy of the docs. The tree events are applied by the live file
+    tree of Overleaf. The changes are committed on the overleaf branch
+    every commit_interval seconds."""
+    def __init__(self, repo, overleaf, confproject, commit_interval=5, fast_forward=True):
+        self.repo = repo
+        self.overleaf = overleaf
+        self.branch = confproject.get_overleaf_branch_name()
+        self.commit_interval = commit_interval
+        self.fast_forward = fast_forward
+        self.lock = threading.Lock()
+        self.docs = dict() # doc _id -> {'text':, 'version':}
+        self.dirty_docs = set() # doc _id modified since the last commit
+        self.to_join = set() # doc _id to (re)join
+        self.files = dict() # file _id -> downloaded content, not committed yet
+        self.committed = dict() # _id -> path in the overleaf branch
+        self.nb_updates = 0
+        self.nb_commits = 0
+
+    def _on_update(self, update, *args):
+        """Called by the reader thread of the socket for each otUpdateApplied."""
+        doc_id = update.get('doc')
+        with self.lock:
+            doc = self.docs.get(doc_id)
+            if doc is None or not 'op' in update:
+                return
+            if update['v'] < doc['version']:
+                # Already applied
+                return
+            if update['v'] > doc['version']:
+                logger.warning("Some updates of the doc %s have been missed, let's join it again.", doc_id)
+                self.to_join.add(doc_id)
+                return
+            try:
+                doc['text'] = apply_ot_op(doc['text'], update['op'])
+            except (ValueError, KeyError, TypeError) as e:
+                logger.warning("Cannot apply an update of the doc %s (%s), let's join it again.", doc_id, e)
+                self.to_join.add(doc_id)
+                return
+            doc['version'] = update['v'] + 1
+            self.dirty_docs.add(doc_id)
+            self.nb_updates += 1
+
+    def _on_error(self, *args):
+        logger.warning("otUpdateError: %s, let's join the docs again.", args)
+        with self.lock:
+            self.to_join.update(self.docs)
+
+    def _on_new_doc(self, parent_id, doc, *args):
+        with self.lock:
+            self.to_join.add(doc['_id'])
+
+    def _on_reconnect(self):
+        # Some updates may have been missed
+        with self.lock:
+            self.to_join.update(self.docs)
+
+    def _join_docs(self):
+        with self.lock:
+            to_join = list(self.to_join)
+            self.to_join.clear()
+        for doc_id in to_join:
+            try:
+                (text, version) = self.overleaf.join_doc(doc_id)
+            except OverleafException as e:
+                logger.warning("Cannot join the doc %s: %s", doc_id, e)
+                continue
+            with self.lock:
+                old = self.docs.get(doc_id)
+                if old is None or old['text'] != text:
+                    self.dirty_docs.add(doc_id)
+                self.docs[doc_id] = {'text': text, 'version': version}
+
+    def start(self):
+        """Join all the docs of the project. The overleaf branch is
+        supposed to match the online project (run ofetch before)."""
+        socket = self.overleaf.get_socket()
+        socket.on('otUpdateApplied', self._on_update)
+        socket.on('otUpdateError', self._on_error)
+        socket.on('reciveNewDoc', self._on_new_doc)
+        socket.on_reconnect(self._on_reconnect)
+        ft = self.overleaf.reload_file_tree()
+        branch_files = set(f for f in self.repo.git.ls_tree("-r", "-z", "--name-only", self.branch).split('\x00') if f)
+        with ft.lock:
+            for (path, node) in ft.l.items():
+                if node.file_type != 'folder' and path.strip("/") in branch_files:
+                    self.committed[node._id] = path.strip("/")
+                if node.file_type == 'doc':
+                    self.to_join.add(node._id)
+        self._join_docs()
+        with self.lock:
+            # The docs that did not change since the fetch do not need a commit
+            for doc_id in list(self.dirty_docs):
+                path = self.committed.get(doc_id)
+                if path and self._get_branch_content(path) == self.docs[doc_id]['text'].encode('utf-8'):
+                    self.dirty_docs.discard(doc_id)
+        logger.info("Following %s doc(s)", len(self.docs))
+
+    def _get_branch_content(self, path):
+        try:
+            return self.repo.git.show("{}:{}".format(self.branch, path), stdout_as_string=False)
+        except git.GitCommandError:
+            return None
+
+    def _download_new_files(self, current):
+        for (_id, (path, file_type)) in current.items():
+            if file_type == 'file' and not _id in self.committed and not _id in self.files:
+                try:
+                    self.files[_id] = self.overleaf.get_file_content(_id)
+                except (OverleafException, requests.exceptions.RequestException) as e:
+                    logger.warning("Cannot download %s: %s", path, e)
+
+    def commit(self):
+        """Commit the changes received since the last commit on the
+        overleaf branch. Returns True if a commit has been created."""
+        ft = self.overleaf.ls(force_reload=True)
+        with ft.lock:
+            current = {node._id: (path.strip("/"), node.file_type)
+                       for (path, node) in ft.l.items()
+                       if node.file_type != 'folder'}
+        self._download_new_files(current)
+        deleted = []
+        written = [] # (path, content or blob sha)
+        with self.lock:
+            new_committed = dict()
+            for (_id, old_path) in self.committed.items():
+                if current.get(_id, (None,))[0] != old_path:
+                    deleted.append(old_path)
+            for (_id, (path, file_type)) in current.items():
+                old_path = self.committed.get(_id)
+                if file_type == 'doc' and _id in self.docs:
+                    if old_path != path or _id in self.dirty_docs:
+                        written.append((path, self.docs[_id]['text'].encode('utf-8')))
+                elif old_path is None:
+                    # New doc not joined yet, or new file being downloaded
+                    if not _id in self.files:
+                        continue
+                    written.append((path, self.files[_id]))
+                elif old_path != path:
+                    # A file moved, its content is already in git
+                    written.append((path, self.repo.git.rev_parse("{}:{}".format(self.branch, old_path))))
+                new_committed[_id] = path
+            # The versions of the docs committed: the updates received
+            # during the commit change them
+            committed_docs = {_id: (doc['version'], doc['text'])
+                              for (_id, doc) in self.docs.items()
+                              if _id in self.dirty_docs}
+        if not deleted and not written:
+            return False
+        def write_files(w):
+            for path in deleted:
+                w.write("D {}\n".format(_fast_import_path(path)).encode('utf-8'))
+            for (path, content) in written:
+                if isinstance(content, str):
+                    w.write("M 100644 {} {}\n".format(content, _fast_import_path(path)).encode('utf-8'))
+                else:
+                    w.write("M 100644 inline {}\ndata {}\n".format(_fast_import_path(path), len(content)).encode('utf-8'))
+                    w.write(content + b"\n")
+        old_tip = self.repo.git.rev_parse(self.branch)
+        changed = commit_in_branch(self.repo, self.branch,
+                                   "Changes made on overleaf until {}".format(datetime.now().strftime("%a. %d %B %Y, %H:%M:%S")),
+                                   write_files)
+        with self.lock:
+            self.committed = new_committed
+            # The docs modified meanwhile stay dirty
+            for (_id, (version, text)) in committed_docs.items():
+                doc = self.docs.get(_id)
+                if (_id in new_committed and doc is not None
+                    and doc['version'] == version and doc['text'] == text):
+                    self.dirty_docs.discard(_id)
+            for _id in new_committed:
+                self.files.pop(_id, None)
+            for _id in list(self.docs):
+                if not _id in current:
+                    del self.docs[_id]
+        if changed:
+            self.nb_commits += 1
+            logger.info("%s file(s) updated, %s removed on the branch %s", len(written), len(deleted), self.branch)
+            self._fast_forward(old_tip)
+        return changed
+
+    def _fast_forward(self, old_tip):
+        """If the current branch was at the previous commit of the
+        overleaf branch, bring it (and the working tree) to the new one.
+        Git refuses if this would overwrite local modifications."""
+        if not self.fast_forward or self.repo.head.is_detached:
+            return
+        if self.repo.active_branch.name == self.branch:
+            # Already done by commit_in_branch
+            return
+        if self.repo.head.commit.hexsha != old_tip:
+            logger.debug("The current branch contains other commits, run opull to merge.")
+            return
+        try:
+            self.repo.git.merge("--ff-only", "--quiet", self.branch)
+        except git.GitCommandError as e:
+            logger.warning("Cannot update the working tree (modified locally?), run opull to merge: %s", e)
+
+    def run(self, poll_interval=0.2, stop_event=None):
+        """Follow the project until stop_event is set (or Ctrl-C)."""
+        self.start()
+        last_commit = time.time()
+        try:
+            while not (stop_event and stop_event.is_set()):
+                time.sleep(poll_interval)
+                if self.to_join:
+                    self._join_docs()
+                if time.time() - last_commit >= self.commit_interval:
+                    last_commit = time.time()
+                    try:
+                        self.commit()
+                    except (OverleafException, requests.exceptions.RequestException) as e:
+                        logger.error("Cannot commit the changes (%s), will try again.", e)
+        finally:
+            self.commit()
+
+def ogit_ofollow(confproject=None, args=None):
+    """Stay connected to the project and commit the changes made online
+    on the overleaf branch every few seconds (only the edits are
+    received, not the whole project). If the current branch has no
+    other commit, it follows the overleaf branch as well (and so the
+    working tree, for the files that are not modified locally)."""
+    if not confproject:
+        confproject = ConfProject(args=args)
+    # Start from the current online project
+    ogit_ofetch(confproject, args=args)
+    repo = get_repo()
+    overleaf = confproject.get_overleaf()
+    commit_interval = getattr(args, 'commit_interval', None)
+    if commit_interval is None:
+        commit_interval = confproject.get_follow_commit_interval()
+    session = FollowSession(repo, overleaf, confproject,
+                            commit_interval=commit_interval,
+                            fast_forward=not getattr(args, 'no_fast_forward', False))
+    logger.info("Following %s (Ctrl-C to stop)", confproject.get_url_project())
+    with cd(repo.working_tree_dir):
+        try:
+            session.run()
+        except KeyboardInterrupt:
+            logger.info("Stop following after %s update(s) and %s commit(s).", session.nb_updates, session.nb_commits)
+        finally:
+            overleaf.close()
+    return 0
+
+##############################
+### Watch mode
+##############################
+
+class WorkingTreeWatcher:
+    """Poll the tracked files of the working tree (like opush, the
+    untracked files are never sent) and tell which ones changed since
+    the last poll. The paths in excluded (files or folders, relative
+    to the root of the repository) are never watched."""
+    def __init__(self, repo, excluded=()):
+        self.repo = repo
+        self.excluded = [e.strip("/") for e in excluded]
+        self.snapshot = self.scan()
+
+    def is_excluded(self, path):
+        return any(path == e or path.startswith(e + "/") for e in self.excluded)
+
+    def scan(self):
+        """path -> (mtime, size) of the files of the working tree."""
+        snapshot = dict()
+        for f in self.repo.git.ls_files("-z", "--cached").split('\x00'):
+            if not f or self.is_excluded(f):
+                continue
+            try:
+                st = os.stat(os.path.join(self.repo.working_tree_dir, f))
+            except OSError:
+                # Removed but still in the index
+                continue
+            snapshot[f] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def poll(self):
+        """Returns (changed, removed), the sets of files created or
+        modified, and removed, since the last poll."""
+        new = self.scan()
+        changed = set(f for (f, stat) in new.items() if self.snapshot.get(f) != stat)
+        removed = set(self.snapshot) - set(new)
+        self.snapshot = new
+        return (changed, removed)
+
+def hash_file(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class WatchSession:
+    """Push the modifications of the working tree as soon as they are
+    saved (see ogit_owatch). The working tree is the reference, as in
+    opush_force, but an online file is only removed if we know it: it
+    is in the overleaf branch, or it has been sent by this session."""
+    def __init__(self, repo, overleaf, confproject, debounce=1.0, max_delay=10, reconcile_interval=600):
+        self.repo = repo
+        self.overleaf = overleaf
+        self.confproject = confproject
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.reconcile_interval = reconcile_interval
+        self.pushed = dict() # path -> hash of the content sent online
+        self.reconcile_requested = False
+        self.nb_pushes = 0
+        self.last_reconcile = 0
+        self.branch_commit = None
+        self.branch_in_sync = False
+        # The password and the backups must never be sent, even if tracked
+        svg_path = os.path.relpath(os.path.join(repo.working_tree_dir, confproject.get_svg_path()),
+                                   repo.working_tree_dir)
+        self.watcher = WorkingTreeWatcher(repo, excluded=[".ogit_confproject", svg_path])
+
+    def _get_branch_files(self):
+        branch = self.confproject.get_overleaf_branch_name()
+        if not branch in [b.name for b in self.repo.branches]:
+            return (None, set())
+        files = set(f for f in self.repo.git.ls_tree("-r", "-z", "--name-only", branch).split('\x00') if f)
+        return (branch, files)
+
+    def _needs_upload(self, path):
+        try:
+            return self.pushed.get(path) != hash_file(path)
+        except OSError:
+            return False
+
+    def push(self, changed, removed):
+        """Send changed and remove removed (local paths) online."""
+        ft = self.overleaf.ls(force_reload=True)
+        files_to_send = sorted(f for f in changed if self._needs_upload(f))
+        # The folders that do not contain anything else online are
+        # removed with their content by plan_remote_deletions
+        paths_to_remove = sorted(p for p in removed if ft.get_element(p))
+        (paths_to_remove, nb_saved) = plan_remote_deletions(ft, paths_to_remove, kept=files_to_send)
+        if not files_to_send and not paths_to_remove:
+            logger.debug("Nothing changed")
+            return
+        hashes = {f: hash_file(f) for f in files_to_send}
+        operations = build_push_operations(ft, files_to_send, paths_to_remove)
+        report = RemoteExecutor(self.overleaf,
+                                concurrency=self.confproject.get_push_concurrency()).run(operations)
+        self.pushed.update(hashes)
+        for path in removed:
+            self.pushed.pop(path, None)
+        self.nb_pushes += 1
+        logger.info("Sent %s file(s), removed %s path(s) (%.2fs)", len(files_to_send), len(paths_to_remove), report.wall_time)
+
+    def reconcile(self):
+        """Compare the whole working tree with the online project: send
+        the files that are missing online or that differ from the
+        overleaf branch (and were not sent yet), and remove the known
+        online files that do not exist locally anymore."""
+        logger.info("Reconciliation with the online project...")
+        ft = self.overleaf.ls(force_reload=True)
+        local_files = set(self.watcher.snapshot)
+        online_files = set(f.strip("/") for f in ft.get_list_files() if f.strip("/"))
+        (branch, branch_files) = self._get_branch_files()
+        commit = self.repo.git.rev_parse(branch) if branch else None
+        if commit != self.branch_commit:
+            # The online project matches the branch when we start (or
+            # when the branch is updated): later differences come from us
+            self.branch_commit = commit
+            self.branch_in_sync = bool(branch) and branch_files == online_files
+        if self.branch_in_sync:
+            # Only the files that differ from the overleaf branch
+            candidates = set(f for f in self.repo.git.diff("-z", "--name-only", "--no-renames", branch).split('\x00') if f)
+            candidates |= local_files - branch_files
+        else:
+            candidates = set(local_files)
+        candidates = (candidates & local_files) | (local_files - online_files)
+        known = (branch_files | set(self.pushed)) & online_files
+        self.push(candidates, known - local_files)
+        self.last_reconcile = time.time()
+
+    def request_reconcile(self, *args):
+        self.reconcile_requested = True
+
+    def run(self, poll_interval=0.5, stop_event=None):
+        """Watch the working tree until stop_event is set (or Ctrl-C)."""
+        self.reconcile()
+        pending_changed = set()
+        pending_removed = set()
+        first_change = last_change = None
+        while not (stop_event and stop_event.is_set()):
+            time.sleep(poll_interval)
+            (changed, removed) = self.watcher.poll()
+            now = time.time()
+            if changed or removed:
+                pending_changed = (pending_changed - removed) | changed
+                pending_removed = (pending_removed - changed) | removed
+                last_change = now
+                first_change = first_change or now
+            if (pending_changed or pending_removed) and (now - last_change >= self.debounce
+                                                         or now - first_change >= self.max_delay):
+                try:
+                    self.push(pending_changed, pending_removed)
+                    pending_changed = set()
+                    pending_removed = set()
+                    first_change = last_change = None
+                except (OverleafException, requests.exceptions.RequestException) as e:
+                    # Keep the changes, we will try again after the next debounce
+                    logger.error("Cannot push the modifications (%s), will try again.", e)
+                    last_change = now
+            if self.reconcile_requested or now - self.last_reconcile >= self.reconcile_interval:
+                self.reconcile_requested = False
+                try:
+                    self.reconcile()
+                except (OverleafException, requests.exceptions.RequestException) as e:
+                    logger.error("The reconciliation failed: %s", e)
+                    self.last_reconcile = now
+
+def ogit_owatch(confproject=None, args=None):
+    """Watch the working tree and push the saved files online within a
+    few seconds, without pulling nor committing. The changes are
+    debounced and sent together, and the whole working tree is
+    compared with the online project periodically (or when the
+    process receives SIGUSR1)."""
+    if not confproject:
+        confproject = ConfProject(args=args)
+    repo = get_repo()
+    overleaf = confproject.get_overleaf()
+    options = confproject.get_watch_options()
+    for key in options:
+        if getattr(args, key, None) is not None:
+            options[key] = getattr(args, key)
+    session = WatchSession(repo, overleaf, confproject,
+                           debounce=options['debounce'],
+                           max_delay=options['max_delay'],
+                           reconcile_interval=options['reconcile_interval'])
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, session.request_reconcile)
+    logger.info("Watching %s (Ctrl-C to stop)", repo.working_tree_dir)
+    with cd(repo.working_tree_dir):
+        try:
+            session.run(poll_interval=options['poll_interval'])
+        except KeyboardInterrupt:
+            logger.info("Stop watching after %s push(es).", session.nb_pushes)
+        finally:
+            overleaf.close()
+    return 0
+
+##############################
+### Several projects at once
+##############################
+
+class MultiSyncError(OverleafException):
+    """Some projects could not be synchronised by omulti."""
+    pass
+
+def read_manifest(manifest):
+    """One repository per line (relative to the folder of the manifest),
+    empty lines and lines starting with # are ignored."""
+    folder = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest) as f:
+        return [os.path.join(folder, line.strip())
+                for line in f
+                if line.strip() and not line.strip().startswith("#")]
+
+def _run_in_project(command, path, conf_dict, session, args):
+    """Run in a worker process: run the command in the repository path,
+    with the configuration conf_dict (read, and completed by the user if
+    needed, in the parent process)."""
+    start = time.time()
+    name = os.path.basename(path.rstrip("/"))
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(logging.Formatter("[{}] ".format(name) + FORMAT))
+    result = {'path': path, 'status': 'ok', 'error': None}
+    # The connections of the parent process must not be used here
+    _overleaf_instances.clear()
+    try:
+        os.chdir(path)
+        # Several workers share the terminal: nothing can be asked to the user
+        confproject = ConfProject(conf_dict=conf_dict, args=args, interactive=False)
+        confproject.session = session
+        res = MULTI_COMMANDS[command](confproject=confproject, args=args)
+        if isinstance(res, int) and res != 0:
+            result['status'] = 'failed'
+            result['error'] = "exit code {}".format(res)
+    except BaseException as e:
+        result['status'] = 'failed'
+        result['error'] = "{}: {}".format(type(e).__name__, e)
+    finally:
+        try:
+            wait_for_background_tasks()
+        except BaseException:
+            pass
+    result['time'] = time.time() - start
+    return result
+
+def ogit_omulti(confproject=None, args=None):
+    """Run ofetch, opull or opush (args.multi_command) in several
+    repositories (args.repos, and the ones listed in args.manifest),
+    with at most args.jobs projects at once (each one in its own
+    process). Each account logs in only once. Prints a summary."""
+    paths = [os.path.abspath(p) for p in (getattr(args, 'repos', None) or [])]
+    if getattr(args, 'manifest', None):
+        paths += read_manifest(args.manifest)
+    if not paths:
+        logger.error("No repository given.")
+        return 1
+    results = dict()
+    # Log in once per account, the session is given to the workers
+    sessions = dict()
+    work = []
+    for path in paths:
+        try:
+            conf = ConfProject(json_file=os.path.join(path, ".ogit_confproject"))
+            url = urlparse(conf.get_url_project())
+            account = (url.scheme, url.netloc, conf.get_email())
+            if not account in sessions:
+                sessions[account] = conf.get_overleaf().get_session()
+            work.append((path, conf.conf_dict, sessions[account]))
+        except BaseException as e:
+            results[path] = {'path': path, 'status': 'failed', 'time': 0,
+                             'error': "{}: {}".format(type(e).__name__, e)}
+    logger.info("%s project(s), %s account(s), %s at once", len(paths), len(sessions), args.jobs)
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = {pool.submit(_run_in_project, args.multi_command, path, conf_dict, session, args): path
+                   for (path, conf_dict, session) in work}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                results[path] = future.result()
+            except BaseException as e:
+                results[path] = {'path': path, 'status': 'failed', 'time': 0,
+                                 'error': "{}: {}".format(type(e).__name__, e)}
+            logger.info("%s: %s", path, results[path]['status'])
+    ### Summary
+    width = max(len(p) for p in paths)
+    print("{:<{}}  {:>7}  {:>8}  {}".format("project", width, "status", "time (s)", "error"))
+    for path in paths:
+        r = results[path]
+        print("{:<{}}  {:>7}  {:>8.1f}  {}".format(path, width, r['status'], r['time'], r['error'] or ""))
+    failed = [p for p in paths if results[p]['status'] != 'ok']
+    print("{} project(s) in {:.1f}s, {} failure(s)".format(len(paths), time.time() - start, len(failed)))
+    if failed:
+        raise MultiSyncError("{} project(s) failed: {}".format(len(failed), ", ".join(failed)))
+    return 0
 
 def ogit_oremote_add(confproject=None, do_nothing_if_exists=None, args=None):
     """
@@ -1109,7 +4522,7 @@ def ogit_oremote_add(confproject=None, do_nothing_if_exists=None, args=None):
     if not confproject:
         confproject = ConfProject(try_to_find_conf=False)
     confproject.save(path_to_save)
-    logger.info("The configuration file has been saved info {}".format(path_to_save))
+    logger.info("The configuration file has been saved info %s", path_to_save)
     return confproject
 
 def ogit_oclone(confproject=None, args=None):
@@ -1130,7 +4543,7 @@ def ogit_oclone(confproject=None, args=None):
         git.Repo(".")
         raise GitRepoAlreadyExist("A repository already exists here, if you want to sync this existing repository with overleaf, please see ofetch and opull (opull = ofetch + merge into current branch).")
     except git.InvalidGitRepositoryError:
-        git.Repo.init(".")
+        TracedRepo.init(".")
     confproject = ogit_oremote_add(confproject=confproject)
     ogit_opull(confproject)
 
@@ -1153,11 +4566,37 @@ def usage():
 ### Command Line Interface
 ##############################
 
+MULTI_COMMANDS = {'ofetch': ogit_ofetch,
+                  'opull': ogit_opull,
+                  'opush': ogit_opush}
+
+def write_profile(args, cprofile=None):
+    """Print and/or save the profile of the command (see Profiler)."""
+    profiler.stop()
+    if cprofile:
+        cprofile.disable()
+        cprofile.dump_stats(args.cprofile)
+        logger.info("cProfile saved in %s (read it with: python -m pstats %s)", args.cprofile, args.cprofile)
+    if args.profile:
+        print(profiler.report(), file=sys.stderr)
+    if args.profile_json:
+        run = {'date': datetime.now().isoformat(timespec='seconds'),
+               'command': args.command,
+               'argv': sys.argv[1:]}
+        run.update(profiler.to_dict())
+        with open(args.profile_json, "a") as f:
+            f.write(json.dumps(run) + "\n")
+
 def main():
     parser = argparse.ArgumentParser(description='ogit: Free git bridge between overleaf v2 and git')
     subparsers = parser.add_subparsers(help='Possible commands:', dest='command')
 
-    parser.add_argument("-v", choices=['INFO', 'DEBUG', 'SPAM'])
+    parser.add_argument("-v", choices=['WARNING', 'INFO', 'DEBUG', 'SPAM'], help="Log level (default INFO)")
+    parser.add_argument("--trace", metavar="FILE", help="Write a span (one JSON line) for each HTTP request, socket.io exchange and git command in FILE ('-' for stderr). Can also be set with the OGIT_TRACE environment variable.")
+    parser.add_argument("--profile", action='store_true', help="Print the time spent in each phase of the command (login, ls, download, import, push...), with the number of requests, bytes, files and git commands.")
+    parser.add_argument("--profile-json", metavar="FILE", help="Append the phases of the command (one JSON line per run) to FILE, to compare the runs over time.")
+    parser.add_argument("--deadline", type=float, metavar="SECONDS", help="Stop sending requests to overleaf after SECONDS (the command then fails).")
+    parser.add_argument("--cprofile", metavar="FILE", help="Save a cProfile of the main thread in FILE (read it with python -m pstats FILE).")
 
     # oclone
     parser_oclone = subparsers.add_parser('oclone', help='Simulate a clone for an overleaf project')
@@ -1169,20 +4608,66 @@ def main():
 
     # opush
     parser_opush = subparsers.add_parser('opush', help="First run opull to merge the online content on the current branch, and then push the modifications online if no conflict occurs (and merge the current branch back to the overleaf's reserved branch)")
+    parser_opush.add_argument("--full", action='store_true', help="Send all the files, even the ones that did not change since the last synchronisation.")
+    parser_opush.add_argument("--force-download", action='store_true', help="Download the project even if it did not change since the last fetch.")
+    parser_opush.add_argument("--plan", nargs='?', const='-', metavar="PLAN.json", help="Do not push anything (the overleaf branch is only fetched): print the operations that a push would run with an estimation of the time, and save them in PLAN.json if given (without PLAN.json, the plan is written in json on stdout and the summary on stderr).")
+    parser_opush.add_argument("--apply-plan", metavar="PLAN.json", help="Run exactly the operations saved by --plan (fails if the repository or the online project changed since).")
+    parser_opush.add_argument("--resume", action='store_true', help="Finish the push that has been interrupted (without pulling first), if HEAD did not change since.")
     parser_opush.set_defaults(func=ogit_opush)
 
     # opush_force
     parser_opush_force = subparsers.add_parser('opush_force', help='Like opush, but does not do the opull first.')
+    parser_opush_force.add_argument("--full", action='store_true', help="Send all the files, even the ones that did not change since the last synchronisation.")
+    parser_opush_force.add_argument("--apply-plan", metavar="PLAN.json", help="Run exactly the operations saved by opush --plan.")
+    parser_opush_force.add_argument("--resume", action='store_true', help="Finish the push that has been interrupted, if HEAD did not change since.")
     parser_opush_force.set_defaults(func=ogit_opush_force)
 
     # opull
     parser_opull = subparsers.add_parser('opull', help="Download the content from overleaf, put it on the overleaf's reserved_branch, and merge this branch with the current branch.")
+    parser_opull.add_argument("--force-download", action='store_true', help="Download the project even if it did not change since the last fetch.")
     parser_opull.set_defaults(func=ogit_opull)
 
     # ofetch
     parser_ofetch = subparsers.add_parser('ofetch', help="Download the content from overleaf, and put in on the overleaf's reserved branch. If you want to merge, see opull")
+    parser_ofetch.add_argument("--force-download", action='store_true', help="Download the project even if it did not change since the last fetch.")
     parser_ofetch.set_defaults(func=ogit_ofetch)
 
+    # ofollow
+    parser_ofollow = subparsers.add_parser('ofollow', help="Stay connected to overleaf, and commit the online modifications on the overleaf's reserved branch every few seconds. If your current branch has no other commit, it is updated as well.")
+    parser_ofollow.add_argument("--commit-interval", type=float, help="Seconds between two commits (default 5).")
+    parser_ofollow.add_argument("--no-fast-forward", action='store_true', help="Only update the overleaf's reserved branch, never the current branch.")
+    parser_ofollow.add_argument("--force-download", action='store_true', help="Download the project first even if it did not change since the last fetch.")
+    parser_ofollow.set_defaults(func=ogit_ofollow)
+
+    # owatch
+    parser_owatch = subparsers.add_parser('owatch', help="Watch the working tree and push online the files as soon as they are saved (without pulling nor committing). The whole working tree is compared with the online project periodically, or when the process receives SIGUSR1.")
+    parser_owatch.add_argument("--debounce", type=float, help="Seconds without modification before sending the modified files (default 1).")
+    parser_owatch.add_argument("--max-delay", type=float, help="Maximum number of seconds a modification can wait (default 10).")
+    parser_owatch.add_argument("--reconcile-interval", type=float, help="Seconds between two full comparisons with the online project (default 600).")
+    parser_owatch.set_defaults(func=ogit_owatch)
+
+    # omulti
+    parser_omulti = subparsers.add_parser('omulti', help="Run ofetch, opull or opush in several repositories at once, and print a summary.")
+    parser_omulti.add_argument("multi_command", choices=['ofetch', 'opull', 'opush'])
+    parser_omulti.add_argument("repos", nargs='*', metavar="REPO", help="Path of the repositories")
+    parser_omulti.add_argument("--manifest", help="File listing the repositories, one per line")
+    parser_omulti.add_argument("-j", "--jobs", type=int, default=4, help="Number of projects synchronised at once (default 4)")
+    parser_omulti.add_argument("--full", action='store_true', help="opush: send all the files.")
+    parser_omulti.add_argument("--force-download", action='store_true', help="Download the projects even if they did not change since the last fetch.")
+    parser_omulti.set_defaults(func=ogit_omulti)
+
+    # osvg
+    parser_osvg = subparsers.add_parser('osvg', help="List the backups of the online project (made at each download), or restore one of them.")
+    parser_osvg.add_argument("--restore", metavar="BACKUP", help="Name of the backup to restore")
+    parser_osvg.add_argument("--to", metavar="FOLDER", help="Folder in which the backup is restored")
+    parser_osvg.set_defaults(func=ogit_osvg)
+
+    # oexport
+    parser_oexport = subparsers.add_parser('oexport', help="Write the online project on the standard output (or in a file) as a zip, tar or tar.gz, while it is downloaded, without touching the disk. Works outside of a git repository.")
+    parser_oexport.add_argument("--format", choices=['zip', 'tar', 'tar.gz'], default='zip', help="Format of the archive (default zip, as given by overleaf)")
+    parser_oexport.add_argument("-o", "--output", metavar="FILE", default='-', help="File in which the archive is written (default -, the standard output)")
+    parser_oexport.set_defaults(func=ogit_oexport)
+
     # # XXX
     # parser_XXX = subparsers.add_parser('XXX', help='YYY')
     # parser_XXX.set_defaults(func=ogit_XXX)
@@ -1192,8 +4677,27 @@ def main():
     parser_help.set_defaults(func=lambda args: parser.print_help())
 
     args = parser.parse_args()
+    if args.v:
+        logger.setLevel(getattr(logging, args.v))
+    trace_file = args.trace or os.environ.get("OGIT_TRACE")
+    if trace_file:
+        tracer.enable(trace_file)
+    cprofile = None
+    if args.profile or args.profile_json or args.cprofile:
+        profiler.enable()
+        if args.cprofile:
+            cprofile = cProfile.Profile()
+            cprofile.enable()
     if hasattr(args, 'func'):
-        args.func(args=args)
+        try:
+            args.func(args=args)
+        finally:
+            wait_for_background_tasks()
+            if profiler.enabled:
+                write_profile(args, cprofile)
+            if tracer.enabled:
+                logger.info("Trace written in %s (%s)", trace_file, tracer.summary())
+                tracer.close()
     else:
         parser.print_help()
 